@@ -6,21 +6,45 @@
 # should be provided in a cluster.yaml file
 
 # All the services are handled based on what is provided in the configuration.
-# Note: For any new service a `Service` class will need to be implemented.
+# Note: New services are described in `SERVICE_REGISTRY` or the `service_registry` section of
+# the cluster.yaml, a `Service` subclass is only needed for steps that aren't declarative.
 
+from contextlib import contextmanager
 from functools import wraps
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from datetime import datetime
+import base64
+import glob
+import hashlib
+import httplib
+import Queue
+import random
+import select
+import shutil
+import socket
+import threading
+import urllib
+import urllib2
+import urlparse
 import yaml
 
 from ansible.module_utils.basic import *
 
 from cm_api.api_client import ApiResource, ApiException
+from cm_api.endpoints.roles import ApiRole
 from cm_api.endpoints.services import ApiServiceSetupInfo, ApiBulkCommandList
+from cm_api.endpoints.types import ApiHostRef, ApiList
 
 
 REMOTE_PARCEL_REPO_URLS = 'REMOTE_PARCEL_REPO_URLS'
 
+# Local parcel repository of the Cloudera Manager server. Parcels found here with a matching
+# `.sha` file are considered as downloaded by CM.
+CM_PARCEL_REPO_DIR = '/opt/cloudera/parcel-repo'
+
 # List of services to configure in the specified order. The names
-# need to match with the names of the respective `Service` subclasses.
+# need to match with the keys of `SERVICE_REGISTRY`.
 # BASE_SERVICES contains a list of services that will be started first, before the
 # rest of the services are configured, since some of them depend on for example creating
 # directories on HDFS.
@@ -28,59 +52,761 @@ BASE_SERVICES = ['Zookeeper', 'Hdfs', 'Yarn']
 ADDITIONAL_SERVICES = ['Spark_On_Yarn', 'Hbase', 'Hive', 'Impala', 'Flume', 'Oozie', 'Sqoop',
                        'Solr', 'Kafka', 'Ranger', 'Hue']
 
+# Declarative description of the services, keyed by service name as used in BASE_SERVICES and
+# ADDITIONAL_SERVICES. `depends_on` lists the services that have to be deployed and started first.
+# `pre_start` and `post_start` are ordered lists of CM commands, either an `ApiService` method
+# (`method`, with optional `args`) or a raw service command (`command`, with optional
+# `api_version`), and the `timeout` in seconds to wait for it. A command only waits for the
+# commands named in its `after`, so independent commands of the same service run concurrently.
+# Services can be added or overridden with a `service_registry` section in the cluster.yaml.
+SERVICE_REGISTRY = {
+    'Zookeeper': dict(
+        pre_start=[dict(name='InitZookeeper', method='init_zookeeper', timeout=60)]),
+    'Hdfs': dict(
+        depends_on=['Zookeeper'],
+        post_start=[dict(name='CreateHdfsTmp', method='create_hdfs_tmp', timeout=60)]),
+    'Yarn': dict(
+        depends_on=['Zookeeper', 'Hdfs'],
+        pre_start=[dict(name='CreateJobHistoryDir', method='create_yarn_job_history_dir', timeout=60),
+                   dict(name='CreateNodeManagerRemoteAppLogDir',
+                        method='create_yarn_node_manager_remote_app_log_dir', timeout=60)]),
+    'Spark_On_Yarn': dict(
+        depends_on=['Hdfs', 'Yarn'],
+        pre_start=[dict(name='CreateSparkUserDir', command='CreateSparkUserDirCommand',
+                        api_version=7, timeout=60),
+                   dict(name='CreateSparkHistoryDir', command='CreateSparkHistoryDirCommand',
+                        api_version=7, timeout=60)]),
+    'Hbase': dict(
+        depends_on=['Zookeeper', 'Hdfs'],
+        pre_start=[dict(name='CreateHbaseRoot', method='create_hbase_root', timeout=60)]),
+    # TODO(rnirmal): CreateHiveMetastoreDatabase and CreateHiveMetastoreTables keep failing as
+    # post_start commands, need to figure out why. Nothing useful in the manager logs
+    'Hive': dict(
+        depends_on=['Zookeeper', 'Hdfs', 'Yarn'],
+        pre_start=[dict(name='CreateHiveWarehouse', method='create_hive_warehouse', timeout=60)]),
+    'Impala': dict(
+        depends_on=['Hdfs', 'Hive', 'Hbase'],
+        pre_start=[dict(name='CreateImpalaUserDir', method='create_impala_user_dir', timeout=60)]),
+    'Flume': dict(
+        depends_on=['Hdfs', 'Hbase', 'Solr']),
+    'Oozie': dict(
+        depends_on=['Hdfs', 'Yarn'],
+        pre_start=[dict(name='CreateOozieSchema', method='create_oozie_db', timeout=300),
+                   dict(name='InstallOozieSharedLib', method='install_oozie_sharelib', timeout=300,
+                        after=['CreateOozieSchema'])]),
+    'Sqoop': dict(
+        depends_on=['Hdfs', 'Yarn'],
+        pre_start=[dict(name='CreateSqoopUserDir', method='create_sqoop_user_dir', timeout=300),
+                   dict(name='CreateSqoopDBTables', method='create_sqoop_database_tables',
+                        timeout=300)]),
+    'Solr': dict(
+        depends_on=['Zookeeper', 'Hdfs'],
+        pre_start=[dict(name='InitSolr', method='init_solr', timeout=300),
+                   dict(name='CreateSolrHdfsHomeDir', method='create_solr_hdfs_home_dir',
+                        timeout=300)]),
+    'Hue': dict(
+        depends_on=['Hdfs', 'Yarn', 'Hive', 'Hbase', 'Impala', 'Oozie', 'Sqoop', 'Solr', 'Sentry']),
+    'Kafka': dict(
+        depends_on=['Zookeeper']),
+    'Sentry': dict(
+        depends_on=['Zookeeper', 'Hdfs'],
+        pre_start=[dict(name='CreateSentryDBTables', method='create_sentry_database_tables',
+                        timeout=300)]),
+    'Ranger': dict(
+        depends_on=['Hdfs']),
+}
+
+# Number of services that can be deployed/started at the same time, as long as their
+# dependencies (`Service.DEPENDS_ON`) have already been handled.
+DEFAULT_PARALLELISM = 4
+
+# Time in seconds for which a snapshot of the service and role states is reused
+STATE_TTL = 10
+
+# Time in seconds since the last agent heartbeat after which a host is considered not ready
+HEARTBEAT_TIMEOUT = 60
+
+# Time in seconds a service waits for the hosts its roles are placed on to become ready
+HOST_READY_TIMEOUT = 600
+
+# Host health checks that keep a host from being ready when BAD: the health of its agent and the
+# resolution of its name. Other BAD checks, like the clock offset, swapping or free disk space,
+# don't keep the roles from being deployed and are only reported.
+HOST_READY_CHECKS = ('HOST_SCM_HEALTH', 'HOST_DNS_RESOLUTION')
+
+# Parcel stages at which the parcel is unpacked on all the hosts of its cluster
+PARCEL_READY_STAGES = ('DISTRIBUTED', 'ACTIVATED')
+
+# Role catalog used by the placement planner. For every role group: where it is placed ('master'
+# roles are bin-packed on the master hosts, 'worker' roles go on every worker host), the number of
+# instances for master roles, the heap in MB and the number of cores it is expected to use.
+# Instances of the same master role are always placed on different hosts (anti-affinity), and
+# 'colocate' places a role on the same hosts as another role group of the service.
+ROLE_CATALOG = {
+    'ZOOKEEPER': [dict(group='SERVER', placement='master', count=3, heap=1024, cores=1)],
+    'HDFS': [dict(group='NAMENODE', placement='master', count=2, heap=4096, cores=2),
+             dict(group='FAILOVERCONTROLLER', colocate='NAMENODE', heap=256, cores=0.5),
+             dict(group='JOURNALNODE', placement='master', count=3, heap=512, cores=0.5),
+             dict(group='DATANODE', placement='worker', heap=1024, cores=1)],
+    'YARN': [dict(group='RESOURCEMANAGER', placement='master', count=2, heap=2048, cores=1),
+             dict(group='JOBHISTORY', placement='master', count=1, heap=1024, cores=0.5),
+             dict(group='NODEMANAGER', placement='worker', heap=1024, cores=1)],
+    'SPARK_ON_YARN': [dict(group='SPARK_YARN_HISTORY_SERVER', placement='master', count=1, heap=1024,
+                           cores=0.5)],
+    'HBASE': [dict(group='MASTER', placement='master', count=2, heap=2048, cores=1),
+              dict(group='REGIONSERVER', placement='worker', heap=8192, cores=2)],
+    'HIVE': [dict(group='HIVEMETASTORE', placement='master', count=1, heap=2048, cores=1),
+             dict(group='HIVESERVER2', placement='master', count=1, heap=4096, cores=2)],
+    'IMPALA': [dict(group='STATESTORE', placement='master', count=1, heap=512, cores=0.5),
+               dict(group='CATALOGSERVER', placement='master', count=1, heap=4096, cores=1),
+               dict(group='IMPALAD', placement='worker', heap=8192, cores=2)],
+    'FLUME': [dict(group='AGENT', placement='worker', heap=512, cores=0.5)],
+    'OOZIE': [dict(group='OOZIE_SERVER', placement='master', count=1, heap=1024, cores=0.5)],
+    'SQOOP': [dict(group='SQOOP_SERVER', placement='master', count=1, heap=1024, cores=0.5)],
+    'SOLR': [dict(group='SOLR_SERVER', placement='master', count=1, heap=2048, cores=1)],
+    'KAFKA': [dict(group='KAFKA_BROKER', placement='worker', heap=1024, cores=1)],
+    'SENTRY': [dict(group='SENTRY_SERVER', placement='master', count=1, heap=1024, cores=0.5)],
+    'HUE': [dict(group='HUE_SERVER', placement='master', count=1, heap=1024, cores=0.5)],
+}
+
+# Share of a host's memory and cores left for the OS and the agent by the placement planner
+HOST_RESERVED_SHARE = 0.1
+
+# Clusters with fewer dedicated worker hosts than this also run the worker roles on the master
+# hosts, so that HDFS still has enough DataNodes for its default 3 replicas
+MIN_WORKER_HOSTS = 3
+
+# Default number of roles restarted at a time during a rolling restart
+RESTART_BATCH_SIZE = 1
+
+# Roles holding replicated HDFS data. These are restarted in batches smaller than the HDFS
+# replication factor, so that every block stays available
+REPLICATED_ROLE_TYPES = ('DATANODE', 'REGIONSERVER')
+
+# Roles that form a quorum and are always restarted one at a time
+QUORUM_ROLE_TYPES = ('SERVER', 'JOURNALNODE')
+
+# Role types with fewer instances than this are treated as masters and restarted one at a time
+MIN_WORKER_ROLES = 4
+
+# Maximum number of roles created with a single API call
+ROLE_BATCH_SIZE = 100
+
+# HTTP methods replayed on a new connection when a reused keep-alive connection drops
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+# Seconds an idle keep-alive connection is reused, below the idle timeout of the CM web server so
+# that the server doesn't close it under a request
+KEEPALIVE_IDLE_TIMEOUT = 10
+
+# Interval in seconds at which the status of all the in-flight CM commands is refreshed
+COMMAND_POLL_INTERVAL = 1
+
+# Seconds for which a CM command not available for execution yet is retried, on top of the time
+# given to each attempt to finish
+COMMAND_RETRY_DEADLINE = 120
+
+
+class RetryPolicy(object):
+    """
+    Decide how long to sleep between attempts of a retried call
+
+    The delay grows exponentially by `backoff` from `delay` up to `max_delay`, with +/- `jitter`
+    (a fraction of the delay) applied on top. The call is given up once either `attempts` or the
+    overall `deadline` (in seconds) is exhausted, whichever comes first.
+    """
+    def __init__(self, attempts=None, delay=5, backoff=2, max_delay=60, jitter=0.1, deadline=None):
+        if attempts is None and deadline is None:
+            raise ValueError("Either attempts or deadline should be specified")
+        self.attempts = attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def next_delay(self, attempt, elapsed):
+        """
+        :param attempt: Number of attempts made so far
+        :param elapsed: Time in seconds since the first attempt
+        :return: Seconds to sleep before the next attempt, None to give up
+        """
+        if self.attempts is not None and attempt >= self.attempts:
+            return None
+        delay = min(self.max_delay, self.delay * self.backoff ** (attempt - 1))
+        if self.jitter:
+            delay += delay * random.uniform(-self.jitter, self.jitter)
+        if self.deadline is not None:
+            remaining = self.deadline - elapsed
+            if remaining <= 0:
+                return None
+            delay = min(delay, remaining)
+        return max(0, delay)
+
+
+class Tracer(object):
+    """
+    Collect timing spans for the phases of a build, along with the number of API calls made and
+    retries done while each span was open on the current thread.
+
+    Spans can be written out in the Chrome trace event format (chrome://tracing, Perfetto).
+    """
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name, category='setup'):
+        """
+        Context manager timing the enclosed block as a span
+        """
+        span = dict(name=name, cat=category, start=time.time(), api_calls=0, retries=0,
+                    tid=threading.current_thread().name)
+        self._stack.append(span)
+        try:
+            yield span
+        finally:
+            self._stack.pop()
+            self.add(span)
+
+    def add(self, span):
+        """
+        Add a span, which needs at least a name, category and start time
+        """
+        span.setdefault('end', time.time())
+        span.setdefault('api_calls', 0)
+        span.setdefault('retries', 0)
+        span.setdefault('tid', threading.current_thread().name)
+        with self._lock:
+            self.spans.append(span)
+
+    def count(self, key, value=1):
+        """
+        Add to a counter of all the spans open on the current thread
+        """
+        for span in self._stack:
+            span[key] += value
+
+    def summary(self):
+        """
+        :return: List of spans with their duration in seconds, longest first
+        """
+        with self._lock:
+            spans = list(self.spans)
+        return [dict(name=span['name'], category=span['cat'],
+                     duration=round(span['end'] - span['start'], 3),
+                     api_calls=span['api_calls'], retries=span['retries'])
+                for span in sorted(spans, key=lambda span: span['start'] - span['end'])]
+
+    def write(self, path):
+        """
+        Write all the spans as a Chrome trace file
+        """
+        with self._lock:
+            spans = list(self.spans)
+        events = [dict(name=span['name'], cat=span['cat'], ph='X', pid=1, tid=span['tid'],
+                       ts=int(span['start'] * 1000000),
+                       dur=int((span['end'] - span['start']) * 1000000),
+                       args=dict(api_calls=span['api_calls'], retries=span['retries']))
+                  for span in spans]
+        with open(path, 'w') as trace:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), trace)
 
-def retry(attempts=3, delay=5):
+
+TRACER = Tracer()
+
+
+def percentile(values, fraction):
+    """
+    :return: Value at the given fraction (0-1) of the sorted values, None for no values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class PooledHttpClient(object):
+    """
+    Keep-alive HTTP(S) transport for the CM API, replacing the urllib2 based `HttpClient` which
+    opens a new connection (and TLS handshake) for every request.
+
+    Up to `size` persistent connections are shared by all the threads, and basic auth is sent
+    upfront instead of after a 401 challenge. URL building, headers and errors are still handled by
+    the wrapped `HttpClient`, so this is a drop in replacement for `ApiResource._client`.
+    """
+    def __init__(self, client, username, password, size):
+        self._client = client
+        self._auth = 'Basic ' + base64.b64encode('{}:{}'.format(username, password))
+        url = urlparse.urlparse(client.base_url)
+        self._connection_class = httplib.HTTPSConnection if url.scheme == 'https' else httplib.HTTPConnection
+        self._netloc = url.netloc
+        self._slots = threading.BoundedSemaphore(max(1, size))
+        self._idle = Queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._latencies = []
+        self.requests = 0
+        self.connections = 0
+        self.reused = 0
+
+    @property
+    def base_url(self):
+        return self._client.base_url
+
+    @property
+    def logger(self):
+        return self._client.logger
+
+    @staticmethod
+    def _stale(conn, idle_since):
+        """
+        :return: True if an idle connection expired or was closed by the server, which makes its
+                 socket readable
+        """
+        if time.time() - idle_since > KEEPALIVE_IDLE_TIMEOUT or conn.sock is None:
+            return True
+        return bool(select.select([conn.sock], [], [], 0)[0])
+
+    def _connection(self):
+        """
+        :return: Tuple of an idle connection or a new one, and whether it is reused
+        """
+        while True:
+            try:
+                conn, idle_since = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            if not self._stale(conn, idle_since):
+                return conn, True
+            conn.close()
+        with self._lock:
+            self.connections += 1
+        return self._connection_class(self._netloc), False
+
+    def _request(self, http_method, url, data, headers):
+        selector = url[url.index(self._netloc) + len(self._netloc):] or '/'
+        self._slots.acquire()
+        try:
+            conn, reused = self._connection()
+            sent = False
+            try:
+                conn.request(http_method, selector, data, headers)
+                sent = True
+                resp = conn.getresponse()
+                body = resp.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # A request that failed to send never reached the server. Once sent, the server
+                # may have received it before the connection dropped, so only the requests that
+                # are safe to send twice are replayed
+                if not reused or (sent and http_method not in IDEMPOTENT_METHODS):
+                    raise
+                # The server closed an idle keep-alive connection, retry on a new one
+                conn, reused = self._connection_class(self._netloc), False
+                with self._lock:
+                    self.connections += 1
+                conn.request(http_method, selector, data, headers)
+                resp = conn.getresponse()
+                body = resp.read()
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self._idle.put((conn, time.time()))
+            if reused:
+                with self._lock:
+                    self.reused += 1
+            return resp, body
+        finally:
+            self._slots.release()
+
+    def execute(self, http_method, path, params=None, data=None, headers=None):
+        url = self._client._make_url(path, params)
+        if http_method in ('GET', 'DELETE'):
+            data = None
+        headers = self._client._get_headers(headers)
+        headers['Authorization'] = self._auth
+
+        started = time.time()
+        resp, body = self._request(http_method, url, data, headers)
+        with self._lock:
+            self.requests += 1
+            self._latencies.append(time.time() - started)
+
+        if resp.status >= 400:
+            raise self._client._exc_class(
+                urllib2.HTTPError(url, resp.status, resp.reason, resp.msg, StringIO(body)))
+        return urllib.addinfourl(StringIO(body), resp.msg, url, resp.status)
+
+    def stats(self):
+        """
+        :return: Request count, connection reuse and latency percentiles in milliseconds
+        """
+        with self._lock:
+            latencies = [latency * 1000 for latency in self._latencies]
+            stats = dict(requests=self.requests, connections=self.connections, reused=self.reused)
+        for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            value = percentile(latencies, fraction)
+            stats['latency_{}_ms'.format(name)] = round(value, 1) if value is not None else None
+        return stats
+
+
+class TracedApiResource(ApiResource):
+    """
+    `ApiResource` counting every API call against the open trace spans
+    """
+    def invoke(self, method, relpath=None, params=None, data=None, headers=None):
+        TRACER.count('api_calls')
+        return ApiResource.invoke(self, method, relpath, params, data, headers)
+
+
+# Retry counts and sleep time per call site, returned as part of the module output
+RETRY_STATS = {}
+_RETRY_STATS_LOCK = threading.Lock()
+
+
+def record_retry(call_site, retries, slept, gave_up):
+    """
+    Accumulate the retry statistics for a call site
+    """
+    with _RETRY_STATS_LOCK:
+        stats = RETRY_STATS.setdefault(call_site, dict(calls=0, retries=0, sleep=0.0, gave_up=0))
+        stats['calls'] += 1
+        stats['retries'] += retries
+        stats['sleep'] = round(stats['sleep'] + slept, 3)
+        stats['gave_up'] += int(gave_up)
+    TRACER.count('retries', retries)
+
+
+def retry(attempts=3, delay=5, policy=None):
     """Function which reruns/retries other functions.
 
     'attempts' - the number of attempted retries (defaults to 3)
     'delay' - time in seconds between each retry (defaults to 5)
+    'policy' - a `RetryPolicy` instance, which takes precedence over a fixed attempts/delay
     """
+    if policy is None:
+        policy = RetryPolicy(attempts=attempts, delay=delay, backoff=1, jitter=0)
+
     def deco_retry(func):
         """Main decorator function."""
         @wraps(func)
         def retry_loop(*args, **kwargs):
             """Main num_tries loop."""
+            call_site = func.__name__
+            if args and isinstance(getattr(args[0], 'name', None), basestring):
+                call_site = '{}[{}]'.format(call_site, args[0].name)
+
+            started = time.time()
             attempt_counter = 1
-            while attempt_counter <= attempts:
+            slept = 0
+            while True:
                 try:
-                    return func(*args, **kwargs)
+                    result = func(*args, **kwargs)
+                    record_retry(call_site, attempt_counter - 1, slept, False)
+                    return result
                 except ApiException as apie:  # pylint: disable=broad-except,catching-non-exception
-                    if attempt_counter == attempts:
+                    sleep = policy.next_delay(attempt_counter, time.time() - started)
+                    if sleep is None:
+                        record_retry(call_site, attempt_counter - 1, slept, True)
                         # pylint: disable=raising-bad-type
                         raise
-                    time.sleep(delay)
+                    time.sleep(sleep)
+                    slept += sleep
                     attempt_counter += 1
         return retry_loop
     return deco_retry
 
 
-@retry(attempts=3, delay=30)
+class CommandWatcher(object):
+    """
+    Track all the in-flight Cloudera Manager commands from a single polling thread
+
+    Instead of every caller sleeping in its own `cmd.wait()` loop, the poller refreshes the status
+    of all the registered commands once per tick and wakes each waiter up as soon as its command
+    is no longer active.
+    """
+    def __init__(self, interval=COMMAND_POLL_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._thread = None
+
+    def wait(self, cmd, timeout=None):
+        """
+        Block till the command finishes or the timeout expires, similar to `ApiCommand.wait()`
+
+        :param cmd: `ApiCommand` instance
+        :param timeout: Time in seconds to wait for, None to wait indefinitely
+        :return: The last fetched `ApiCommand` instance
+        """
+        # Synchronous commands don't have an id to track and are already finished
+        if cmd.id == -1 or not cmd.active:
+            return cmd
+
+        waiter = {'cmd': cmd, 'done': threading.Event()}
+        with self._lock:
+            self._waiters.setdefault(cmd.id, []).append(waiter)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll, name='cm-command-watcher')
+                self._thread.daemon = True
+                self._thread.start()
+
+        waiter['done'].wait(timeout)
+        with self._lock:
+            waiters = self._waiters.get(cmd.id, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiters[cmd.id]
+        return waiter['cmd']
+
+    def _poll(self):
+        """
+        Refresh all the tracked commands once per tick, till there is nothing left to track
+        """
+        while True:
+            with self._lock:
+                if not self._waiters:
+                    self._thread = None
+                    return
+                tracked = [(cmd_id, waiters[0]['cmd']) for cmd_id, waiters in self._waiters.items()]
+
+            for cmd_id, cmd in tracked:
+                try:
+                    cmd = cmd.fetch()
+                except ApiException:
+                    # Transient API errors are retried on the next tick
+                    continue
+                with self._lock:
+                    waiters = self._waiters.get(cmd_id, [])
+                    for waiter in waiters:
+                        waiter['cmd'] = cmd
+                    if not cmd.active:
+                        for waiter in waiters:
+                            waiter['done'].set()
+                        self._waiters.pop(cmd_id, None)
+
+            time.sleep(self.interval)
+
+
+COMMAND_WATCHER = CommandWatcher()
+
+
+def wait_cmd(cmd, timeout=None):
+    """
+    Wait for a CM command to finish using the shared `CommandWatcher`
+    """
+    return COMMAND_WATCHER.wait(cmd, timeout)
+
+
 def execute_cmd(func, service_name, timeout, fail_msg, *args, **kwargs):
     """
     Wrap retry checks for pre and post start commands that sometimes are not available to
     execute immediately after configuring or starting a service
+
+    The command is retried for `COMMAND_RETRY_DEADLINE` seconds on top of its own `timeout`, so a
+    slow attempt does not use up the retries.
     """
     def check(cmd, name, fail_msg, timeout, retry=True):
-        if not cmd.wait(timeout).success:
+        cmd = wait_cmd(cmd, timeout)
+        if not cmd.success:
             if retry:
                 if (cmd.resultMessage is not None and
                         "is not currently available for execution" in cmd.resultMessage):
                     raise ApiException('Retry command')
             print_json(type=name, msg="{}. {}".format(fail_msg, cmd.resultMessage))
 
-    cmd = func(*args, **kwargs)
-    if isinstance(cmd, ApiBulkCommandList):
-        for cmdi in cmd:
-            check(cmdi, service_name, fail_msg, timeout, retry=False)
-    else:
-        check(cmd, service_name, fail_msg, timeout)
+    @retry(policy=RetryPolicy(delay=2, max_delay=30,
+                              deadline=(timeout or 0) + COMMAND_RETRY_DEADLINE))
+    def run_cmd():
+        cmd = func(*args, **kwargs)
+        if isinstance(cmd, ApiBulkCommandList):
+            for cmdi in cmd:
+                check(cmdi, service_name, fail_msg, timeout, retry=False)
+        else:
+            check(cmd, service_name, fail_msg, timeout)
+
+    run_cmd()
+
+
+def refresh_parcel_repos(manager):
+    """
+    Have CM rescan its local parcel repository and re-read the remote parcel repos right away,
+    instead of on its next periodic refresh
+
+    :param manager: `ApiClouderaManager` instance
+    """
+    print_json(type="PARCELS", msg="Refreshing the parcel repos")
+    # cm_api has no wrapper for the refreshParcelRepos command
+    execute_cmd(manager._cmd, "PARCELS", 120, "Refreshing the parcel repos failed",
+                'refreshParcelRepos', api_version=16)
+
+
+def create_roles_bulk(api, service, roles):
+    """
+    Create roles for a service with one API call per `ROLE_BATCH_SIZE` roles
+
+    :param api: `ApiResource` instance
+    :param service: `ApiService` instance
+    :param roles: List of (role name, role type, host) tuples
+    :return: List of the created `ApiRole` instances
+    """
+    path = '/clusters/{}/services/{}/roles'.format(service.clusterRef.clusterName, service.name)
+    created = []
+    for start in range(0, len(roles), ROLE_BATCH_SIZE):
+        batch = ApiList([ApiRole(api, name, role_type, ApiHostRef(api, host))
+                         for name, role_type, host in roles[start:start + ROLE_BATCH_SIZE]])
+        response = api.post(path, data=json.dumps(batch.to_json_dict()))
+        created.extend(ApiList.from_json_dict(response, api, ApiRole))
+    return created
+
+
+def update_role_configs(updates, workers=DEFAULT_PARALLELISM, apply=None):
+    """
+    Apply per role configs in concurrent batches, since CM has no bulk role config endpoint
+
+    :param updates: List of (`ApiRole` instance, config dict) tuples
+    :param apply: Function taking an `ApiRole` instance and its config dict, defaults to pushing
+                  the config as is
+    """
+    if not updates:
+        return
+    apply = apply or (lambda role, config: role.update_config(config))
+    pool = ThreadPool(max(1, min(workers, len(updates))))
+    try:
+        pool.map(lambda update: apply(*update), updates)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def config_value(value):
+    """
+    Normalize a config value from yaml to the string representation used by the CM API
+    """
+    if value is None or isinstance(value, basestring):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def config_diff(current, desired):
+    """
+    Compute the configs that need to be updated
+
+    :param current: Dict of config name to `ApiConfig` instance, as returned for the full view
+    :param desired: Dict of config name to value from yaml
+    :return: Dict of config name to {'old': ..., 'new': ...} for all the configs that differ
+    """
+    changes = {}
+    for name, value in desired.items():
+        value = config_value(value)
+        config = current.get(name)
+        existing = None
+        if config is not None:
+            existing = config.value if config.value is not None else config.default
+        if config is None or existing != value:
+            changes[name] = dict(old=existing, new=value)
+    return changes
+
+
+class EventStream(object):
+    """
+    Append only stream of progress events as JSON lines, flushed per event, so that a build can
+    be followed live (see `tail`) instead of only seeing the buffered module output at the end.
+
+    The target is either a file path or `unix://<path>` for a Unix datagram socket, which the tail
+    command binds to. Events sent to a socket nobody listens on are dropped.
+    """
+    def __init__(self):
+        self.echo = True
+        self._lock = threading.Lock()
+        self._file = None
+        self._socket = None
+        self._address = None
+
+    def open(self, target, echo=False):
+        """
+        :param target: File path or `unix://<path>`
+        :param echo: Also print the events to stdout
+        """
+        self.echo = echo
+        if target.startswith('unix://'):
+            self._address = target[len('unix://'):]
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+        else:
+            self._file = open(target, 'a')
+
+    def emit(self, event):
+        line = json.dumps(dict(event, time=round(time.time(), 3)))
+        with self._lock:
+            if self.echo:
+                print json.dumps(event)
+            if self._file is not None:
+                self._file.write(line + '\n')
+                self._file.flush()
+            if self._socket is not None:
+                try:
+                    self._socket.sendto(line, self._address)
+                except socket.error:
+                    pass
+
+
+EVENTS = EventStream()
+
+
+def tail(target):
+    """
+    Follow an event stream and print the events as they come in. Runs till interrupted.
+
+    :param target: File path or `unix://<path>`
+    """
+    def show(line):
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return
+        stamp = time.strftime('%H:%M:%S', time.localtime(event.pop('time', time.time())))
+        print '{} [{}] {}'.format(stamp, event.pop('type', '-'), event.pop('msg', '') or json.dumps(event))
+        sys.stdout.flush()
+
+    if target.startswith('unix://'):
+        address = target[len('unix://'):]
+        if os.path.exists(address):
+            os.remove(address)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(address)
+        while True:
+            show(sock.recv(65536))
+
+    while not os.path.exists(target):
+        time.sleep(1)
+    with open(target) as events:
+        while True:
+            line = events.readline()
+            if line.endswith('\n'):
+                show(line)
+            else:
+                # Wait for the rest of a partially written line, or for new events
+                events.seek(-len(line), os.SEEK_CUR)
+                time.sleep(0.5)
 
 
 def print_json(**kwargs):
     """
-    Print json output based on the passed in arguments
+    Print json output based on the passed in arguments, and send it to the event stream
     """
-    print json.dumps(kwargs)
+    EVENTS.emit(kwargs)
 
 
 def fail(module, msg):
@@ -94,6 +820,75 @@ def fail(module, msg):
         sys.exit(1)
 
 
+class ServiceScheduler(object):
+    """
+    Run a step over a list of services on a bounded pool of worker threads
+
+    A service is only scheduled once all the services listed in its `DEPENDS_ON` have finished
+    the same step. Dependencies that are not part of the given list of services are considered
+    to be satisfied already, since they were either handled earlier or are not configured.
+    """
+    def __init__(self, workers=DEFAULT_PARALLELISM):
+        self.workers = max(1, int(workers))
+
+    def run(self, services, step, key=None, depends_on=None):
+        """
+        Run `step(svc)` for all the services and block till all of them are finished. The first
+        error raised by a step is re-raised once the steps already in flight have finished.
+
+        :param services: List of `Service` instances
+        :param step: Function taking a single `Service` instance
+        :param key: Function returning the name of an item, defaults to the class name
+        :param depends_on: Function returning the names an item depends on, defaults to `DEPENDS_ON`
+        """
+        key = key or (lambda svc: svc.__class__.__name__)
+        depends_on = depends_on or (lambda svc: svc.DEPENDS_ON)
+        names = [key(svc) for svc in services]
+        by_name = dict(zip(names, services))
+        pending = dict((name, set(dep for dep in depends_on(by_name[name]) if dep in by_name))
+                       for name in names)
+        finished = Queue.Queue()
+        errors = []
+        running = 0
+
+        def worker(name):
+            try:
+                step(by_name[name])
+                finished.put((name, None))
+            except:  # pylint: disable=bare-except
+                # Also catch SystemExit raised by `fail`, so it can be re-raised in the main thread
+                finished.put((name, sys.exc_info()))
+
+        pool = ThreadPool(self.workers)
+        try:
+            while pending or running:
+                ready = [name for name in names if name in pending and not pending[name]]
+                if not errors:
+                    for name in ready:
+                        del pending[name]
+                        pool.apply_async(worker, (name,))
+                        running += 1
+                if not running:
+                    if errors:
+                        break
+                    raise Exception("Dependency cycle between: {}".format(
+                        ', '.join(sorted(pending))))
+
+                name, exc_info = finished.get()
+                running -= 1
+                if exc_info is not None:
+                    errors.append(exc_info)
+                    continue
+                for deps in pending.values():
+                    deps.discard(name)
+        finally:
+            pool.close()
+            pool.join()
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+
 class Parcels(object):
     """
     Cloudera Parcels manager
@@ -101,6 +896,14 @@ class Parcels(object):
     This class handles all the required operations on Parcels from downloading, distributing
     to activating it.
     """
+    # Ordered stages as (description, `ApiParcel` method starting it, parcel stages reached once
+    # it's finished)
+    STAGES = [
+        ('Downloading', 'start_download', ['DOWNLOADED', 'DISTRIBUTED', 'ACTIVATED', 'INUSE']),
+        ('Distributing', 'start_distribution', ['DISTRIBUTED', 'ACTIVATED', 'INUSE']),
+        ('Activating', 'activate', ['ACTIVATED', 'INUSE']),
+    ]
+
     def __init__(self, module, manager, cluster, version, repo, product='CDH'):
         self.module = module
         self.manager = manager
@@ -108,6 +911,10 @@ class Parcels(object):
         self.version = version
         self.repo = repo
         self.product = product
+        self.step = 0
+        self.started_step = None
+        self.stage_started = None
+        self.last_state = None
         self.validate()
 
     @property
@@ -145,64 +952,441 @@ class Parcels(object):
             value = ','.join([repo_config.value or repo_config.default, self.repo])
 
             self.manager.update_config({REMOTE_PARCEL_REPO_URLS: value})
+            refresh_parcel_repos(self.manager)
             self.check_error(wait_parcel())
 
-    @retry(attempts=20, delay=30)
-    def check_state(self, states):
+    @property
+    def done(self):
+        return self.step == len(self.STAGES)
+
+    def advance(self):
         """
-        Check parcel progress state
+        Start the next stage of the parcel as soon as the current one is finished, without
+        waiting on it. Stages that were already completed previously are skipped.
 
-        :param states: List of possible states to test for
+        :return: True if the parcel moved on to another stage
         """
         parcel = self.parcel
         self.check_error(parcel)
-        if parcel.stage in states:
-            return
-        else:
+        self.last_state = parcel
+
+        step = self.step
+        while self.step < len(self.STAGES) and parcel.stage in self.STAGES[self.step][2]:
+            self.step += 1
+        if self.started_step is not None and self.started_step < self.step:
+            TRACER.add(dict(name='{} {}-{}'.format(self.STAGES[self.started_step][0], self.product,
+                                                   self.version),
+                            cat='parcels', start=self.stage_started))
+        if not self.done and self.started_step != self.step:
+            description, action, _ = self.STAGES[self.step]
             print_json(type=self.__class__.__name__.upper(),
-                       msg="{} progress: {} / {}".format(states[0], parcel.state.progress,
-                                                         parcel.state.totalProgress))
-            raise ApiException("Waiting on parcel to get to state {}".format(states[0]))
+                       msg="{}: {}-{}".format(description, self.product, self.version))
+            getattr(parcel, action)()
+            self.started_step = self.step
+            self.stage_started = time.time()
+        return self.step != step
+
+
+class ParcelPipeline(object):
+    """
+    Download, distribute and activate a set of parcels with the stages overlapping
+
+    All the downloads are started up front and each parcel is moved on to its next stage as soon
+    as it is ready, instead of handling one parcel at a time. `policy` paces the polls until all
+    the parcels are activated, `poll_policy` retries a single poll failing with a transient API
+    error.
+    """
+    def __init__(self, module, parcels, policy=None, poll_policy=None):
+        self.module = module
+        self.parcels = parcels
+        self.policy = policy or RetryPolicy(delay=2, max_delay=30, deadline=3600)
+        self.poll_policy = poll_policy or RetryPolicy(attempts=5, delay=2, max_delay=30)
+
+    def progress(self):
+        """
+        :return: Combined progress of the parcels currently being downloaded or distributed
+        """
+        progress = total = 0
+        for parcel in self.parcels:
+            if not parcel.done and parcel.last_state is not None:
+                progress += parcel.last_state.state.progress or 0
+                total += parcel.last_state.state.totalProgress or 0
+        return progress, total
+
+    def run(self):
+        started = time.time()
+        tick = 1
+        while True:
+            advanced = False
+            for parcel in self.parcels:
+                if not parcel.done:
+                    advanced = retry(policy=self.poll_policy)(parcel.advance)() or advanced
+            pending = [parcel for parcel in self.parcels if not parcel.done]
+            if not pending:
+                return
+
+            progress, total = self.progress()
+            print_json(type="PARCELS",
+                       msg="progress: {} / {} ({})".format(
+                           progress, total,
+                           ', '.join('{}: {}'.format(parcel.product, parcel.last_state.stage)
+                                     for parcel in pending)))
+
+            # Poll quickly again right after a stage change, back off while the stages are running
+            tick = 1 if advanced else tick + 1
+            sleep = self.policy.next_delay(tick, time.time() - started)
+            if sleep is None:
+                fail(self.module, "Timed out waiting on parcels: {}".format(
+                    ', '.join('{}-{}'.format(parcel.product, parcel.version) for parcel in pending)))
+            time.sleep(sleep)
+
+
+class ParcelCache(object):
+    """
+    Content addressed local cache of parcel files
+
+    Parcels are stored as `<root>/<product>-<version>/<sha1>/<parcel file>`. Cached parcels are
+    seeded into the CM local parcel repository so that CM doesn't need to download them again.
+
+    Note: The cache is not served as a parcel repo. A server living in the module process would
+    die with it, leaving a dead URL in the parcel repos of CM.
+    """
+    def __init__(self, root, repo_dir=CM_PARCEL_REPO_DIR):
+        self.root = root
+        self.repo_dir = repo_dir
+
+    @staticmethod
+    def sha1(path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as parcel_file:
+            for chunk in iter(lambda: parcel_file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def entries(self, product='*', version='*'):
+        """
+        :return: List of (parcel file name, sha1, path) for the matching cached parcels
+        """
+        entries = []
+        pattern = os.path.join(self.root, '{}-{}'.format(product, version), '*', '*.parcel')
+        for path in sorted(glob.glob(pattern)):
+            entries.append((os.path.basename(path), os.path.basename(os.path.dirname(path)), path))
+        return entries
+
+    def seed(self, product, version):
+        """
+        Copy the cached parcels into the CM local parcel repository, unless a parcel with the same
+        hash is already there
 
-    def download(self):
+        :return: True if the cache contains the parcel
         """
-        Download the specified parcel to the Cloudera Manager server
+        entries = self.entries(product, version)
+        for name, sha, path in entries:
+            target = os.path.join(self.repo_dir, name)
+            sha_file = target + '.sha'
+            if os.path.exists(target) and os.path.exists(sha_file):
+                with open(sha_file) as existing:
+                    if existing.read().strip() == sha:
+                        continue
+            print_json(type="PARCELS", msg="Seeding {} from the parcel cache".format(name))
+            shutil.copyfile(path, target + '.part')
+            os.rename(target + '.part', target)
+            with open(sha_file, 'w') as sha_out:
+                sha_out.write(sha)
+        return bool(entries)
+
+    def collect(self, product, version):
         """
-        print_json(type=self.__class__.__name__.upper(),
-                   msg="Downloading: {}-{}".format(self.product, self.version))
-        self.parcel.start_download()
-        self.check_state(['DOWNLOADED', 'DISTRIBUTED', 'ACTIVATED', 'INUSE'])
+        Add parcels downloaded by CM for a product and version to the cache
+        """
+        pattern = os.path.join(self.repo_dir, '{}-{}-*.parcel'.format(product, version))
+        for path in glob.glob(pattern):
+            sha_file = path + '.sha'
+            if os.path.exists(sha_file):
+                with open(sha_file) as sha_in:
+                    sha = sha_in.read().strip()
+            else:
+                sha = self.sha1(path)
+            target_dir = os.path.join(self.root, '{}-{}'.format(product, version), sha)
+            target = os.path.join(target_dir, os.path.basename(path))
+            if os.path.exists(target):
+                continue
+            if not os.path.isdir(target_dir):
+                os.makedirs(target_dir)
+            shutil.copyfile(path, target + '.part')
+            os.rename(target + '.part', target)
+
+
+class Journal(object):
+    """
+    Append only checkpoint journal of the completed setup steps, stored as JSON lines
+
+    Every step is recorded with a digest of the config it used. The digest of a step also covers
+    the digests of the steps it depends on, so a changed config invalidates all the steps after it.
+    Without a path the journal is only kept in memory and nothing is skipped.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.completed = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A partially written last line from an interrupted run
+                        continue
+                    self.completed[entry['step']] = entry['hash']
+
+    @staticmethod
+    def digest(*configs):
+        return hashlib.sha1(json.dumps(configs, sort_keys=True, default=str)).hexdigest()
+
+    def done(self, step, digest):
+        return self.completed.get(step) == digest
+
+    def record(self, step, digest):
+        with self._lock:
+            self.completed[step] = digest
+            if self.path:
+                with open(self.path, 'a') as journal:
+                    journal.write(json.dumps(dict(step=step, hash=digest, time=time.time())) + '\n')
+                    journal.flush()
+                    os.fsync(journal.fileno())
+
+    def reset(self):
+        with self._lock:
+            self.completed = {}
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class ClusterState(object):
+    """
+    Snapshot of the state of all the services and their roles within a cluster
+
+    The service states are refreshed in a single pass once the snapshot is older than `ttl` seconds
+    or has been invalidated, which should be done after every mutating command. The roles of a
+    started service are only listed the first time it is read after a refresh, so a refresh costs
+    one round trip instead of one per started service.
+    """
+    def __init__(self, cluster, ttl=STATE_TTL):
+        self.cluster = cluster
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._fetched = None
+        self._services = {}
+        self._roles = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._fetched = None
+
+    def refresh(self):
+        """
+        Fetch the state of all the services, their roles are fetched on read
+        """
+        self._services = dict((service.name, service)
+                              for service in self.cluster.get_all_services())
+        self._roles = {}
+        self._fetched = time.time()
+
+    def get(self, name):
+        """
+        :param name: Service name
+        :return: Tuple of service state and list of (role type, role state), None if the service
+                 doesn't exist. The roles are only listed for a started service.
+        """
+        with self._lock:
+            if self._fetched is None or time.time() - self._fetched > self.ttl:
+                self.refresh()
+            service = self._services.get(name)
+            if service is None:
+                return None
+            if name not in self._roles:
+                self._roles[name] = []
+                if service.serviceState == 'STARTED':
+                    self._roles[name] = [(role.type, role.roleState)
+                                         for role in service.get_all_roles()]
+            return service.serviceState, self._roles[name]
+
+    def started(self, name):
+        """
+        :param name: Service name
+        :return: True if the service and all its non gateway roles are started
+        """
+        state = self.get(name)
+        if state is None:
+            return False
+        service_state, roles = state
+        if service_state != 'STARTED':
+            return False
+        return all(role_type == 'GATEWAY' or role_state == 'STARTED'
+                   for role_type, role_state in roles)
+
+
+class HostReadiness(object):
+    """
+    Per host readiness, based on the agent heartbeat, the `HOST_READY_CHECKS` health checks and
+    the stage of the parcels on the cluster of the host.
+
+    All the hosts are fetched with a single call, along with the parcels once per cluster, and the
+    result is shared for `ttl` seconds, so each service can wait on just the hosts its roles are
+    placed on instead of on the slowest host of the cluster.
 
-    def distribute(self):
+    Note: The CM API has no per host parcel state. A parcel is only distributed or activated once
+    it is unpacked on every host of its cluster, hosts added later included, so the stage of the
+    cluster parcel is used for each of its hosts.
+    """
+    def __init__(self, module, api, parcels=None, ttl=5):
+        """
+        :param parcels: List of parcel configs with `product` and `version`, as in the cluster.yaml
+        """
+        self.module = module
+        self.api = api
+        self.parcels = parcels or []
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._fetched = None
+        self._findings = {}
+        self._warnings = {}
+
+    @staticmethod
+    def host_findings(host, now):
+        """
+        :param host: `ApiHost` instance in the full view
+        :param now: Current UTC time
+        :return: Tuple of the list of reasons why the host is not ready, empty if it is ready, and
+                 the list of the other BAD health checks
+        """
+        findings = []
+        warnings = []
+        heartbeat = getattr(host, 'lastHeartbeat', None)
+        if heartbeat is None:
+            findings.append('no agent heartbeat')
+        else:
+            if not isinstance(heartbeat, datetime):
+                heartbeat = datetime.strptime(str(heartbeat)[:19], '%Y-%m-%dT%H:%M:%S')
+            age = (now - heartbeat).total_seconds()
+            if age > HEARTBEAT_TIMEOUT:
+                findings.append('last agent heartbeat {}s ago'.format(int(age)))
+        for check in getattr(host, 'healthChecks', None) or []:
+            if check.get('summary') == 'BAD':
+                (findings if check.get('name') in HOST_READY_CHECKS else warnings).append(
+                    '{}: BAD'.format(check.get('name')))
+        return findings, warnings
+
+    def parcel_findings(self, cluster_name):
+        """
+        :param cluster_name: Name of the cluster of a host
+        :return: List of the parcels not yet unpacked on the hosts of the cluster
+        """
+        cluster = self.api.get_cluster(cluster_name)
+        findings = []
+        for parcel_cfg in self.parcels:
+            product, version = parcel_cfg.get('product', 'CDH'), parcel_cfg.get('version')
+            try:
+                parcel = cluster.get_parcel(product, version)
+            except ApiException:
+                findings.append('parcel {}-{} not found'.format(product, version))
+                continue
+            if (parcel.stage not in PARCEL_READY_STAGES or
+                    (parcel.state.progress or 0) < (parcel.state.totalProgress or 0)):
+                findings.append('parcel {}-{} {}'.format(product, version, parcel.stage))
+        return findings
+
+    def refresh(self):
+        now = datetime.utcnow()
+        findings, warnings, parcels = {}, {}, {}
+        for host in self.api.get_all_hosts(view='full'):
+            findings[host.hostname], warnings[host.hostname] = self.host_findings(host, now)
+            # Hosts outside of a cluster, like the CM host, don't get the parcels
+            cluster_ref = getattr(host, 'clusterRef', None)
+            if self.parcels and cluster_ref is not None:
+                if cluster_ref.clusterName not in parcels:
+                    parcels[cluster_ref.clusterName] = self.parcel_findings(cluster_ref.clusterName)
+                findings[host.hostname] += parcels[cluster_ref.clusterName]
+        self._findings, self._warnings = findings, warnings
+        self._fetched = time.time()
+
+    def findings(self, hosts):
+        """
+        :param hosts: List of host names
+        :return: Dict of host name to findings, for the hosts that are not ready
+        """
+        with self._lock:
+            if self._fetched is None or time.time() - self._fetched > self.ttl:
+                self.refresh()
+            findings = self._findings
+        not_ready = {}
+        for host in hosts:
+            if host not in findings:
+                not_ready[host] = ['not registered with Cloudera Manager']
+            elif findings[host]:
+                not_ready[host] = findings[host]
+        return not_ready
+
+    def warnings(self, hosts):
         """
-        Distribute the parcel to all the nodes
+        :param hosts: List of host names
+        :return: Dict of host name to the BAD health checks not keeping it from being ready, for
+                 the hosts with any, as of the last `findings`
         """
-        print_json(type=self.__class__.__name__.upper(),
-                   msg="Distributing: {}-{}".format(self.product, self.version))
-        self.parcel.start_distribution()
-        self.check_state(['DISTRIBUTED', 'ACTIVATED', 'INUSE'])
+        with self._lock:
+            warnings = self._warnings
+        return dict((host, warnings[host]) for host in hosts if warnings.get(host))
 
-    def activate(self):
+    def wait(self, hosts, name, timeout=HOST_READY_TIMEOUT):
         """
-        Activate the parcel for use in the cluster installation step
+        Wait till all the given hosts are ready, failing with the stragglers and their findings
+        once the timeout expires
+
+        :param hosts: List of host names
+        :param name: Name of what is waiting, used for reporting
         """
-        print_json(type=self.__class__.__name__.upper(),
-                   msg="Activating: {}-{}".format(self.product, self.version))
-        self.parcel.activate()
-        self.check_state(['ACTIVATED', 'INUSE'])
+        policy = RetryPolicy(delay=self.ttl, max_delay=30, deadline=timeout)
+        started = time.time()
+        attempt = 1
+        while True:
+            not_ready = self.findings(hosts)
+            if attempt == 1:
+                for host, warnings in sorted(self.warnings(hosts).items()):
+                    print_json(type=name, msg="{} health: {}".format(host, ', '.join(warnings)))
+            if not not_ready:
+                return
+            sleep = policy.next_delay(attempt, time.time() - started)
+            if sleep is None:
+                fail(self.module, "[{}] Hosts not ready: {}".format(name, '; '.join(
+                    '{} ({})'.format(host, ', '.join(findings))
+                    for host, findings in sorted(not_ready.items()))))
+            print_json(type=name, msg="Waiting on hosts: {}".format(', '.join(sorted(not_ready))))
+            time.sleep(sleep)
+            attempt += 1
 
 
 class Service(object):
     """
     Superclass to handle common repeatable functionality for each service
 
-    Note: All subclass names should match an existing service name within CDH
+    Note: All class names should match an existing service name within CDH. The classes are
+    built by `ServiceRegistry` from `SERVICE_REGISTRY`, subclasses are only needed for services
+    with steps that can't be described declaratively.
+
+    `DEPENDS_ON` lists the names of the services that have to be deployed and started before this
+    service. Services without a dependency on each other are handled concurrently.
+    `SPEC` is the registry entry of the service, holding its pre and post start commands.
     """
+    DEPENDS_ON = ()
+    SPEC = {}
 
-    def __init__(self, cluster, config, type=None):
+    def __init__(self, api, cluster, config, type=None, state=None):
+        self.api = api
         self.cluster = cluster
         self.config = config
-        self.type = type or self.name
+        self.type = type or self.SPEC.get('type') or self.name
+        self.state = state or ClusterState(cluster)
+        self.changes = {}
         self._service = None
 
     @property
@@ -231,22 +1415,43 @@ class Service(object):
     @property
     def started(self):
         """
-        Check if a service is already started and running.
+        Check if a service is already started and running, based on the cluster state snapshot.
         :return: service state Boolean
         """
-        if self.service.serviceState == 'STARTED':
-            for role in self.service.get_all_roles():
-                if role.type != 'GATEWAY' and role.roleState != 'STARTED':
-                    return False
-            return True
-        return False
+        return self.state.started(self.name)
 
     def run_cmd(self, func, timeout, fail_msg, *args, **kwargs):
         """
         Wrap retry checks for pre and post start commands that sometimes are not available to
         execute immediately after configuring or starting a service
         """
-        execute_cmd(func, self.name, timeout, fail_msg, *args, **kwargs)
+        try:
+            execute_cmd(func, self.name, timeout, fail_msg, *args, **kwargs)
+        finally:
+            self.state.invalidate()
+
+    @property
+    def hosts(self):
+        """
+        :return: Sorted list of all the hosts the roles of the service are placed on
+        """
+        return sorted(set(host for role in self.config.get('roles', [])
+                          for host in role.get('hosts', [])))
+
+    def update_config(self, entity, current, desired, key):
+        """
+        Only push the configs that differ from the current ones and keep track of the changes
+
+        :param entity: `ApiService` or `ApiRoleConfigGroup` instance
+        :param current: Current configs of the entity in the full view
+        :param desired: Configs from yaml
+        :param key: Name under which the changes are reported
+        """
+        changes = config_diff(current, desired)
+        if changes:
+            print_json(type=self.name, msg="Updating {} configs: {}".format(key, ', '.join(sorted(changes))))
+            entity.update_config(dict((name, desired[name]) for name in changes))
+            self.changes[key] = changes
 
     def deploy(self):
         """
@@ -255,7 +1460,8 @@ class Service(object):
         print_json(type=self.name, msg="Deploying service")
 
         # Service creation and config updates
-        self.service.update_config(self.config.get('config', {}))
+        self.update_config(self.service, self.service.get_config(view='full')[0],
+                           self.config.get('config', {}), 'service')
 
         # Retrieve base role config groups, update configs for those and create individual roles
         # per host
@@ -266,36 +1472,51 @@ class Service(object):
                 raise Exception("[{}] group and hosts should be specified per role".format(self.name))
             group = role['group']
             role_group = self.service.get_role_config_group('{}-{}-BASE'.format(self.name, group))
-            role_group.update_config(role.get('config', {}))
+            self.update_config(role_group, role_group.get_config(view='full'),
+                               role.get('config', {}), group)
             self.create_roles(role, group)
 
-    def create_roles(self, role, group):
+    def role_names(self, role, group):
         """
-        Create individual roles for all the hosts under a specific role group
-
         :param role: Role configuration from yaml
         :param group: Role group name
+        :return: List of (role name, host) for all the hosts under the role group
         """
-        role_id = 0
-        for host in role.get('hosts', []):
-            role_id += 1
-            role_name = '{}-{}-{}'.format(self.name, group, role_id)
-            try:
-                self.service.get_role(role_name)
-            except ApiException:
-                self.service.create_role(role_name, group, host)
+        return [('{}-{}-{}'.format(self.name, group, role_id), host)
+                for role_id, host in enumerate(role.get('hosts', []), 1)]
+
+    def create_roles(self, role, group, hosts=None):
+        """
+        Create individual roles for all the hosts under a specific role group. The existing roles
+        are listed once and only the missing ones are created, in bulk.
 
-    @retry(attempts=3, delay=60)
+        :param role: Role configuration from yaml
+        :param group: Role group name
+        :param hosts: Only handle the roles on these hosts, defaults to all the hosts of the group
+        :return: Dict of role name to `ApiRole` instance for all the handled roles in the group
+        """
+        role_names = [(role_name, host) for role_name, host in self.role_names(role, group)
+                      if hosts is None or host in hosts]
+        roles = dict((existing.name, existing) for existing in self.service.get_all_roles())
+        missing = [(role_name, group, host) for role_name, host in role_names
+                   if role_name not in roles]
+        if missing:
+            print_json(type=self.name, msg="Creating {} {} roles".format(len(missing), group))
+            for created in create_roles_bulk(self.api, self.service, missing):
+                roles[created.name] = created
+        return dict((role_name, roles[role_name]) for role_name, _ in role_names)
+
+    @retry(policy=RetryPolicy(delay=5, max_delay=60, deadline=600))
     def start(self):
         """
         Start the service and wait for the command to finish, followed by a check that the
         service is running and healthy
         """
         print_json(type=self.name, msg="Starting service")
-        self._service = None
         if not self.started:
-            cmd = self.service.start()
-            if not cmd.wait(300).success:
+            cmd = wait_cmd(self.service.start(), 300)
+            self.state.invalidate()
+            if not cmd.success:
                 print_json(type=self.name,
                            msg="Command Service start failed. {}".format(cmd.resultMessage))
                 if (cmd.resultMessage is not None and
@@ -303,21 +1524,49 @@ class Service(object):
                     raise ApiException('Retry command')
                 raise Exception("Service {} failed to start".format(self.name))
 
-        self._service = None
         assert self.started
 
+    def run_commands(self, phase):
+        """
+        Run the commands of a phase from the registry entry of the service. A command waits for
+        the commands listed in its `after` to finish, the other commands are run concurrently.
+
+        :param phase: 'pre_start' or 'post_start'
+        """
+        commands = self.SPEC.get(phase, [])
+        if not commands:
+            return
+
+        def run(command):
+            print_json(type=self.name, msg="Running {}".format(command['name']))
+            if 'method' in command:
+                func = getattr(self.service, command['method'])
+                args = command.get('args', [])
+                kwargs = {}
+            else:
+                func = self.service._cmd
+                args = [command['command']]
+                kwargs = {'api_version': command.get('api_version', 1)}
+            with TRACER.span('{} {}'.format(self.name, command['name']), 'commands'):
+                self.run_cmd(func, command.get('timeout', 300),
+                             "Command {} failed".format(command['name']), *args, **kwargs)
+
+        ServiceScheduler(len(commands)).run(commands, run, key=lambda command: command['name'],
+                                            depends_on=lambda command: command.get('after', ()))
+
     def pre_start(self):
         """
         Any service specific actions that needs to be performed before the cluster is started.
-        Each service subclass can implement and hook into the pre-start process.
+        Runs the `pre_start` commands of the registry, subclasses can hook into the pre-start
+        process.
         """
-        pass
+        self.run_commands('pre_start')
 
     def post_start(self):
         """
         Post cluster start actions required to be performed on a per service basis.
         """
-        pass
+        self.run_commands('post_start')
 
 
 class Zookeeper(Service):
@@ -325,30 +1574,24 @@ class Zookeeper(Service):
     Service Role Groups:
         SERVER
     """
-    def create_roles(self, role, group):
+    def create_roles(self, role, group, hosts=None):
         """
         This is overriden since there are some Zookeeper configs that has to be specific to
         a single host/role
 
         :param role: Role configuration from yaml
         :param group: Role group name
+        :param hosts: Only handle the roles on these hosts, defaults to all the hosts of the group
         """
-        role_id = 0
-        for host in role['hosts']:
-            role_id += 1
-            role_name = '{}-{}-{}'.format(self.name, group, role_id)
-            try:
-                role = self.service.get_role(role_name)
-            except ApiException:
-                role = self.service.create_role(role_name, group, host)
-            role.update_config({'serverId': role_id})
-
-    def pre_start(self):
-        """
-        Initialize Zookeeper for the first runs. This commands fails silently if it's rerun
-        """
-        print_json(type=self.name, msg="Initializing")
-        self.run_cmd(self.service.init_zookeeper, 60, "Command InitZookeeper failed")
+        roles = super(Zookeeper, self).create_roles(role, group, hosts)
+        # Only the serverIds that differ are pushed, so a re-run doesn't touch the servers
+        update_role_configs([(roles[role_name], {'serverId': role_id})
+                             for role_id, (role_name, _) in
+                             enumerate(self.role_names(role, group), 1)
+                             if role_name in roles],
+                            apply=lambda server, config: self.update_config(
+                                server, server.get_config(view='full'), config, server.name))
+        return roles
 
 
 class Hdfs(Service):
@@ -435,158 +1678,327 @@ class Hdfs(Service):
         self.run_cmd(self.service.start_roles, 300, "Command Service start failed",
                      self.failover_secondary)
 
-    def post_start(self):
-        self.run_cmd(self.service.create_hdfs_tmp, 60, "Command CreateHdfsTmp failed")
-
-
-class Yarn(Service):
-    """
-    Service Role Groups:
-        RESOURCEMANAGER
-        JOBHISTORY
-        NODEMANAGER
-        GATEWAY
-    """
-    def pre_start(self):
-        self.run_cmd(self.service.create_yarn_job_history_dir, 60, "Command Create Job History Dir failed")
-
-        self.run_cmd(self.service.create_yarn_node_manager_remote_app_log_dir, 60,
-                     "Command Create NodeManager app dir failed")
-
 
-class Spark_On_Yarn(Service):
+class ServiceRegistry(object):
     """
-    This is the Spark on Yarn service
-
-    Service Role Groups:
-        HISTORYSERVER
-        GATEWAY
+    Build the `Service` classes from `SERVICE_REGISTRY`, extended or overridden by the
+    `service_registry` section of the cluster.yaml, so that adding a service with its pre and post
+    start commands doesn't require any code changes.
     """
-    def pre_start(self):
-        self.run_cmd(self.service._cmd, 60, "Command CreateSparkUserDir failed",
-                     'CreateSparkUserDirCommand', api_version=7)
-
-        self.run_cmd(self.service._cmd, 60, "Command CreateSparkHistoryDirCommand failed",
-                     'CreateSparkHistoryDirCommand', api_version=7)
+    # Services with steps that can't be described declaratively
+    CLASSES = {'Zookeeper': Zookeeper, 'Hdfs': Hdfs}
+
+    def __init__(self, overrides=None):
+        self.specs = dict(SERVICE_REGISTRY)
+        for name, spec in (overrides or {}).items():
+            merged = dict(self.specs.get(name, {}))
+            merged.update(spec)
+            self.specs[name] = merged
+        # Services only known from the cluster.yaml are configured after the built-in ones
+        self.additional = ADDITIONAL_SERVICES + sorted(name for name in self.specs
+                                                       if name not in SERVICE_REGISTRY)
+        self._classes = {}
+
+    def get(self, name):
+        """
+        :param name: Service name, as used in BASE_SERVICES and ADDITIONAL_SERVICES
+        :return: `Service` class for the service
+        """
+        if name not in self._classes:
+            if name not in self.specs:
+                raise Exception("Unknown service {}".format(name))
+            spec = self.specs[name]
+            base = self.CLASSES.get(name, Service)
+            self._classes[name] = type(str(name), (base,), {
+                '__doc__': base.__doc__,
+                'DEPENDS_ON': tuple(spec.get('depends_on', ())),
+                'SPEC': spec,
+            })
+        return self._classes[name]
+
+    def depends_on(self, name):
+        """
+        :return: Names of the services the service depends on
+        """
+        return self.get(name).DEPENDS_ON
 
 
-class Hbase(Service):
-    """
-    Service Role Groups:
-        MASTER
-        REGIONSERVER
-        HBASETHRIFTSERVER
-        GATEWAY
+class RollingRestart(object):
     """
-    def pre_start(self):
-        self.run_cmd(self.service.create_hbase_root, 60, "Command CreateHbaseRoot failed")
-
+    Restart the roles of a set of services a batch at a time, waiting for the restarted roles to
+    be healthy before moving on to the next batch.
 
-class Hive(Service):
-    """
-    Service Role Groups:
-        HIVEMETASTORE
-        HIVESERVER2
-        WEBHCAT
-        GATEWAY
+    Services are restarted one after the other in dependency order. Within a service the role
+    types with the fewest instances (masters) are restarted first, one role at a time.
     """
-    def pre_start(self):
-        self.run_cmd(self.service.create_hive_warehouse, 60, "Command CreateHiveWarehouse failed")
-
-    def post_start(self):
-        pass
-        # TODO(rnirmal): These commands keep failing, need to figure out why. Nothing useful in the
-        # manager logs
-        # self.run_cmd(self.service.create_hive_metastore_database, 60,
-        #              "Command CreateHiveMetastoreDatabase failed")
-        #
-        # self.run_cmd(self.service.create_hive_metastore_tables, 60,
-        #              "Command CreateHiveMetastoreTables failed")
-
+    def __init__(self, module, cluster, services, batch_size=RESTART_BATCH_SIZE, health_timeout=600,
+                 registry=None, health_interval=2):
+        self.module = module
+        self.cluster = cluster
+        self.services = services
+        self.registry = registry or ServiceRegistry()
+        self.batch_size = max(1, batch_size)
+        self.health_timeout = health_timeout
+        self.health_interval = health_interval
+        self._replication = None
+
+    def order(self):
+        """
+        :return: Service names sorted so that services are restarted after their dependencies
+        :raises Exception: If the dependencies of the services form a cycle
+        """
+        known = dict((name.upper(), name) for name in self.registry.specs)
+        ordered = []
+        visiting = []
 
-class Impala(Service):
-    """
-    Service Role Groups:
-        STATESTORE
-        CATALOGSERVER
-        IMPALAD
-    """
-    def pre_start(self):
-        self.run_cmd(self.service.create_impala_user_dir, 60, "Command CreateImpalaUserDir failed")
+        def visit(name):
+            if name in ordered or name not in self.services:
+                return
+            if name in visiting:
+                raise Exception("Dependency cycle between: {}".format(
+                    ' -> '.join(visiting[visiting.index(name):] + [name])))
+            visiting.append(name)
+            if name in known:
+                for dep in self.registry.depends_on(known[name]):
+                    visit(dep.upper())
+            visiting.pop()
+            ordered.append(name)
+
+        for name in self.services:
+            visit(name)
+        return ordered
 
+    @property
+    def replication(self):
+        """
+        :return: HDFS replication factor
+        """
+        if self._replication is None:
+            self._replication = 3
+            try:
+                config = self.cluster.get_service('HDFS').get_config(view='full')[0].get('dfs_replication')
+                if config is not None:
+                    self._replication = int(config.value or config.default)
+            except ApiException:
+                pass
+        return self._replication
 
-class Flume(Service):
-    """
-    Service Role Groups:
-        AGENT
-    """
+    def batch_limit(self, role_type, count):
+        """
+        :param role_type: Role type
+        :param count: Number of roles of that type within the service
+        :return: Maximum number of roles of the type restarted at a time
+        """
+        if role_type in QUORUM_ROLE_TYPES or count < MIN_WORKER_ROLES:
+            return 1
+        if role_type in REPLICATED_ROLE_TYPES:
+            return max(1, min(self.batch_size, self.replication - 1))
+        return self.batch_size
 
+    def batches(self, service):
+        """
+        :param service: `ApiService` instance
+        :return: List of batches of role names
+        """
+        by_type = {}
+        for role in service.get_all_roles():
+            if role.type != 'GATEWAY':
+                by_type.setdefault(role.type, []).append(role.name)
+
+        batches = []
+        for role_type, names in sorted(by_type.items(), key=lambda item: (len(item[1]), item[0])):
+            names = sorted(names)
+            limit = self.batch_limit(role_type, len(names))
+            batches.extend(names[start:start + limit] for start in range(0, len(names), limit))
+        return batches
+
+    def wait_healthy(self, service, names):
+        """
+        Wait till all the given roles are started and in good health
 
-class Oozie(Service):
-    """
-    Service Role Groups:
-        OOZIE_SERVER
+        :param service: `ApiService` instance
+        :param names: List of role names
+        """
+        policy = RetryPolicy(delay=self.health_interval, max_delay=15, deadline=self.health_timeout)
+        started = time.time()
+        attempt = 1
+        while True:
+            unhealthy = [role.name for role in service.get_all_roles()
+                         if role.name in names and
+                         (role.roleState != 'STARTED' or role.healthSummary not in ('GOOD', 'DISABLED'))]
+            if not unhealthy:
+                return
+            sleep = policy.next_delay(attempt, time.time() - started)
+            if sleep is None:
+                fail(self.module, "[{}] Roles not healthy after restart: {}".format(
+                    service.name, ', '.join(unhealthy)))
+            time.sleep(sleep)
+            attempt += 1
+
+    def run(self):
+        """
+        :return: Dict of service name to list of restarted batches
+        """
+        restarted = {}
+        for name in self.order():
+            service = self.cluster.get_service(name)
+            batches = self.batches(service)
+            print_json(type=name, msg="Rolling restart of {} roles in {} batches".format(
+                sum(len(batch) for batch in batches), len(batches)))
+            for batch in batches:
+                print_json(type=name, msg="Restarting {}".format(', '.join(batch)))
+                execute_cmd(service.restart_roles, name, 300, "Command Restart roles failed", *batch)
+                self.wait_healthy(service, batch)
+            restarted[name] = batches
+        return restarted
+
+
+class PlacementPlanner(object):
     """
-    def pre_start(self):
-        self.run_cmd(self.service.create_oozie_db, 300, "Command CreateOozieSchema failed")
-
-        self.run_cmd(self.service.install_oozie_sharelib, 300,
-                     "Command InstallOozieSharedLib failed")
-
+    Place the roles of the requested services on hosts based on their gathered facts
 
-class Sqoop(Service):
+    Master roles are bin-packed largest heap first onto the master host that ends up the least
+    loaded (the highest of its memory and core usage ratios), while instances of the same role
+    are kept on different hosts. Worker roles are placed on all the worker hosts, and on the
+    masters as well when there are fewer than `MIN_WORKER_HOSTS` workers. The planner doesn't
+    talk to CM, so it can be run offline against a host facts file, see `load_host_facts`.
     """
-    Service Role Groups:
-        SQOOP_SERVER
-    """
-    def pre_start(self):
-        self.run_cmd(self.service.create_sqoop_user_dir, 300,
-                     "Command CreateSqoopUserDir failed")
-        self.run_cmd(self.service.create_sqoop_database_tables, 300,
-                     "Command CreateSqoopDBTables failed")
+    def __init__(self, hosts, catalog=None):
+        """
+        :param hosts: List of host facts dicts with `hostname`, `cores`, `memory_mb`, `disks` and
+                      optionally `type` ('master' or 'worker'). Ansible fact names
+                      (`ansible_processor_vcpus`, `ansible_memtotal_mb`) are accepted as well.
+        """
+        self.catalog = catalog or ROLE_CATALOG
+        self.hosts = [self.normalize(host) for host in hosts]
+        if not self.hosts:
+            raise Exception("At least one host is required for the placement")
+        if not any(host['type'] == 'master' for host in self.hosts):
+            # Use the hosts with the fewest disks as masters, 3 of them for a quorum if possible
+            count = 3 if len(self.hosts) >= 3 else 1
+            for host in sorted(self.hosts, key=lambda host: (host['disks'], host['hostname']))[:count]:
+                host['type'] = 'master'
+        self.load = dict((host['hostname'], dict(heap=0, cores=0.0, roles=[])) for host in self.hosts)
+
+    @staticmethod
+    def normalize(host):
+        disks = host.get('disks', 1)
+        if isinstance(disks, (list, tuple)):
+            disks = len(disks)
+        return dict(hostname=host['hostname'],
+                    cores=int(host.get('cores', host.get('ansible_processor_vcpus', 1))),
+                    memory_mb=int(host.get('memory_mb', host.get('ansible_memtotal_mb', 1024))),
+                    disks=int(disks),
+                    type=host.get('type'))
+
+    def usage(self, host, heap=0, cores=0):
+        """
+        :return: Highest of the memory and core usage ratios of the host after adding a role
+        """
+        load = self.load[host['hostname']]
+        usable = 1 - HOST_RESERVED_SHARE
+        return max((load['heap'] + heap) / (host['memory_mb'] * usable),
+                   (load['cores'] + cores) / (host['cores'] * usable))
+
+    def assign(self, hostname, service, spec):
+        load = self.load[hostname]
+        load['heap'] += spec['heap']
+        load['cores'] += spec['cores']
+        load['roles'].append('{}-{}'.format(service, spec['group']))
+
+    def place_master(self, service, spec):
+        masters = [host for host in self.hosts if host['type'] == 'master']
+        count = min(spec['count'], len(masters))
+        if spec['count'] > 1 and count < spec['count']:
+            print_json(type="PLAN", msg="Only {} master hosts for {} instances of {}-{}".format(
+                len(masters), spec['count'], service, spec['group']))
+        placed = []
+        for _ in range(count):
+            candidates = [host for host in masters if host['hostname'] not in placed]
+            host = min(candidates, key=lambda host: (self.usage(host, spec['heap'], spec['cores']),
+                                                     host['hostname']))
+            self.assign(host['hostname'], service, spec)
+            placed.append(host['hostname'])
+        return placed
+
+    def plan(self, services):
+        """
+        :param services: List of service names (as used in the cluster.yaml)
+        :return: Dict of service name to a dict with the list of role groups and their hosts
+        """
+        placements = dict((service, {}) for service in services if service in self.catalog)
+
+        # Largest master roles first, so they get spread before the small ones fill up the hosts
+        masters = sorted(((service, spec) for service in placements for spec in self.catalog[service]
+                          if spec.get('placement') == 'master'),
+                         key=lambda item: (-item[1]['heap'] * item[1]['count'], item[0], item[1]['group']))
+        for service, spec in masters:
+            placements[service][spec['group']] = self.place_master(service, spec)
+
+        workers = [host['hostname'] for host in self.hosts if host['type'] != 'master']
+        if len(workers) < MIN_WORKER_HOSTS:
+            # Small cluster, colocate the worker roles with the masters
+            workers = [host['hostname'] for host in self.hosts]
+        for service in placements:
+            for spec in self.catalog[service]:
+                if spec.get('placement') == 'worker':
+                    hosts = workers
+                elif spec.get('colocate'):
+                    hosts = placements[service].get(spec['colocate'], [])
+                else:
+                    continue
+                for hostname in hosts:
+                    self.assign(hostname, service, spec)
+                placements[service][spec['group']] = list(hosts)
 
+        return dict((service, dict(roles=[dict(group=spec['group'], hosts=groups[spec['group']])
+                                          for spec in self.catalog[service]
+                                          if groups.get(spec['group'])]))
+                    for service, groups in placements.items())
 
-class Solr(Service):
-    """
-    Service Role Groups:
-        HUE_SERVER
-    """
-    def pre_start(self):
-        self.run_cmd(self.service.init_solr, 300, "Command InitSolr failed")
-        self.run_cmd(self.service.create_solr_hdfs_home_dir, 300,
-                     "Command CreateSolrHdfsHomeDir failed")
+    def summary(self):
+        """
+        :return: Per host load after the placement
+        """
+        hosts = dict((host['hostname'], host) for host in self.hosts)
+        return dict((hostname, dict(type=hosts[hostname]['type'] or 'worker', heap_mb=load['heap'],
+                                    cores=load['cores'], usage=round(self.usage(hosts[hostname]), 2),
+                                    roles=load['roles']))
+                    for hostname, load in self.load.items())
 
 
-class Hue(Service):
-    """
-    Service Role Groups:
-        HUE_SERVER
+def load_host_facts(path):
     """
+    Load the host facts of the `PlacementPlanner` from a JSON file
 
-
-class Kafka(Service):
-    """
-    Service Role Groups:
-        KAFKA_BROKER
+    :param path: JSON file with either a list of host facts dicts or a dict with a `hosts` list
+    :return: List of host facts dicts
     """
+    with open(path, 'r') as facts:
+        hosts = json.load(facts)
+    return hosts['hosts'] if isinstance(hosts, dict) else hosts
 
 
-class Sentry(Service):
+def merge_placement(services_config, placement):
     """
-    Service Role Groups:
-        SENTRY_SERVER
+    Replace the hosts of the role groups in a cluster.yaml `services:` section with the planned
+    ones, keeping all the configs. Role groups missing from the section are added.
     """
-    def pre_start(self):
-        self.run_cmd(self.service.create_sentry_database_tables, 300,
-                     "Command CreateSentryDBTables failed")
+    merged = dict(services_config or {})
+    for service, planned in placement.items():
+        service_config = dict(merged.get(service) or {})
+        roles = [dict(role) for role in service_config.get('roles', [])]
+        for planned_role in planned['roles']:
+            for role in roles:
+                if role.get('group') == planned_role['group']:
+                    role['hosts'] = planned_role['hosts']
+                    break
+            else:
+                roles.append(dict(planned_role))
+        service_config['roles'] = roles
+        merged[service] = service_config
+    return merged
 
-class Ranger(Service):
-    """
-    Service Role Groups:
-        RANGER_USERSYNC
-        RANGER_TAGSYNC
-        RANGER_ADMIN
-    """
 
 class ClouderaManager(object):
     """
@@ -598,22 +2010,38 @@ class ClouderaManager(object):
     __class__.setup()
     """
 
-    def __init__(self, module, config, trial=False, license_txt=None):
+    def __init__(self, module, config, trial=False, license_txt=None,
+                 parallelism=DEFAULT_PARALLELISM, parcel_cache=None, journal=None, pool_size=None):
         self.config = config
         self.module = module
         self.trial = trial
         self.license_txt = license_txt
+        self.scheduler = ServiceScheduler(parallelism)
+        self.registry = ServiceRegistry(config.get('service_registry'))
+        # Allow a connection per service worker, plus the command poller and the main thread
+        self.pool_size = pool_size or parallelism + 2
+        self.http = None
+        self.parcel_cache = parcel_cache
+        self.journal = journal or Journal()
+        self.digests = {}
+        self.config_changes = {}
         self.cluster = None
+        self.state = None
+        self._hosts = None
         self._api = None
         self._manager = None
 
     @property
     def api(self):
         if self._api is None:
-            self._api = ApiResource(self.config['cm']['host'],
-                                    username=self.config['cm']['username'],
-                                    password=self.config['cm']['password'],
-                                    use_tls=self.config['cm'].get('tls', False))
+            self._api = TracedApiResource(self.config['cm']['host'],
+                                          server_port=self.config['cm'].get('port'),
+                                          username=self.config['cm']['username'],
+                                          password=self.config['cm']['password'],
+                                          use_tls=self.config['cm'].get('tls', False))
+            self.http = PooledHttpClient(self._api._client, self.config['cm']['username'],
+                                         self.config['cm']['password'], self.pool_size)
+            self._api._client = self.http
         return self._api
 
     @property
@@ -622,6 +2050,12 @@ class ClouderaManager(object):
             self._manager = self.api.get_cloudera_manager()
         return self._manager
 
+    @property
+    def host_readiness(self):
+        if self._hosts is None:
+            self._hosts = HostReadiness(self.module, self.api, self.config.get('parcels'))
+        return self._hosts
+
     def enable_license(self):
         """
         Enable the requested license, either it's trial mode or a full license is entered and
@@ -634,8 +2068,8 @@ class ClouderaManager(object):
             if self.trial:
                 self.manager.begin_trial()
             else:
-                if license_txt is not None:
-                    self.manager.update_license(license_txt)
+                if self.license_txt:
+                    self.manager.update_license(self.license_txt)
                 else:
                     fail(self.module, 'License should be provided or trial should be specified')
 
@@ -646,6 +2080,13 @@ class ClouderaManager(object):
         print_json(type="LICENSE",
                    msg="Owner: {}, UUID: {}".format(_license.owner, _license.uuid))
 
+    def load_cluster(self):
+        """
+        Look up an already created cluster entity
+        """
+        self.cluster = self.api.get_cluster(self.config['cluster']['name'])
+        self.state = ClusterState(self.cluster)
+
     def create_cluster(self):
         """
         Create a cluster and add hosts to the cluster. A new cluster is only created
@@ -662,25 +2103,44 @@ class ClouderaManager(object):
                                                    cluster_config['version'],
                                                    cluster_config['fullVersion'])
 
-        cluster_hosts = [self.api.get_host(host.hostId).hostname
-                         for host in self.cluster.list_hosts()]
+        cluster_hosts = self.cluster_hostnames()
         hosts = []
         for host in cluster_config['hosts']:
             if host not in cluster_hosts:
                 hosts.append(host)
         self.cluster.add_hosts(hosts)
+        self.state = ClusterState(self.cluster)
+
+    def cluster_hostnames(self):
+        """
+        :return: Host names of all the hosts within the cluster, with two API calls in total
+        """
+        hostnames = dict((host.hostId, host.hostname) for host in self.api.get_all_hosts())
+        return [hostnames[host.hostId] for host in self.cluster.list_hosts()
+                if host.hostId in hostnames]
 
     def activate_parcels(self):
         print_json(type="PARCELS", msg="Setting up parcels")
+        seeded = False
         for parcel_cfg in self.config['parcels']:
-            parcel = Parcels(self.module, self.manager, self.cluster,
-                             parcel_cfg.get('version'), parcel_cfg.get('repo'),
-                             parcel_cfg.get('product', 'CDH'))
-            parcel.download()
-            parcel.distribute()
-            parcel.activate()
-
-    @retry(attempts=20, delay=5)
+            # Parcels available in the local cache are seeded into the CM local parcel repository,
+            # so that CM finds them already downloaded
+            if self.parcel_cache and self.parcel_cache.seed(parcel_cfg.get('product', 'CDH'),
+                                                            parcel_cfg.get('version')):
+                seeded = True
+        if seeded:
+            # CM only finds the seeded parcels once it rescans its local parcel repository
+            refresh_parcel_repos(self.manager)
+        parcels = [Parcels(self.module, self.manager, self.cluster, parcel_cfg.get('version'),
+                           parcel_cfg.get('repo'), parcel_cfg.get('product', 'CDH'))
+                   for parcel_cfg in self.config['parcels']]
+        ParcelPipeline(self.module, parcels).run()
+
+        if self.parcel_cache:
+            for parcel in parcels:
+                self.parcel_cache.collect(parcel.product, parcel.version)
+
+    @retry(policy=RetryPolicy(delay=1, max_delay=10, deadline=300))
     def wait_inspect_hosts(self, cmd):
         """
         Inspect all the hosts. Basically wait till the check completes on all hosts.
@@ -698,6 +2158,14 @@ class ClouderaManager(object):
             fail(self.module, 'Host inspection failed')
         print_json(type="HOSTS", msg="Host inspection completed: {}".format(cmd.resultMessage))
 
+        # Report the hosts that are not ready yet. Services only wait on the hosts they use, so a
+        # straggler doesn't hold up the services placed on other hosts
+        not_ready = self.host_readiness.findings(self.config['cluster']['hosts'])
+        print_json(type="HOSTS", msg="{} of {} hosts ready".format(
+            len(self.config['cluster']['hosts']) - len(not_ready), len(self.config['cluster']['hosts'])))
+        for host, findings in sorted(not_ready.items()):
+            print_json(type="HOSTS", msg="{} not ready: {}".format(host, ', '.join(findings)))
+
     def deploy_mgmt_services(self):
         """
         Configure, deploy and start all the Cloudera Management Services.
@@ -711,40 +2179,77 @@ class ClouderaManager(object):
             print_json(type="MGMT", msg="Management Services don't exist. Creating.")
             mgmt = self.manager.create_mgmt_service(ApiServiceSetupInfo())
 
-        for role in config['services']['MGMT']['roles']:
+        self.host_readiness.wait(set(host for role in self.config['services']['MGMT']['roles']
+                                     for host in role['hosts'][:1]), "MGMT")
+
+        for role in self.config['services']['MGMT']['roles']:
             if not len(mgmt.get_roles_by_type(role['group'])) > 0:
                 print_json(type="MGMT", msg="Creating role for {}".format(role['group']))
                 mgmt.create_role('{}-1'.format(role['group']), role['group'], role['hosts'][0])
 
-        for role in config['services']['MGMT']['roles']:
+        for role in self.config['services']['MGMT']['roles']:
             role_group = mgmt.get_role_config_group('mgmt-{}-BASE'.format(role['group']))
             role_group.update_config(role.get('config', {}))
 
-        mgmt.start().wait()
+        wait_cmd(mgmt.start())
         if self.manager.get_service().serviceState == 'STARTED':
             print_json(type="MGMT", msg="Management Services started")
         else:
             fail(self.module, "[MGMT] Cloudera Management services didn't start up properly")
 
+    def service_digest(self, service):
+        """
+        Digest of a service config, covering the base setup steps and the services it depends on
+
+        :param service: Name of the service in the registry
+        """
+        if service not in self.digests:
+            deps = [self.service_digest(dep)
+                    for dep in self.registry.depends_on(service)
+                    if self.config['services'].get(dep.upper())]
+            self.digests[service] = Journal.digest(service, self.config['services'].get(service.upper()),
+                                                   self.digests['MGMT'], deps)
+        return self.digests[service]
+
     def service_orchestrate(self, services):
         """
         Create, pre-configure provided list of services
         Stop/Start those services
         Perform and post service startup actions
 
+        Services that don't depend on each other are handled concurrently by the scheduler.
+        Services already recorded as completed in the journal with the same config are skipped,
+        as long as they are still started in the cluster.
+
         :param services: List of Services to perform service specific actions
         """
         service_classes = []
-
-        # Create and pre-configure provided services
         for service in services:
             service_config = self.config['services'].get(service.upper())
-            if service_config:
-                svc = getattr(sys.modules[__name__], service)(self.cluster, service_config)
-                if not svc.started:
+            if not service_config:
+                continue
+            if (self.journal.done('service:' + service, self.service_digest(service)) and
+                    self.state.started(service.upper())):
+                print_json(type=service.upper(), msg="Already completed, skipping")
+                continue
+            service_classes.append(self.registry.get(service)(
+                self.api, self.cluster, service_config, state=self.state))
+        if not service_classes:
+            return
+
+        # Create and pre-configure provided services
+        def configure(svc):
+            if not svc.started:
+                self.host_readiness.wait(svc.hosts, svc.name)
+                with TRACER.span('{} deploy'.format(svc.name), 'services'):
                     svc.deploy()
+                with TRACER.span('{} pre_start'.format(svc.name), 'services'):
                     svc.pre_start()
-                service_classes.append(svc)
+
+        self.scheduler.run(service_classes, configure)
+        for svc in service_classes:
+            if svc.changes:
+                self.config_changes[svc.name] = svc.changes
 
         print_json(type="CLUSTER", msg="Starting services: {} on Cluster".format(services))
 
@@ -755,30 +2260,159 @@ class ClouderaManager(object):
         except ApiException:
             # Sometimes the deploy client configs cannot be run, but we can safely ignore them
             pass
+        self.state.invalidate()
 
         # Start each service and run the post_start actions for each service
-        for svc in service_classes:
+        def start(svc):
             # Only go thru the steps if the service is not yet started. This helps with
             # re-running the script after fixing errors
             if not svc.started:
-                svc.start()
-                svc.post_start()
+                with TRACER.span('{} start'.format(svc.name), 'services'):
+                    svc.start()
+                with TRACER.span('{} post_start'.format(svc.name), 'services'):
+                    svc.post_start()
+            service = svc.__class__.__name__
+            self.journal.record('service:' + service, self.service_digest(service))
+
+        self.scheduler.run(service_classes, start)
+
+    def step(self, name, config, func, skipped=None):
+        """
+        Run a setup step, unless the journal shows it completed with the same config and none
+        of the previous steps changed
+
+        :param name: Step name as recorded in the journal
+        :param config: Config used by the step
+        :param func: Function performing the step
+        :param skipped: Function called instead of `func` when the step is skipped
+        """
+        previous = self.digests.get('previous')
+        digest = self.digests[name] = self.digests['previous'] = Journal.digest(name, config, previous)
+        if self.journal.done(name, digest):
+            print_json(type=name, msg="Already completed, skipping")
+            if skipped is not None:
+                skipped()
+            return
+        with TRACER.span(name):
+            func()
+        self.journal.record(name, digest)
+
+    def wait_parcels_distributed(self, timeout=1800):
+        """
+        Wait till the activated parcels are distributed to all the hosts of the cluster, which CM
+        does on its own for newly added hosts
+        """
+        policy = RetryPolicy(delay=2, max_delay=30, deadline=timeout)
+        started = time.time()
+        attempt = 1
+        while True:
+            pending = []
+            for parcel_cfg in self.config['parcels']:
+                parcel = self.cluster.get_parcel(parcel_cfg.get('product', 'CDH'), parcel_cfg.get('version'))
+                if parcel.state.errors:
+                    fail(self.module, parcel.state.errors)
+                if (parcel.stage not in ('ACTIVATED', 'INUSE') or
+                        (parcel.state.progress or 0) < (parcel.state.totalProgress or 0)):
+                    pending.append('{}-{} {} {} / {}'.format(parcel.product, parcel.version, parcel.stage,
+                                                            parcel.state.progress,
+                                                            parcel.state.totalProgress))
+            if not pending:
+                return
+            sleep = policy.next_delay(attempt, time.time() - started)
+            if sleep is None:
+                fail(self.module, "Timed out distributing parcels: {}".format(', '.join(pending)))
+            print_json(type="PARCELS", msg="Distributing to new hosts: {}".format(', '.join(pending)))
+            time.sleep(sleep)
+            attempt += 1
+
+    def scale_out(self, new_hosts):
+        """
+        Add new hosts to an existing cluster, only creating and starting the roles placed on the
+        new hosts in the cluster.yaml, without walking through the rest of the cluster.
+
+        :param new_hosts: List of host names to add
+        :return: Dict of service name to the list of roles added
+        """
+        self.load_cluster()
+        new_hosts = set(new_hosts)
+        cluster_hosts = self.cluster_hostnames()
+        hosts = sorted(host for host in new_hosts if host not in cluster_hosts)
+        if hosts:
+            print_json(type="CLUSTER", msg="Adding hosts: {}".format(', '.join(hosts)))
+            self.cluster.add_hosts(hosts)
+
+        self.host_readiness.wait(new_hosts, "CLUSTER")
+        self.wait_parcels_distributed()
+
+        service_classes = []
+        for service in BASE_SERVICES + self.registry.additional:
+            service_config = self.config['services'].get(service.upper())
+            if service_config and any(new_hosts.intersection(role.get('hosts', []))
+                                      for role in service_config.get('roles', [])):
+                service_classes.append(self.registry.get(service)(
+                    self.api, self.cluster, service_config, state=self.state))
+
+        added = {}
+
+        def add_roles(svc):
+            roles = {}
+            for role in svc.config['roles']:
+                if new_hosts.intersection(role.get('hosts', [])):
+                    roles.update(svc.create_roles(role, role['group'], new_hosts))
+            if not roles:
+                return
+            added[svc.name] = sorted(roles)
+            try:
+                execute_cmd(svc.service.deploy_client_config, svc.name, 300,
+                            "Failed deploying client configs", *sorted(roles))
+            except ApiException:
+                # Not all the role types have client configs to deploy
+                pass
+            stopped = sorted(name for name, role in roles.items()
+                             if role.type != 'GATEWAY' and getattr(role, 'roleState', None) != 'STARTED')
+            if stopped:
+                print_json(type=svc.name, msg="Starting roles: {}".format(', '.join(stopped)))
+                svc.run_cmd(svc.service.start_roles, 300, "Command Start roles failed", *stopped)
+
+        self.scheduler.run(service_classes, add_roles)
+        return added
+
+    def rolling_restart(self, services=None, batch_size=RESTART_BATCH_SIZE):
+        """
+        Rolling restart of the given services, defaulting to the services with stale configs
+
+        :param services: List of service names
+        :param batch_size: Number of roles restarted at a time
+        :return: Dict of service name to list of restarted batches
+        """
+        self.load_cluster()
+        if services:
+            services = [service.upper() for service in services]
+        else:
+            services = [service.name for service in self.cluster.get_all_services()
+                        if getattr(service, 'configStalenessStatus', None) == 'STALE']
+        if not services:
+            print_json(type="CLUSTER", msg="No services to restart")
+            return {}
+        return RollingRestart(self.module, self.cluster, services, batch_size,
+                              registry=self.registry).run()
 
     def setup(self):
         # Enable a full license or start a trial
-        self.enable_license()
+        self.step('LICENSE', dict(trial=self.trial, license=self.license_txt), self.enable_license)
 
         # Create the cluster entity and associate hosts
-        self.create_cluster()
+        self.step('CLUSTER', self.config['cluster'], self.create_cluster, self.load_cluster)
 
         # Download and activate the parcels
-        self.activate_parcels()
+        self.step('PARCELS', self.config['parcels'], self.activate_parcels)
 
         # Inspect all the hosts
-        self.wait_inspect_hosts(self.manager.inspect_hosts())
+        self.step('HOSTS', self.config['cluster']['hosts'],
+                  lambda: self.wait_inspect_hosts(self.manager.inspect_hosts()))
 
         # Create Management services
-        self.deploy_mgmt_services()
+        self.step('MGMT', self.config['services']['MGMT'], self.deploy_mgmt_services)
 
         # Configure and Start base services
         # Note: The base services needs to be started one at a time, since there's
@@ -787,17 +2421,37 @@ class ClouderaManager(object):
             self.service_orchestrate([service])
 
         # Configure and Start remaining services
-        self.service_orchestrate(ADDITIONAL_SERVICES)
+        self.service_orchestrate(self.registry.additional)
 
 
 if __name__ == '__main__':
+    # Follow the progress of a build: cdh.py tail <events file | unix://path>
+    if len(sys.argv) == 3 and sys.argv[1] == 'tail':
+        try:
+            tail(sys.argv[2])
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
     module = None
     # Load all the variables passed in by Ansible
     try:
         argument_spec = dict(
             template=dict(type='str', default='/opt/cluster.yaml'),
             trial=dict(type='bool', default=False),
-            license_txt=dict(type='str', default='')
+            license_txt=dict(type='str', default=''),
+            parallelism=dict(type='int', default=DEFAULT_PARALLELISM),
+            parcel_cache=dict(type='str', default=''),
+            resume=dict(type='bool', default=False),
+            mode=dict(type='str', default='setup',
+                      choices=['setup', 'rolling_restart', 'scale_out', 'plan']),
+            host_facts=dict(type='str', default=''),
+            plan_output=dict(type='str', default=''),
+            events=dict(type='str', default=''),
+            new_hosts=dict(type='list', default=[]),
+            restart_services=dict(type='list', default=[]),
+            restart_batch_size=dict(type='int', default=RESTART_BATCH_SIZE),
+            pool_size=dict(type='int', default=0)
         )
 
         module = AnsibleModule(
@@ -807,6 +2461,17 @@ if __name__ == '__main__':
         yaml_template = module.params.get('template')
         trial = module.params.get('trial')
         license_txt = module.params.get('license_txt')
+        parallelism = module.params.get('parallelism')
+        parcel_cache = module.params.get('parcel_cache')
+        resume = module.params.get('resume')
+        mode = module.params.get('mode')
+        new_hosts = module.params.get('new_hosts')
+        host_facts = module.params.get('host_facts')
+        plan_output = module.params.get('plan_output')
+        events = module.params.get('events') or yaml_template + '.events'
+        restart_services = module.params.get('restart_services')
+        restart_batch_size = module.params.get('restart_batch_size')
+        pool_size = module.params.get('pool_size')
 
         if not yaml_template:
             fail(module, msg='The cluster configuration template is not available')
@@ -815,14 +2480,67 @@ if __name__ == '__main__':
         yaml_template = 'cluster.yaml'
         trial = True
         license_txt = ''
+        parallelism = DEFAULT_PARALLELISM
+        parcel_cache = ''
+        resume = False
+        mode = 'setup'
+        new_hosts = []
+        host_facts = ''
+        plan_output = ''
+        events = ''
+        restart_services = []
+        restart_batch_size = RESTART_BATCH_SIZE
+        pool_size = 0
+
+    # Stream the progress events, by default next to the cluster.yaml. The module output is
+    # buffered by Ansible till the end, so the events are only echoed when running locally
+    if events:
+        EVENTS.open(events, echo=module is None)
 
     # Load the cluster.yaml template and create a Cloudera cluster
     try:
         with open(yaml_template, 'r') as cluster_yaml:
             config = yaml.load(cluster_yaml)
-        cm = ClouderaManager(module, config, trial, license_txt)
-        cm.setup()
-        if module:
-            module.exit_json(changed=True)
+        if mode == 'plan':
+            # Offline placement of the roles based on the host facts, without talking to CM
+            planner = PlacementPlanner(load_host_facts(host_facts))
+            services = [service for service in config['services'] if service != 'MGMT']
+            config['services'] = merge_placement(config['services'], planner.plan(services))
+            if plan_output:
+                with open(plan_output, 'w') as output:
+                    yaml.safe_dump(config, output, default_flow_style=False)
+            if module:
+                module.exit_json(changed=bool(plan_output), services=config['services'],
+                                 hosts=planner.summary())
+            else:
+                print_json(services=config['services'], hosts=planner.summary())
+            sys.exit(0)
+        cache = ParcelCache(parcel_cache) if parcel_cache else None
+        # The checkpoint journal lives next to the cluster.yaml, its steps are only skipped when
+        # resuming a failed run since the cluster may have changed since it was written
+        journal = Journal(yaml_template + '.journal')
+        if not resume:
+            journal.reset()
+        cm = ClouderaManager(module, config, trial, license_txt, parallelism, cache, journal,
+                             pool_size)
+        if mode == 'rolling_restart':
+            restarted = cm.rolling_restart(restart_services, restart_batch_size)
+            if module:
+                module.exit_json(changed=bool(restarted), restarted=restarted, retry_stats=RETRY_STATS,
+                                 http_stats=cm.http.stats())
+        elif mode == 'scale_out':
+            added = cm.scale_out(new_hosts)
+            if module:
+                module.exit_json(changed=bool(added), added=added, retry_stats=RETRY_STATS,
+                                 http_stats=cm.http.stats())
+        else:
+            try:
+                cm.setup()
+            finally:
+                # The trace is written next to the cluster.yaml, also for failed builds
+                TRACER.write(yaml_template + '.trace.json')
+            if module:
+                module.exit_json(changed=True, retry_stats=RETRY_STATS, config_changes=cm.config_changes,
+                                 timings=TRACER.summary(), http_stats=cm.http.stats())
     except IOError as e:
         fail(module, "Error creating cluster {}".format(e))
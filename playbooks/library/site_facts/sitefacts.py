@@ -19,12 +19,23 @@ limitations under the License.
 
 # This file is part of Ansible
 
+from multiprocessing.pool import ThreadPool
+import bisect
 import math
 import json
+import os
 import requests
 import re
+import sys
 
 from ansible.module_utils.basic import *
+try:
+    from ansible.module_utils.ambari_properties import lookup_property, property_index
+except ImportError:
+    # Imported outside of Ansible, by tools/planner.py and the tests
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    '..', '..', 'module_utils'))
+    from ambari_properties import lookup_property, property_index
 
 ''' Reserved for OS + DN + NM,  Map: dnmemory => Reservation '''
 reservedStack = { 4:1, 8:2, 16:2, 24:4, 48:6, 64:8, 72:8, 96:12,
@@ -33,8 +44,78 @@ reservedStack = { 4:1, 8:2, 16:2, 24:4, 48:6, 64:8, 72:8, 96:12,
 
 reservedHBase = {4:1, 8:1, 16:2, 24:4, 48:8, 64:8, 72:8, 96:16,
                    128:24, 256:32, 512:64}
+''' Reserved for an Impala daemon. Map: dnmemory => Reservation '''
+reservedImpala = {4:1, 8:2, 16:4, 24:6, 48:12, 64:16, 72:16, 96:24,
+                   128:32, 256:64, 512:128}
+''' Reserved for a colocated Kafka broker. Map: dnmemory => Reservation '''
+reservedKafka = {4:1, 8:1, 16:2, 24:2, 48:4, 64:6, 72:6, 96:8,
+                   128:8, 256:12, 512:16}
+''' Reserved for the services colocated with the NodeManager. Map: service => Reservations '''
+reservedServices = {'hbase': reservedHBase, 'impala': reservedImpala, 'kafka': reservedKafka}
 GB = 1024
 
+# Sizing modes. The conservative mode keeps every YARN allocation within 8GB and every MapReduce
+# task within 4GB, the scaled mode hands the whole usable memory and vcores of a worker to YARN
+SIZING_MODES = ['conservative', 'scaled']
+
+# Largest sort buffer of a MapReduce task, mapreduce.task.io.sort.mb has to stay below 2GB
+MAX_IO_SORT_MB = 2047
+
+# Workload profiles chosen with the `workload` module argument. The default one keeps the fixed
+# tuning, the others weight the memory of a worker between YARN and the HBase RegionServer and
+# shape the containers of the engines running on YARN. They are derived from the YARN memory of a
+# worker, so they require the scaled sizing mode, the conservative one clips it to 8192MB:
+#   regionserver_share  share of the usable worker memory moved from YARN to the RegionServer heap
+#   block_cache         share of the RegionServer heap for the block cache
+#   memstore            share of the RegionServer heap for the memstores
+#   executor_cores      cores per Spark executor
+#   executor_overhead   off heap overhead of a Spark executor, as a share of its heap
+#   tez_containers      YARN containers per Tez task
+#   llap_share          share of the YARN memory of a worker for an LLAP daemon, 0 without LLAP
+# Map: workload => weights
+WORKLOADS = {
+    'default': None,
+    'batch-etl': dict(regionserver_share=0.0, block_cache=0.25, memstore=0.45,
+                      executor_cores=5, executor_overhead=0.10, tez_containers=2, llap_share=0.0),
+    'interactive': dict(regionserver_share=0.0, block_cache=0.4, memstore=0.4,
+                        executor_cores=2, executor_overhead=0.10, tez_containers=1, llap_share=0.5),
+    'hbase-serving': dict(regionserver_share=0.4, block_cache=0.55, memstore=0.25,
+                          executor_cores=2, executor_overhead=0.10, tez_containers=1, llap_share=0.0),
+    'spark': dict(regionserver_share=0.0, block_cache=0.4, memstore=0.4,
+                  executor_cores=5, executor_overhead=0.15, tez_containers=1, llap_share=0.0),
+}
+
+# Largest RegionServer heap, above it the JVM loses compressed object pointers
+MAX_REGIONSERVER_HEAP_MB = 31744
+
+# Memory of an LLAP executor, the share of an LLAP daemon kept as headroom and the share of the
+# rest kept for the IO cache
+LLAP_EXECUTOR_MB = 4096
+LLAP_HEADROOM = 0.06
+LLAP_CACHE_SHARE = 0.5
+
+# JVM options of the Tez AM, followed by its heap
+TEZ_AM_LAUNCH_OPTS = "-XX:+PrintGCDetails -verbose:gc -XX:+PrintGCTimeStamps -XX:+UseNUMA -XX:+UseParallelGC -Xmx"
+
+# Host memory is rounded to this many GB when grouping hosts into hardware profiles, so that
+# identical hosts reporting a slightly different amount of memory share a profile
+PROFILE_MEMORY_STEP = 4
+
+# Per host properties overridden with a config group per hardware profile.
+# Map: (config type, fact key) => Ambari property
+PROFILE_OVERRIDES = {
+    ('yarn-site', 'yarn_nodemanager_resource_memory_mb'): 'yarn.nodemanager.resource.memory-mb',
+    ('yarn-site', 'yarn_nodemanager_resource_cpu_vcores'): 'yarn.nodemanager.resource.cpu-vcores',
+    ('hbase-env', 'hbase_regionserver_heapsize'): 'hbase_regionserver_heapsize',
+}
+
+# Service and component of the config groups of a config type.
+# Map: config type => (Ambari service, component described)
+PROFILE_SERVICES = {'yarn-site': ('YARN', 'NodeManager'), 'hbase-env': ('HBASE', 'RegionServer')}
+
+# Number of Ambari config types fetched at the same time
+FETCH_WORKERS = 8
+
 
 def getMinContainerSize(dnmemory):
   if (dnmemory <= 4):
@@ -47,27 +128,52 @@ def getMinContainerSize(dnmemory):
     return 2048
   pass
 
+def interpolate(table, dnmemory):
+    """
+    Reservation for a node size, linearly interpolated between the node sizes of a table
+
+    Nodes smaller than the table get its smallest reservation, larger nodes reserve the same
+    share of their memory as the largest node of the table.
+
+    :param table: Map of node memory in GB to reservation in GB
+    :return: Reservation in GB
+    """
+    sizes = sorted(table)
+    if (dnmemory <= sizes[0]):
+        return table[sizes[0]]
+    if (dnmemory >= sizes[-1]):
+        return int(round(float(table[sizes[-1]]) * dnmemory / sizes[-1]))
+    upper = bisect.bisect_left(sizes, dnmemory)
+    lo, hi = sizes[upper - 1], sizes[upper]
+    return int(round(table[lo] + float(table[hi] - table[lo]) * (dnmemory - lo) / (hi - lo)))
+
 def getReservedStackdnmemory(dnmemory):
-  if ('dnmemory' in reservedStack):
-    return reservedStack[dnmemory]
-  if (dnmemory <= 4):
-    ret = 1
-  elif (dnmemory >= 512):
-    ret = 64
-  else:
-    ret = 1
-  return ret
+  return interpolate(reservedStack, dnmemory)
+
+def getReservedServiceMem(service, dnmemory):
+  return interpolate(reservedServices[service], dnmemory)
 
 def getReservedHBaseMem(dnmemory):
-  if ('dnmemory' in reservedHBase):
-    return reservedHBase[dnmemory]
-  if (dnmemory <= 4):
-    ret = 1
-  elif (dnmemory >= 512):
-    ret = 64
-  else:
-    ret = 2
-  return ret
+  return getReservedServiceMem('hbase', dnmemory)
+
+def colocated_services(hbaseEnabled=False, impalaEnabled=False, kafkaEnabled=False):
+    """
+    :return: Names of the enabled services colocated with the NodeManager, as in `reservedServices`
+    """
+    enabled = dict(hbase=hbaseEnabled, impala=impalaEnabled, kafka=kafkaEnabled)
+    return sorted(service for service in enabled if enabled[service])
+
+def getReservedMem(dnmemory, services):
+    """
+    Memory reserved on a worker for the OS, the DataNode, the NodeManager and the services
+    colocated with them
+
+    :param dnmemory: Memory of the node in GB
+    :param services: Names of the colocated services, as returned by `colocated_services`
+    :return: Reservation in GB
+    """
+    return getReservedStackdnmemory(dnmemory) + \
+        sum(getReservedServiceMem(service, dnmemory) for service in services)
 
 def clip(lo, x, hi):
     return lo if x <= lo else hi if x >= hi else x
@@ -241,14 +347,22 @@ def spark_defaults_facts(dnmemory):
 
     return spark_defaults
 
-def mapred_site_facts(map_memory,reduce_memory,am_memory):
+def mapred_site_facts(map_memory,reduce_memory,am_memory,sizing='conservative'):
 
     mapred_site=dict()
-    mapred_site['mapreduce_map_memory_mb']=clip(1028, map_memory, 4096)
-    mapred_site['mapreduce_map_java_opts']="-Xmx" + str(clip(1028, int(0.8 * map_memory), 8192))  +"m"
-    mapred_site['mapreduce_reduce_memory_mb']=clip(1028, reduce_memory, 4096)
-    mapred_site['mapreduce_reduce_java_opts']="-Xmx" + str(clip(1028, int(0.8 * reduce_memory), 8192)) + "m"
-    mapred_site['mapreduce_task_io_sort_mb']=clip(1028, int(0.4 * map_memory), 8192)
+    if (sizing == 'scaled'):
+        # The tasks get the whole container, the AM doesn't grow with the data and keeps its limit
+        mapred_site['mapreduce_map_memory_mb']=max(1028, map_memory)
+        mapred_site['mapreduce_map_java_opts']="-Xmx" + str(max(1028, int(0.8 * map_memory))) + "m"
+        mapred_site['mapreduce_reduce_memory_mb']=max(1028, reduce_memory)
+        mapred_site['mapreduce_reduce_java_opts']="-Xmx" + str(max(1028, int(0.8 * reduce_memory))) + "m"
+        mapred_site['mapreduce_task_io_sort_mb']=clip(256, int(0.4 * map_memory), MAX_IO_SORT_MB)
+    else:
+        mapred_site['mapreduce_map_memory_mb']=clip(1028, map_memory, 4096)
+        mapred_site['mapreduce_map_java_opts']="-Xmx" + str(clip(1028, int(0.8 * map_memory), 8192))  +"m"
+        mapred_site['mapreduce_reduce_memory_mb']=clip(1028, reduce_memory, 4096)
+        mapred_site['mapreduce_reduce_java_opts']="-Xmx" + str(clip(1028, int(0.8 * reduce_memory), 8192)) + "m"
+        mapred_site['mapreduce_task_io_sort_mb']=clip(1028, int(0.4 * map_memory), 8192)
     mapred_site['yarn_app_mapreduce_am_resource_mb']=clip(1028, am_memory, 4096)
     mapred_site['yarn_app_mapreduce_am_command_opts']="-Xmx" + str(clip(1028, int(0.8*am_memory), 8192)) + "m"
 
@@ -267,12 +381,20 @@ def hdfs_site_facts():
     
     return hdfs_site
 
-def yarn_site_facts(container_ram,containers):
+def yarn_site_facts(container_ram,containers,sizing='conservative',vcores=None):
     yarn_site=dict()
 
-    yarn_site['yarn_scheduler_minimum_allocation_mb']=clip(1024, container_ram, 8192)
-    yarn_site['yarn_scheduler_maximum_allocation_mb']=clip(1024, (containers*container_ram), 8192)
-    yarn_site['yarn_nodemanager_resource_memory_mb']=clip(1024, (containers*container_ram), 8192)
+    if (sizing == 'scaled'):
+        yarn_site['yarn_scheduler_minimum_allocation_mb']=max(1024, container_ram)
+        yarn_site['yarn_scheduler_maximum_allocation_mb']=max(1024, (containers*container_ram))
+        yarn_site['yarn_nodemanager_resource_memory_mb']=max(1024, (containers*container_ram))
+        yarn_site['yarn_nodemanager_resource_cpu_vcores']=max(1, vcores)
+        yarn_site['yarn_scheduler_minimum_allocation_vcores']=1
+        yarn_site['yarn_scheduler_maximum_allocation_vcores']=max(1, vcores)
+    else:
+        yarn_site['yarn_scheduler_minimum_allocation_mb']=clip(1024, container_ram, 8192)
+        yarn_site['yarn_scheduler_maximum_allocation_mb']=clip(1024, (containers*container_ram), 8192)
+        yarn_site['yarn_nodemanager_resource_memory_mb']=clip(1024, (containers*container_ram), 8192)
 
     yarn_site['yarn_timeline-service_store-class'] = "org.apache.hadoop.yarn.server.timeline.RollingLevelDBTimelineStore"
     yarn_site['yarn_timeline-service_generic-application-history_save-non-am-container-meta-info'] = "false"
@@ -295,7 +417,7 @@ def tez_site_facts(dnmemory):
         tez_site['tez_task_resource_memory_mb']="2048"
         memopts="1024"
 
-    tez_site['tez_am_launch_cmd-opts']="-XX:+PrintGCDetails -verbose:gc -XX:+PrintGCTimeStamps -XX:+UseNUMA -XX:+UseParallelGC -Xmx" + memopts + "m"
+    tez_site['tez_am_launch_cmd-opts']=TEZ_AM_LAUNCH_OPTS + memopts + "m"
 
     return tez_site
 
@@ -313,32 +435,351 @@ def zeppelin_env_facts(mnmemory):
     
     return zeppelin_env
 
-def get_config_property(ambari_server, cluster_name, ambari_pass, params, config):
-
-        curr_conf = dict()
-        url='http://' + ambari_server + ':8080/api/v1/clusters/' + cluster_name
-        desired_config=requests.get(url + '?fields=Clusters/desired_configs/' + config, auth=('admin', ambari_pass))
-        this=desired_config.json()
-        
-        tag=this['Clusters']['desired_configs'][config]['tag']
-        
-        desired_conf = requests.get(url + '/configurations?type=' + config + '&tag=' + str(tag), auth=('admin', ambari_pass))
-        this=desired_conf.json()
-    
-        for key in params.iterkeys():
-                            
-            try:
-                property  = key.replace('_', '.', 10).replace('-','.')
-                re_obj = re.compile(property)
-                for my_key in this['items'][0]['properties']:
-                  if re.match(re_obj, my_key):
-                      property = this['items'][0]['properties'][my_key]
-            except KeyError:
-                property = this['items'][0]['properties'][key]
-                
-            curr_conf[key]=property 
-
-        return curr_conf
+def node_sizing(cores, memory, disks, services, regionserver_share=None):
+    """
+    Size the YARN containers of a worker node, after reserving memory for the OS and the daemons
+    running next to the containers
+
+    :param memory: Memory of the node in GB
+    :param services: Names of the colocated services, as returned by `colocated_services`
+    :param regionserver_share: Share of the usable memory moved from YARN to the RegionServer
+                               heap, None for the default tuning
+    :return: Dict with the number of containers and the memory sizes in MB, with a share also the
+             YARN and RegionServer memory
+    """
+    minContainerSize = getMinContainerSize(memory)
+    reservedMem = getReservedMem(memory, services)
+    usable_mb = max(2, memory - reservedMem) * GB
+
+    # The RegionServer heap is its reservation, grown with memory taken from YARN
+    moved_mb = 0
+    regionserver_mb = 0
+    if ('hbase' in services):
+        regionserver_mb = getReservedHBaseMem(memory) * GB
+        moved_mb = min(int((regionserver_share or 0.0) * usable_mb) / GB * GB,
+                       max(0, MAX_REGIONSERVER_HEAP_MB - regionserver_mb))
+        regionserver_mb += moved_mb
+    yarn_mb = usable_mb - moved_mb
+
+    containers = int(min(2 * cores,
+                         min(math.ceil(1.8 * float(disks)),
+                             yarn_mb / minContainerSize)))
+    if (containers <= 2):
+        containers = 3
+
+    container_ram = abs(yarn_mb / containers)
+    if (container_ram > GB):
+        container_ram = int(math.floor(container_ram / 512)) * 512
+
+    map_memory = container_ram
+    reduce_memory = 2 * container_ram if (container_ram <= 2048) else container_ram
+    sizing = dict(containers=containers, container_ram=container_ram, usable_mb=usable_mb,
+                  reserved_mb=reservedMem * GB, map_memory=map_memory, reduce_memory=reduce_memory,
+                  am_memory=max(map_memory, reduce_memory))
+    if (regionserver_share is not None):
+        sizing.update(yarn_mb=yarn_mb, regionserver_mb=regionserver_mb)
+    return sizing
+
+def host_profiles(hosts, disks):
+    """
+    Group hosts into hardware profiles by their cores, memory and disks
+
+    :param hosts: List of host facts dicts with `hostname`, `memory_mb`, `cores` and optionally
+                  `vcores` and `disks`
+    :param disks: Number of disks of the hosts without a disk count
+    :return: Dict of profile name to a dict with the cores, the vcores of its smallest host,
+             memory in GB, disks and hosts
+    """
+    profiles = dict()
+    for host in hosts:
+        memory = int(round(float(host['memory_mb']) / GB / PROFILE_MEMORY_STEP)) * PROFILE_MEMORY_STEP
+        cores = int(host['cores'])
+        host_disks = int(host.get('disks') or disks)
+        name = '{}c-{}g-{}d'.format(cores, memory, host_disks)
+        vcores = int(host.get('vcores') or cores)
+        profile = profiles.setdefault(name, dict(cores=cores, vcores=vcores, memory=memory,
+                                                 disks=host_disks, hosts=[]))
+        profile['vcores'] = min(profile['vcores'], vcores)
+        profile['hosts'].append(host['hostname'])
+    for profile in profiles.values():
+        profile['hosts'].sort()
+    return profiles
+
+def profile_facts(profiles, services, mode, weights=None):
+    """
+    Size every hardware profile on its own
+
+    :param profiles: Hardware profiles as returned by `host_profiles`
+    :param services: Names of the colocated services, as returned by `colocated_services`
+    :param mode: Sizing mode, one of `SIZING_MODES`
+    :param weights: Weights of the workload profile, None for the default tuning
+    :return: Dict of profile name to the profile with its sizing and yarn-site, mapred-site,
+             tez-site and with a workload profile hbase-env facts
+    """
+    facts = dict()
+    for name, profile in profiles.items():
+        sizing = node_sizing(profile['cores'], profile['memory'], profile['disks'], services,
+                             weights['regionserver_share'] if weights else None)
+        facts[name] = dict(profile, **sizing)
+        facts[name]['yarn_site'] = yarn_site_facts(sizing['container_ram'], sizing['containers'],
+                                                   mode, profile['vcores'])
+        facts[name]['mapred_site'] = mapred_site_facts(sizing['map_memory'], sizing['reduce_memory'],
+                                                       sizing['am_memory'], mode)
+        facts[name]['tez_site'] = tez_site_facts(sizing['usable_mb'])
+        if weights and 'hbase' in services:
+            facts[name]['hbase_env'] = hbase_workload_facts(weights, sizing['regionserver_mb'])[0]
+    return facts
+
+def config_groups(cluster_name, profiles, recommended):
+    """
+    Ambari config groups overriding the per host properties for every hardware profile that
+    differs from the cluster wide configuration, one group per service and profile
+
+    :param profiles: Sized hardware profiles as returned by `profile_facts`
+    :param recommended: Dict of Ambari config type to the cluster wide facts
+    :return: List of config group definitions, as posted to /api/v1/clusters/<cluster>/config_groups
+    """
+    groups = []
+    for name, profile in sorted(profiles.items()):
+        for config, (service, component) in sorted(PROFILE_SERVICES.items()):
+            profile_config = profile.get(config.replace('-', '_'), {})
+            properties = dict((PROFILE_OVERRIDES[(config_type, key)], str(profile_config[key]))
+                              for config_type, key in PROFILE_OVERRIDES
+                              if config_type == config and key in profile_config and
+                              key in recommended[config] and profile_config[key] != recommended[config][key])
+            if not properties:
+                continue
+            groups.append(dict(ConfigGroup=dict(
+                cluster_name=cluster_name,
+                group_name=service.lower() + '-' + name,
+                tag=service,
+                description='{} sizing for {} hosts'.format(component, name),
+                hosts=[dict(host_name=host) for host in profile['hosts']],
+                desired_configs=[dict(type=config, tag='sitefacts-' + name, properties=properties)])))
+    return groups
+
+def megabytes(value):
+    """
+    :return: Size in MB of a fact value like "4096m" or 4096
+    """
+    return int(str(value).rstrip('m'))
+
+def hbase_workload_facts(weights, regionserver_mb):
+    """
+    Size the RegionServer heap and split it between the block cache and the memstores
+
+    :param regionserver_mb: RegionServer heap as sized by `node_sizing`
+    :return: Tuple of the hbase-env and hbase-site facts
+    """
+    heap = clip(1024, regionserver_mb, MAX_REGIONSERVER_HEAP_MB)
+    hbase_env=dict()
+    hbase_env['hbase_regionserver_heapsize']=str(heap) + "m"
+    hbase_env['hbase_regionserver_xmn_max']=str(min(2048, heap / 8)) + "m"
+
+    hbase_site=dict()
+    hbase_site['hfile_block_cache_size']=str(weights['block_cache'])
+    hbase_site['hbase_regionserver_global_memstore_size']=str(weights['memstore'])
+
+    return hbase_env, hbase_site
+
+def spark_workload_facts(weights, yarn_mb, max_allocation_mb, vcores):
+    """
+    Size the Spark executors to fill a worker, leaving a core to the daemons
+
+    :param yarn_mb: Memory of the NodeManager
+    :return: spark-defaults facts
+    """
+    executor_cores = max(1, min(weights['executor_cores'], vcores - 1))
+    executors = max(1, (vcores - 1) / executor_cores)
+    container_mb = min(max_allocation_mb, yarn_mb / executors)
+    overhead = max(384, int(container_mb * weights['executor_overhead'] / (1 + weights['executor_overhead'])))
+
+    spark_defaults=dict()
+    spark_defaults['spark_executor_cores']=str(executor_cores)
+    spark_defaults['spark_yarn_executor_memory']=str(max(512, container_mb - overhead)) + "m"
+    spark_defaults['spark_yarn_executor_memoryOverhead']=str(overhead)
+
+    return spark_defaults
+
+def tez_workload_facts(weights, container_ram, max_allocation_mb):
+    """
+    Size the Tez containers in YARN containers
+
+    :return: Tuple of the hive-site and tez-site facts
+    """
+    container_mb = min(max_allocation_mb, max(1024, weights['tez_containers'] * container_ram))
+
+    hive_site=dict()
+    hive_site['hive_tez_container_size']=str(container_mb)
+    # Map joins hold the small table in memory, a third of the container
+    hive_site['hive_auto_convert_join_noconditionaltask_size']=str(container_mb / 3 * 1024 * 1024)
+
+    tez_site=dict()
+    tez_site['tez_am_resource_memory_mb']=str(container_mb)
+    tez_site['tez_task_resource_memory_mb']=str(container_mb)
+    tez_site['tez_am_launch_cmd-opts']=TEZ_AM_LAUNCH_OPTS + str(int(0.8 * container_mb)) + "m"
+    tez_site['tez_runtime_io_sort_mb']=str(clip(256, int(0.4 * container_mb), MAX_IO_SORT_MB))
+
+    return hive_site, tez_site
+
+def llap_facts(weights, yarn_mb, max_allocation_mb, vcores):
+    """
+    Size an LLAP daemon per worker, splitting it between executors of `LLAP_EXECUTOR_MB` and the
+    IO cache
+
+    :param yarn_mb: Memory of the NodeManager
+    :return: Tuple of the hive-interactive-site and hive-interactive-env facts
+    """
+    daemon_mb = min(max_allocation_mb, int(weights['llap_share'] * yarn_mb) / GB * GB)
+    headroom_mb = max(GB, int(LLAP_HEADROOM * daemon_mb))
+    executors = max(1, min(vcores, int((1 - LLAP_CACHE_SHARE) * (daemon_mb - headroom_mb)) / LLAP_EXECUTOR_MB))
+    heap_mb = min(daemon_mb - headroom_mb, executors * LLAP_EXECUTOR_MB)
+    cache_mb = max(0, daemon_mb - headroom_mb - heap_mb)
+
+    hive_interactive_site=dict()
+    hive_interactive_site['hive_llap_daemon_yarn_container_mb']=str(daemon_mb)
+    hive_interactive_site['hive_llap_daemon_num_executors']=str(executors)
+    hive_interactive_site['hive_llap_io_threadpool_size']=str(executors)
+    hive_interactive_site['hive_llap_io_enabled']="true" if cache_mb else "false"
+    hive_interactive_site['hive_llap_io_memory_size']=str(cache_mb)
+
+    hive_interactive_env=dict()
+    hive_interactive_env['llap_heap_size']=str(heap_mb)
+    hive_interactive_env['llap_headroom_space']=str(headroom_mb)
+
+    return hive_interactive_site, hive_interactive_env
+
+def workload_facts(weights, services, sizing, yarn_site, vcores):
+    """
+    Facts of a workload profile, from the YARN memory of a worker sized in the scaled mode
+
+    :param sizing: Sizing of the worker as returned by `node_sizing`
+    :param yarn_site: yarn-site facts of the worker
+    :return: Dict of Ambari config type to the facts overriding the fixed tuning
+    """
+    max_allocation_mb = yarn_site['yarn_scheduler_maximum_allocation_mb']
+    yarn_mb = yarn_site['yarn_nodemanager_resource_memory_mb']
+    facts = dict()
+    if ('hbase' in services):
+        facts['hbase-env'], facts['hbase-site'] = hbase_workload_facts(weights, sizing['regionserver_mb'])
+    facts['spark-defaults'] = spark_workload_facts(weights, yarn_mb, max_allocation_mb, vcores)
+    facts['hive-site'], facts['tez-site'] = tez_workload_facts(weights, sizing['container_ram'],
+                                                               max_allocation_mb)
+    if (weights['llap_share']):
+        facts['hive-interactive-site'], facts['hive-interactive-env'] = llap_facts(
+            weights, yarn_mb, max_allocation_mb, vcores)
+    return facts
+
+def workload_summary(workload, memory, vcores, sizing, recommended):
+    """
+    Split of the memory of a worker between its consumers and the work it runs at once, to compare
+    the trade-offs of the workload profiles. A negative unallocated memory is overcommitted.
+
+    :param memory: Memory of the worker in GB
+    :param sizing: Sizing of the worker as returned by `node_sizing`
+    :param recommended: Dict of Ambari config type to the cluster wide facts
+    :return: Dict of the summary, memory in MB
+    """
+    node_mb = memory * GB
+    yarn_mb = recommended['yarn-site']['yarn_nodemanager_resource_memory_mb']
+    other_mb = sizing['reserved_mb'] - sizing['regionserver_mb'] + (sizing['usable_mb'] - sizing['yarn_mb'])
+    regionserver_mb = 0
+    if (sizing['regionserver_mb']):
+        regionserver_mb = megabytes(recommended['hbase-env']['hbase_regionserver_heapsize'])
+    hbase_site = recommended['hbase-site']
+
+    spark_defaults = recommended['spark-defaults']
+    executor_cores = int(spark_defaults.get('spark_executor_cores', 1))
+    executor_mb = megabytes(spark_defaults['spark_yarn_executor_memory']) + \
+        int(spark_defaults['spark_yarn_executor_memoryOverhead'])
+
+    llap = recommended.get('hive-interactive-site', {})
+    llap_mb = int(llap.get('hive_llap_daemon_yarn_container_mb', 0))
+    tez_mb = int(recommended['hive-site']['hive_tez_container_size'])
+
+    summary = dict(
+        workload=workload,
+        node_mb=node_mb,
+        daemons_mb=other_mb,
+        regionserver_heap_mb=regionserver_mb,
+        yarn_mb=yarn_mb,
+        unallocated_mb=node_mb - other_mb - regionserver_mb - yarn_mb,
+        block_cache_mb=int(regionserver_mb * float(hbase_site.get('hfile_block_cache_size', 0.4))),
+        memstore_mb=int(regionserver_mb * float(hbase_site.get('hbase_regionserver_global_memstore_size', 0.4))),
+        containers=sizing['containers'],
+        container_mb=sizing['container_ram'],
+        spark_executors=min(yarn_mb / executor_mb, max(1, vcores / executor_cores)),
+        spark_executor_cores=executor_cores,
+        spark_executor_mb=executor_mb,
+        tez_container_mb=tez_mb,
+        tez_tasks=(yarn_mb - llap_mb) / tez_mb,
+        llap_daemon_mb=llap_mb,
+        llap_executors=int(llap.get('hive_llap_daemon_num_executors', 0)),
+        llap_cache_mb=int(llap.get('hive_llap_io_memory_size', 0)))
+    for consumer in ['daemons', 'regionserver_heap', 'yarn']:
+        summary[consumer + '_pct'] = round(100.0 * summary[consumer + '_mb'] / node_mb, 1)
+    return summary
+
+def ambari_session(ambari_pass):
+    """
+    :return: `requests.Session` keeping a connection per fetch worker alive for all the calls
+    """
+    session = requests.Session()
+    session.auth = ('admin', ambari_pass)
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1,
+                                                           pool_maxsize=FETCH_WORKERS))
+    return session
+
+def get_desired_tags(session, url):
+    """
+    :return: Dict of config type to the tag of its desired version, all fetched in a single call
+    """
+    desired_configs = session.get(url + '?fields=Clusters/desired_configs').json()
+    return dict((config, desired['tag'])
+                for config, desired in desired_configs['Clusters']['desired_configs'].items())
+
+def get_config_property(properties, params, config):
+    """
+    :param properties: Current properties of the config type
+    :param params: Recommended properties by fact key
+    :param config: Config type
+    :return: Dict of fact key to the current value, None for properties that aren't set
+    """
+    index = property_index(properties)
+    curr_conf = dict()
+    for key in params.iterkeys():
+        name = lookup_property(index, properties, config, key)
+        curr_conf[key] = properties[name] if name is not None else None
+    return curr_conf
+
+def get_current_configs(ambari_server, cluster_name, ambari_pass, recommended):
+    """
+    Look up the current values of the recommended properties in Ambari. The desired tags of all
+    the config types are fetched at once, followed by the configurations of the types in parallel
+    over a shared session.
+
+    :param recommended: Dict of Ambari config type to the recommended properties
+    :return: Dict of config type to the current values of the recommended properties. Types not
+             present in the cluster are left out.
+    """
+    url = 'http://' + ambari_server + ':8080/api/v1/clusters/' + cluster_name
+    session = ambari_session(ambari_pass)
+    tags = get_desired_tags(session, url)
+    configs = [config for config in recommended if config in tags]
+
+    def fetch(config):
+        desired_conf = session.get(url + '/configurations',
+                                   params={'type': config, 'tag': str(tags[config])}).json()
+        return get_config_property(desired_conf['items'][0]['properties'], recommended[config], config)
+
+    if not configs:
+        return {}
+    pool = ThreadPool(min(FETCH_WORKERS, len(configs)))
+    try:
+        return dict(zip(configs, pool.map(fetch, configs)))
+    finally:
+        pool.close()
+        pool.join()
 
 def compare_configs(curr_params, rec_params, config):
 
@@ -365,57 +806,65 @@ def main():
   module = AnsibleModule(
       argument_spec = dict(
         cores =  dict(default=16, type='str'),
+        vcores = dict(default=None, type='str'),
         mnmemory = dict(default=64, type='float'),
         dnmemory = dict(default=64, type='float'),
         disks = dict(default=4, type='str'),
         hbaseEnabled = dict(default='True', type='bool'),
+        impalaEnabled = dict(default='False', type='bool'),
+        kafkaEnabled = dict(default='False', type='bool'),
         ambari_server = dict(default='localhost', type='str'), 
         ambari_pass = dict(default='admin', type='str'),
         cluster_name = dict(default='hadoop-poc',type='str'),
         compare = dict(default='True', type='bool'),
-        current_facts = dict(default='True', type='bool')
+        current_facts = dict(default='True', type='bool'),
+        hosts = dict(default=[], type='list'),
+        sizing = dict(default='conservative', choices=SIZING_MODES),
+        workload = dict(default='default', choices=sorted(WORKLOADS))
       )
     )
 
   cores = int(module.params.get('cores'))
+  vcores = int(module.params.get('vcores') or cores)
   mnmemory = int(round(module.params.get('mnmemory')))
   dnmemory = int(round(module.params.get('dnmemory')))
   disks = int(module.params.get('disks'))
   hbaseEnabled = module.params.get('hbaseEnabled')
+  impalaEnabled = module.params.get('impalaEnabled')
+  kafkaEnabled = module.params.get('kafkaEnabled')
   ambari_server = module.params.get('ambari_server')
   ambari_pass = module.params.get('ambari_pass')
   cluster_name = module.params.get('cluster_name')
   compare = module.params.get('compare')
   current_facts = module.params.get('compare')
-
-  minContainerSize = getMinContainerSize(dnmemory)
-  reservedStackdnmemory = getReservedStackdnmemory(dnmemory)
-  reservedHBasednmemory = 0
-  if (hbaseEnabled):
-    reservedHBasednmemory = getReservedHBaseMem(dnmemory)
-  reservedMem = reservedStackdnmemory + reservedHBasednmemory
-  usableMem = dnmemory - reservedMem
-  dnmemory -= (reservedMem)
-  if (dnmemory < 2):
-    dnmemory = 2
-    reservedMem = max(0, dnmemory - reservedMem)
-
-  dnmemory *= GB
-
-  containers = int (min(2 * cores,
-                         min(math.ceil(1.8 * float(disks)),
-                              dnmemory/minContainerSize)))
-  if (containers <= 2):
-    containers = 3
-
-  container_ram =  abs(dnmemory/containers)
-  if (container_ram > GB):
-    container_ram = int(math.floor(container_ram / 512)) * 512
-
-  map_memory = container_ram
-  reduce_memory = 2*container_ram if (container_ram <= 2048) else container_ram
-  am_memory = max(map_memory, reduce_memory)
-
+  hosts = module.params.get('hosts')
+  sizing_mode = module.params.get('sizing')
+  workload = module.params.get('workload')
+  weights = WORKLOADS[workload]
+
+  if (weights and sizing_mode != 'scaled'):
+    module.fail_json(msg="The {} workload profile requires sizing=scaled, the {} sizing clips the "
+                         "YARN memory of a worker to 8192MB".format(workload, sizing_mode))
+
+  # With the facts of all the workers every hardware profile is sized on its own, the cluster
+  # wide facts use the smallest profile so that the containers fit on every node
+  services = colocated_services(hbaseEnabled, impalaEnabled, kafkaEnabled)
+  profiles = dict()
+  if hosts:
+    profiles = profile_facts(host_profiles(hosts, disks), services, sizing_mode, weights)
+    smallest = min(profiles.values(), key=lambda profile: (profile['usable_mb'], profile['cores']))
+    cores, dnmemory, disks = smallest['cores'], smallest['memory'], smallest['disks']
+    vcores = min(profile['vcores'] for profile in profiles.values())
+
+  sizing = node_sizing(cores, dnmemory, disks, services,
+                       weights['regionserver_share'] if weights else None)
+  containers = sizing['containers']
+  container_ram = sizing['container_ram']
+  map_memory = sizing['map_memory']
+  reduce_memory = sizing['reduce_memory']
+  am_memory = sizing['am_memory']
+  memory = dnmemory
+  dnmemory = sizing['usable_mb']
 
   ams_hbase_env = ams_hbase_env_facts(mnmemory,dnmemory)
   ams_env = ams_env_facts(mnmemory)
@@ -426,81 +875,52 @@ def main():
   hbase_site = hbase_site_facts()
   hadoop_env = hadoop_env_facts(mnmemory,dnmemory)
   spark_defaults = spark_defaults_facts(dnmemory)
-  mapred_site = mapred_site_facts(map_memory,reduce_memory,am_memory)
+  mapred_site = mapred_site_facts(map_memory,reduce_memory,am_memory,sizing_mode)
   hdfs_site = hdfs_site_facts()
-  yarn_site = yarn_site_facts(container_ram,containers)
+  yarn_site = yarn_site_facts(container_ram,containers,sizing_mode,vcores)
   tez_site = tez_site_facts(dnmemory)
   zeppelin_env = zeppelin_env_facts(mnmemory)
-  if current_facts:    
-    curr_ams_hbase_env = get_config_property(ambari_server, cluster_name, ambari_pass, ams_hbase_env, 'ams-hbase-env') 
-    curr_ams_env = get_config_property(ambari_server, cluster_name, ambari_pass, ams_env, 'ams-env') 
-    curr_core_site =  get_config_property(ambari_server, cluster_name, ambari_pass, core_site, 'core-site') 
-    curr_hive_site = get_config_property(ambari_server, cluster_name, ambari_pass, hive_site, 'hive-site') 
-    curr_hive_env = get_config_property(ambari_server, cluster_name, ambari_pass, hive_env, 'hive-env') 
-    curr_hbase_env = get_config_property(ambari_server, cluster_name, ambari_pass, hbase_env, 'hbase-env') 
-    curr_hbase_site = get_config_property(ambari_server, cluster_name, ambari_pass, hbase_site, 'hbase-site') 
-    curr_hadoop_env = get_config_property(ambari_server, cluster_name, ambari_pass, hadoop_env, 'hadoop-env') 
-    curr_spark_defaults = get_config_property(ambari_server, cluster_name, ambari_pass, spark_defaults, 'spark-defaults') 
-    curr_mapred_site = get_config_property(ambari_server, cluster_name, ambari_pass, mapred_site, 'mapred-site') 
-    curr_hdfs_site = get_config_property(ambari_server, cluster_name, ambari_pass, hdfs_site, 'hdfs-site') 
-    curr_yarn_site = get_config_property(ambari_server, cluster_name, ambari_pass, yarn_site, 'yarn-site') 
-    curr_tez_site = get_config_property(ambari_server, cluster_name, ambari_pass, tez_site, 'tez-site') 
-#    curr_zeppelin_env = get_config_property(ambari_server, cluster_name, ambari_pass, zeppelin_env, 'zeppelin-env') 
+
+  recommended = {
+    'ams-hbase-env': ams_hbase_env,
+    'ams-env': ams_env,
+    'core-site': core_site,
+    'hive-site': hive_site,
+    'hive-env': hive_env,
+    'hbase-env': hbase_env,
+    'hbase-site': hbase_site,
+    'hadoop-env': hadoop_env,
+    'spark-defaults': spark_defaults,
+    'mapred-site': mapred_site,
+    'hdfs-site': hdfs_site,
+    'yarn-site': yarn_site,
+    'tez-site': tez_site,
+    'zeppelin-env': zeppelin_env,
+  }
+  # The workload profile re-weights the fixed tuning
+  if weights:
+    for config, params in workload_facts(weights, services, sizing, yarn_site, vcores).items():
+      recommended.setdefault(config, dict()).update(params)
+  facts = dict((config.replace('-', '_'), dict(params)) for config, params in recommended.items())
+  if weights:
+    facts['workload_summary'] = workload_summary(workload, memory, vcores, sizing, recommended)
+  if profiles:
+    facts['host_profiles'] = profiles
+    facts['config_groups'] = config_groups(cluster_name, profiles, recommended)
+
+  if current_facts:
+    # zeppelin-env is not compared
+    current = get_current_configs(ambari_server, cluster_name, ambari_pass,
+                                  dict((config, params) for config, params in recommended.items()
+                                       if config != 'zeppelin-env'))
+    facts.update(('curr_' + config.replace('-', '_'), dict(params)) for config, params in current.items())
 
 #  print json.dumps({"Num Container" : str(containers),
 #                    "Container Ram MB" : str(container_ram),
 #                    "Used Ram GB" : str(int (containers*container_ram/float(GB))),
 #                    "Unused Ram GB" : str(reservedMem),
 
-  if current_facts:
-    module.exit_json(changed=True,
-         ansible_facts=dict(
-         ams_hbase_env=dict(ams_hbase_env),
-         ams_env=dict(ams_env),
-         core_site=dict(core_site),
-         hive_site=dict(hive_site),
-         hive_env=dict(hive_env),
-         hbase_env=dict(hbase_env),
-         hbase_site=dict(hbase_site),
-         hadoop_env=dict(hadoop_env),
-         spark_defaults=dict(spark_defaults),
-         mapred_site=dict(mapred_site),
-         hdfs_site=dict(hdfs_site),
-         yarn_site=dict(yarn_site),
-         tez_site=dict(tez_site),
-         zeppelin_env=dict(zeppelin_env),
-         curr_ams_hbase_env=dict(curr_ams_hbase_env),
-         curr_ams_env=dict(curr_ams_env), 
-         curr_core_site=dict(curr_core_site),
-         curr_hive_site=dict(curr_hive_site),
-         curr_hive_env=dict(curr_hive_env),
-         curr_hbase_env=dict(curr_hbase_env),
-         curr_hbase_site=dict(curr_hbase_site),
-         curr_hadoop_env=dict(curr_hadoop_env),
-         curr_spark_defaults=dict(curr_spark_defaults),
-         curr_mapred_site=dict(curr_mapred_site),
-         curr_hdfs_site=dict(curr_hdfs_site),
-         curr_yarn_site=dict(curr_yarn_site),
-         curr_tez_site=dict(curr_tez_site)
-         ))
-  else:
-                   module.exit_json(changed=True,
-                           ansible_facts=dict(
-                           ams_hbase_env=dict(ams_hbase_env),
-                           ams_env=dict(ams_env),
-                           core_site=dict(core_site),
-                           hive_site=dict(hive_site),
-                           hive_env=dict(hive_env),
-                           hbase_env=dict(hbase_env),
-                           hbase_site=dict(hbase_site),
-                           hadoop_env=dict(hadoop_env),
-                           spark_defaults=dict(spark_defaults),
-                           mapred_site=dict(mapred_site),
-                           hdfs_site=dict(hdfs_site),
-                           yarn_site=dict(yarn_site),
-                           tez_site=dict(tez_site),
-                           zeppelin_env=dict(zeppelin_env) 
-                           ))
+  module.exit_json(changed=True, ansible_facts=facts)
 
 if __name__ == '__main__':
     main()
@@ -25,6 +25,7 @@ import requests
 import re
 
 from ansible.module_utils.basic import *
+from ansible.module_utils.ambari_properties import lookup_property, property_index
 
 from datetime import datetime
 import hashlib
@@ -54,20 +55,14 @@ def update_config(cluster, config_name, new_properties):
     properties = config.properties
     original_sha = hashlib.sha256(json.dumps(properties)).hexdigest()
 
-    """Sanitise new properties"""
-   for key in new_properties.iterkeys():
-
+    """Map the fact keys onto the existing Ambari property names"""
+    index = property_index(properties)
     new_conf=dict()
 
-    for key in new_properties.iterkeys():
-      
-        property = key.replace('_', '.', 10).replace('-','.')
-        re_obj = re.compile(property)
-        for my_key in properties:
-            my_key = str(my_key)
-            if re.match(re_obj, my_key):
-                property = new_properties[key]
-                new_conf[my_key]=property
+    for key, value in new_properties.iteritems():
+        name = lookup_property(index, properties, config_name, key)
+        if name is not None:
+            new_conf[name] = value
 
     properties.update(new_conf)
     new_sha = hashlib.sha256(json.dumps(properties)).hexdigest()
@@ -89,6 +84,66 @@ def update_config(cluster, config_name, new_properties):
     cluster.update(Clusters=data)
 
 
+def config_group_tags(group):
+    """Suffix the desired config tags with the hash of their properties, so a changed profile gets
+    a new config version and an unchanged one keeps its tag"""
+    desired_configs = []
+    for desired in group['desired_configs']:
+        sha = hashlib.sha256(json.dumps(desired['properties'], sort_keys=True)).hexdigest()
+        desired_configs.append(dict(desired, tag='{}-{}'.format(desired['tag'], sha[:8])))
+    return dict(group, desired_configs=desired_configs)
+
+
+def apply_config_groups(ambari_server, ambari_pass, cluster_name, groups):
+    """Create or update the per hardware profile config groups of sitefacts.py
+
+    :param groups: Config group definitions, as in the config_groups fact
+    :return: Names of the groups created or updated
+    :raises ValueError: If a host of a group is not a host of the cluster in Ambari, since Ambari
+                        would silently leave it out of the group
+    """
+    url = 'http://{}:8080/api/v1/clusters/{}'.format(ambari_server, cluster_name)
+    session = requests.Session()
+    session.auth = ('admin', ambari_pass)
+    session.headers['X-Requested-By'] = 'ambari'
+
+    response = session.get(url + '/hosts', params={'fields': 'Hosts/host_name'})
+    response.raise_for_status()
+    cluster_hosts = set(item['Hosts']['host_name'] for item in response.json().get('items', []))
+    missing = sorted(set(host['host_name'] for group in groups
+                         for host in group['ConfigGroup']['hosts']) - cluster_hosts)
+    if missing:
+        raise ValueError('Hosts not found in the Ambari cluster {}: {}'.format(
+            cluster_name, ', '.join(missing)))
+
+    url += '/config_groups'
+    response = session.get(url, params={'fields': 'ConfigGroup/group_name,ConfigGroup/hosts,'
+                                                  'ConfigGroup/desired_configs'})
+    response.raise_for_status()
+    existing = dict((item['ConfigGroup']['group_name'], item['ConfigGroup'])
+                    for item in response.json().get('items', []))
+
+    applied = []
+    for group in groups:
+        group = config_group_tags(group['ConfigGroup'])
+        current = existing.get(group['group_name'])
+        if current is None:
+            response = session.post(url, data=json.dumps([dict(ConfigGroup=group)]))
+        else:
+            hosts = sorted(host['host_name'] for host in current.get('hosts', []))
+            tags = sorted((desired['type'], desired['tag'])
+                          for desired in current.get('desired_configs', []))
+            if hosts == sorted(host['host_name'] for host in group['hosts']) and \
+                    tags == sorted((desired['type'], desired['tag'])
+                                   for desired in group['desired_configs']):
+                continue
+            response = session.put('{}/{}'.format(url, current['id']),
+                                   data=json.dumps(dict(ConfigGroup=group)))
+        response.raise_for_status()
+        applied.append(group['group_name'])
+    return applied
+
+
 def main():
 
     module = None
@@ -99,7 +154,8 @@ def main():
 	ambari_pass = dict(default='admin', type='str'),
 	cluster_name = dict(default='hadoop-poc',type='str'),
 	config_name = dict(type='str'),
-	properties = dict(type='dict')
+	properties = dict(type='dict'),
+	config_groups = dict(type='list')
       )
     )
 
@@ -108,8 +164,16 @@ def main():
     cluster_name = module.params.get('cluster_name')
     config_name = module.params.get('config_name')
     properties = module.params.get('properties')
+    config_groups = module.params.get('config_groups')
+
+    if config_groups is not None:
+        try:
+            applied = apply_config_groups(ambari_server, ambari_pass, cluster_name, config_groups)
+        except ValueError as e:
+            module.fail_json(msg=str(e))
+        module.exit_json(changed=bool(applied), config_groups=applied, ansible_facts=dict())
 
-    client = Ambari(ambari_server,  port=8080, username=ambari_user, password=ambari_pass)
+    client = Ambari(ambari_server,  port=8080, username='admin', password=ambari_pass)
   
     update_config(next(client.clusters), config_name, properties)
 
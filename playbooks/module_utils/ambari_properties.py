@@ -0,0 +1,51 @@
+# This file is part of Ansible
+
+# Mapping of the fact keys of sitefacts.py onto the Ambari property names, shared by sitefacts.py
+# and updateconfigs.py so that both resolve a fact key to the same property.
+
+import re
+
+
+# Separators that differ between the fact keys and the Ambari property names
+PROPERTY_SEPARATORS = re.compile(r'[._-]')
+
+# Fact keys that don't map onto their Ambari property by the separators alone.
+# Map: (config type, fact key) => Ambari property
+PROPERTY_ALIASES = {
+    ('zeppelin-env', 'zeppelin_executor_memory'): 'zeppelin.executor.mem',
+}
+
+
+def normalize_property(name):
+    """
+    :return: Property name with the separators unified, so that fact keys and Ambari property
+             names compare equal, e.g. yarn_nodemanager_resource_memory_mb and
+             yarn.nodemanager.resource.memory-mb
+    """
+    return PROPERTY_SEPARATORS.sub('_', name).lower()
+
+
+def property_index(properties):
+    """
+    Build the lookup of the properties of a config type once, instead of matching every key
+    against every property. Of the properties normalizing to the same name the first one in
+    sorted order is used, which keeps the lookup deterministic.
+
+    :return: Dict of normalized name to Ambari property name
+    """
+    index = dict()
+    for name in sorted(properties):
+        index.setdefault(normalize_property(name), name)
+    return index
+
+
+def lookup_property(index, properties, config, key):
+    """
+    :return: Ambari property name for a fact key, None if the config type doesn't have it
+    """
+    alias = PROPERTY_ALIASES.get((config, key))
+    if alias is not None:
+        return alias if alias in properties else None
+    if key in properties:
+        return key
+    return index.get(normalize_property(key))
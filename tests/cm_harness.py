@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# Run cdh.py against the simulated Cloudera Manager of benchmark.py in the tests.
+
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+
+from cm_api.api_client import ApiResource
+
+import benchmark
+import cdh
+
+
+# Tick of the command poller in the tests, in seconds
+TEST_POLL_INTERVAL = 0.02
+
+
+class SimulatedCMServer(object):
+    """
+    Serve a `SimulatedCM` on a local port for the duration of a with block
+
+    The command poller of cdh.py ticks every `TEST_POLL_INTERVAL` seconds and the progress
+    events are not echoed while the server runs.
+    """
+    def __init__(self, cm):
+        self.cm = cm
+        self.server = None
+        self.api = None
+        self._interval = None
+        self._echo = None
+
+    def __enter__(self):
+        self.server = benchmark.ThreadingHTTPServer(('127.0.0.1', 0), benchmark.SimulatedCMHandler)
+        self.server.cm = self.cm
+        thread = threading.Thread(target=self.server.serve_forever, name='simulated-cm')
+        thread.daemon = True
+        thread.start()
+        self.api = ApiResource('127.0.0.1', server_port=self.port, username='admin', password='admin')
+        self._interval = cdh.COMMAND_WATCHER.interval
+        self._echo = cdh.EVENTS.echo
+        cdh.COMMAND_WATCHER.interval = TEST_POLL_INTERVAL
+        cdh.EVENTS.echo = False
+        benchmark.reset()
+        return self
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def __exit__(self, *exc_info):
+        cdh.COMMAND_WATCHER.interval = self._interval
+        cdh.EVENTS.echo = self._echo
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def started_cluster(cm, name, services):
+    """
+    Add a cluster with started services to a `SimulatedCM`
+
+    :param services: Dict of service name to (service type, config dict, list of (role name,
+                     role type, host) tuples)
+    """
+    cm.create_clusters(dict(items=[dict(name=name, version='CDH5', fullVersion='5.16.2')]))
+    cm.add_cluster_hosts(dict(items=[dict(hostId=host) for host in cm.hosts]), name)
+    for service, (service_type, config, roles) in services.items():
+        cm.create_services(dict(items=[dict(name=service, type=service_type)]), name)
+        svc = cm.service(name, service)
+        svc['config'].update(config)
+        svc['state'] = 'STARTED'
+        cm.create_roles(dict(items=[dict(name=role, type=role_type, hostRef=dict(hostId=host))
+                                    for role, role_type, host in roles]), name, service)
+        for role in svc['roles'].values():
+            cm.set_state(role, 'STARTED')
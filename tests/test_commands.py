@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# Tests of the command retries of cdh.py.
+#
+# Usage: python -m unittest discover -s tests
+
+import time
+import unittest
+
+from cm_harness import cdh
+
+
+class Command(object):
+    """
+    Finished CM command, as returned by `cdh.wait_cmd`
+    """
+    def __init__(self, success, resultMessage=None):
+        self.success = success
+        self.resultMessage = resultMessage
+
+
+class ExecuteCmdTest(unittest.TestCase):
+
+    def setUp(self):
+        self._wait_cmd = cdh.wait_cmd
+        self._deadline = cdh.COMMAND_RETRY_DEADLINE
+        self.results = []
+        self.issued = 0
+
+    def tearDown(self):
+        cdh.wait_cmd = self._wait_cmd
+        cdh.COMMAND_RETRY_DEADLINE = self._deadline
+
+    def wait_cmd(self, cmd, timeout=None):
+        time.sleep(0.3)
+        return self.results.pop(0)
+
+    def issue(self):
+        self.issued += 1
+
+    def test_slow_attempt_keeps_the_retries(self):
+        # The first attempt takes longer than the retry deadline alone
+        cdh.wait_cmd = self.wait_cmd
+        cdh.COMMAND_RETRY_DEADLINE = 0.1
+        self.results = [Command(False, 'Command is not currently available for execution'),
+                        Command(True)]
+        cdh.execute_cmd(self.issue, 'TEST', 1, 'Command failed')
+        self.assertEqual(self.issued, 2)
+        self.assertEqual(self.results, [])
+
+    def test_gives_up_after_the_timeout_and_deadline(self):
+        cdh.wait_cmd = self.wait_cmd
+        cdh.COMMAND_RETRY_DEADLINE = 0
+        self.results = [Command(False, 'Command is not currently available for execution')] * 5
+        self.assertRaises(cdh.ApiException, cdh.execute_cmd, self.issue, 'TEST', 0.1,
+                          'Command failed')
+        self.assertEqual(self.issued, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# Tests of the pooled keep-alive transport of cdh.py.
+#
+# Usage: python -m unittest discover -s tests
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+import httplib
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'playbooks', 'library', 'cloudera'))
+
+from cm_api.api_client import ApiException
+from cm_api.http_client import HttpClient
+
+from benchmark import ThreadingHTTPServer
+import cdh
+
+
+class DroppingHandler(BaseHTTPRequestHandler):
+    """
+    Answer with a keep-alive response, then drop the connection if the server is set to, like a
+    server closing an idle keep-alive connection. A request in `server.unanswered` is dropped
+    without a response, like a server going away while handling it.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.server.received.append((self.command, self.path))
+        if self.command in self.server.unanswered:
+            self.close_connection = 1
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('{}')
+        self.close_connection = int(self.server.drop)
+
+    do_GET = do_POST = do_PUT = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class DroppingServer(ThreadingHTTPServer):
+    """
+    Server signalling every connection it closed
+    """
+    def __init__(self, *args, **kwargs):
+        ThreadingHTTPServer.__init__(self, *args, **kwargs)
+        self.received = []
+        self.unanswered = []
+        self.drop = True
+        self.closed = threading.Event()
+
+    def shutdown_request(self, request):
+        ThreadingHTTPServer.shutdown_request(self, request)
+        self.closed.set()
+
+
+class PooledHttpClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self._timeout = cdh.KEEPALIVE_IDLE_TIMEOUT
+        self.server = DroppingServer(('127.0.0.1', 0), DroppingHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        client = HttpClient('http://127.0.0.1:{}/api/v7'.format(self.server.server_address[1]),
+                            exc_class=ApiException)
+        self.http = cdh.PooledHttpClient(client, 'admin', 'admin', 1)
+
+    def tearDown(self):
+        cdh.KEEPALIVE_IDLE_TIMEOUT = self._timeout
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_replayed_on_dropped_connection(self):
+        self.http.execute('GET', '/clusters')
+        self.http.execute('GET', '/clusters')
+        self.assertEqual(self.server.received, [('GET', '/api/v7/clusters')] * 2)
+        self.assertEqual(self.http.connections, 2)
+
+    def test_put_after_idle_connection_closed(self):
+        self.http.execute('GET', '/clusters')
+        self.assertTrue(self.server.closed.wait(5))
+        self.http.execute('PUT', '/clusters/test/services/HDFS/config', data='{}')
+        self.assertEqual(self.server.received, [('GET', '/api/v7/clusters'),
+                                                ('PUT', '/api/v7/clusters/test/services/HDFS/config')])
+        self.assertEqual(self.http.connections, 2)
+
+    def test_idle_connection_expired(self):
+        self.server.drop = False
+        self.http.execute('GET', '/clusters')
+        self.http.execute('GET', '/clusters')
+        self.assertEqual(self.http.connections, 1)
+        cdh.KEEPALIVE_IDLE_TIMEOUT = 0
+        time.sleep(0.01)
+        self.http.execute('GET', '/clusters')
+        self.assertEqual(self.http.connections, 2)
+
+    def test_post_not_replayed_once_sent(self):
+        self.server.drop = False
+        self.server.unanswered = ['POST']
+        self.http.execute('GET', '/clusters')
+        self.assertRaises((httplib.HTTPException, socket.error),
+                          self.http.execute, 'POST', '/clusters/test/commands/firstRun', data='{}')
+        self.assertEqual(self.server.received, [('GET', '/api/v7/clusters'),
+                                                ('POST', '/api/v7/clusters/test/commands/firstRun')])
+
+
+if __name__ == '__main__':
+    unittest.main()
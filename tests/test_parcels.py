@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# Tests of the parcel pipeline of cdh.py against a simulated Cloudera Manager.
+#
+# Usage: python -m unittest discover -s tests
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cm_harness import SimulatedCMServer, started_cluster
+import benchmark
+import cdh
+
+
+HOSTS = ['worker-{:02d}.test'.format(i) for i in range(1, 4)]
+
+VERSION = '5.16.2-1.cdh5.16.2.p0.8'
+
+
+class FlakyCM(benchmark.SimulatedCM):
+    """
+    `SimulatedCM` answering every other parcel status request with a 503
+    """
+    def __init__(self, *args, **kwargs):
+        benchmark.SimulatedCM.__init__(self, *args, **kwargs)
+        self.polls = 0
+
+    def handle(self, method, path, body):
+        if method == 'GET' and '/parcels/products/' in path:
+            self.polls += 1
+            if self.polls % 2 == 0:
+                self.errors += 1
+                return 503, dict(message='Injected failure')
+        return benchmark.SimulatedCM.handle(self, method, path, body)
+
+
+class RepoCM(benchmark.SimulatedCM):
+    """
+    `SimulatedCM` only knowing the parcel once its repo is configured and the parcel repos were
+    refreshed, recording the refreshes. Without a repo the parcel is seeded into the local parcel
+    repo, and known after any refresh.
+    """
+    def __init__(self, repo, *args, **kwargs):
+        benchmark.SimulatedCM.__init__(self, *args, **kwargs)
+        self.repo = repo
+        self.refreshes = []
+
+    def cm_command(self, body, command):
+        if command == 'refreshParcelRepos':
+            self.refreshes.append(self._cm_config.get(cdh.REMOTE_PARCEL_REPO_URLS))
+        return benchmark.SimulatedCM.cm_command(self, body, command)
+
+    def get_parcel(self, body, cluster, product, version):
+        if not any(self.repo is None or self.repo in (urls or '') for urls in self.refreshes):
+            raise benchmark.NotFound('Parcel {}-{}'.format(product, version))
+        return benchmark.SimulatedCM.get_parcel(self, body, cluster, product, version)
+
+
+class ParcelRepoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_repo_refreshed_after_added(self):
+        cm = RepoCM('http://repo.test/', HOSTS, latency=0, command_duration=0.01, host_duration=0)
+        started_cluster(cm, 'test', {})
+        with SimulatedCMServer(cm) as server:
+            parcels = cdh.Parcels(None, server.api.get_cloudera_manager(),
+                                  server.api.get_cluster('test'), VERSION, 'http://repo.test/')
+            self.assertEqual(parcels.parcel.stage, 'AVAILABLE_REMOTELY')
+        self.assertEqual(len(cm.refreshes), 1)
+        self.assertTrue(cm.refreshes[0].endswith(',http://repo.test/'))
+
+    def test_repos_refreshed_after_seeding(self):
+        parcel_name = 'CDH-{}-el7.parcel'.format(VERSION)
+        cached = os.path.join(self.root, 'cache', 'CDH-' + VERSION, 'abc123')
+        os.makedirs(cached)
+        with open(os.path.join(cached, parcel_name), 'w') as parcel_file:
+            parcel_file.write('parcel')
+        repo_dir = os.path.join(self.root, 'repo')
+        os.makedirs(repo_dir)
+        cache = cdh.ParcelCache(os.path.join(self.root, 'cache'), repo_dir=repo_dir)
+
+        cm = RepoCM(None, HOSTS, latency=0, command_duration=0.01, host_duration=0,
+                    parcel_duration=0.01)
+        started_cluster(cm, 'test', {})
+        with SimulatedCMServer(cm) as server:
+            manager = cdh.ClouderaManager(None, dict(
+                cm=dict(host='127.0.0.1', port=server.port, username='admin', password='admin'),
+                parcels=[dict(product='CDH', version=VERSION)]), trial=True, parcel_cache=cache)
+            manager.cluster = manager.api.get_cluster('test')
+            manager.activate_parcels()
+
+        self.assertTrue(os.path.exists(os.path.join(repo_dir, parcel_name)))
+        # The seeded parcel is picked up by a refresh, without adding a parcel repo to CM
+        self.assertEqual(cm.refreshes, [None])
+        self.assertFalse(cdh.REMOTE_PARCEL_REPO_URLS in cm._cm_config)
+        self.assertEqual(cm.parcel('test', 'CDH', VERSION)['stage'], 'ACTIVATED')
+
+
+class ParcelPipelineTest(unittest.TestCase):
+
+    def pipeline(self, server, attempts):
+        cluster = server.api.get_cluster('test')
+        parcels = cdh.Parcels(None, server.api.get_cloudera_manager(), cluster, VERSION, None)
+        return parcels, cdh.ParcelPipeline(
+            None, [parcels], policy=cdh.RetryPolicy(delay=0.02, backoff=1, deadline=10),
+            poll_policy=cdh.RetryPolicy(attempts=attempts, delay=0.01, backoff=1))
+
+    def test_transient_errors_retried(self):
+        cm = FlakyCM(HOSTS, latency=0, parcel_duration=0.05, host_duration=0)
+        started_cluster(cm, 'test', {})
+        with SimulatedCMServer(cm) as server:
+            parcels, pipeline = self.pipeline(server, 3)
+            pipeline.run()
+
+        self.assertTrue(parcels.done)
+        self.assertEqual(cm.parcel('test', 'CDH', VERSION)['stage'], 'ACTIVATED')
+        self.assertTrue(cm.errors > 0)
+
+    def test_persistent_errors_raised(self):
+        cm = FlakyCM(HOSTS, latency=0, parcel_duration=0.05, host_duration=0)
+        started_cluster(cm, 'test', {})
+        with SimulatedCMServer(cm) as server:
+            parcels, pipeline = self.pipeline(server, 1)
+            self.assertRaises(cdh.ApiException, pipeline.run)
+
+
+if __name__ == '__main__':
+    unittest.main()
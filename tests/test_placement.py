@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# Tests of the offline role placement of cdh.py against host facts fixtures.
+#
+# Usage: python -m unittest discover -s tests
+
+import os
+import unittest
+
+from cm_harness import cdh
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+SERVICES = ['ZOOKEEPER', 'HDFS', 'YARN', 'SPARK_ON_YARN', 'HBASE', 'HIVE', 'IMPALA', 'OOZIE',
+            'KAFKA', 'HUE']
+
+# Worker roles, placed on every worker host
+WORKER_ROLES = [('HDFS', 'DATANODE'), ('YARN', 'NODEMANAGER'), ('HBASE', 'REGIONSERVER'),
+                ('IMPALA', 'IMPALAD'), ('KAFKA', 'KAFKA_BROKER')]
+
+
+def hostnames(size):
+    return [host['hostname'] for host in cdh.load_host_facts(os.path.join(
+        FIXTURES, 'hosts_{}.json'.format(size)))]
+
+
+class PlacementPlannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._echo = cdh.EVENTS.echo
+        cdh.EVENTS.echo = False
+
+    def tearDown(self):
+        cdh.EVENTS.echo = self._echo
+
+    def plan(self, size):
+        """
+        :return: Dict of (service, role group) to the list of hosts, and the planner
+        """
+        planner = cdh.PlacementPlanner(cdh.load_host_facts(os.path.join(
+            FIXTURES, 'hosts_{}.json'.format(size))))
+        placement = planner.plan(SERVICES)
+        return dict(((service, role['group']), role['hosts'])
+                    for service, planned in placement.items() for role in planned['roles']), planner
+
+    def masters(self, planner):
+        return sorted(hostname for hostname, host in planner.summary().items()
+                      if host['type'] == 'master')
+
+    def assertDistinct(self, hosts, count):
+        self.assertEqual(len(hosts), count, hosts)
+        self.assertEqual(len(set(hosts)), count, hosts)
+
+    def test_single_host(self):
+        roles, planner = self.plan(1)
+        self.assertEqual(planner.hosts[0]['cores'], 8)
+        self.assertEqual(planner.hosts[0]['memory_mb'], 32768)
+        self.assertEqual(planner.hosts[0]['disks'], 2)
+        # Every role on the only host, one instance of each
+        self.assertEqual(sorted(set(sum(roles.values(), []))), hostnames(1))
+        for hosts in roles.values():
+            self.assertEqual(len(hosts), 1)
+        for role in WORKER_ROLES:
+            self.assertEqual(roles[role], hostnames(1))
+
+    def test_three_hosts(self):
+        roles, planner = self.plan(3)
+        self.assertEqual(self.masters(planner), hostnames(3))
+        # Quorum and HA on the 3 hosts, with the workers colocated
+        self.assertDistinct(roles['ZOOKEEPER', 'SERVER'], 3)
+        self.assertDistinct(roles['HDFS', 'JOURNALNODE'], 3)
+        self.assertDistinct(roles['HDFS', 'NAMENODE'], 2)
+        for role in WORKER_ROLES:
+            self.assertEqual(sorted(roles[role]), hostnames(3))
+
+    def test_five_hosts(self):
+        roles, planner = self.plan(5)
+        # The hosts with the fewest disks are the masters
+        self.assertEqual(self.masters(planner), hostnames(5)[:3])
+        self.assertDistinct(roles['ZOOKEEPER', 'SERVER'], 3)
+        self.assertDistinct(roles['HDFS', 'NAMENODE'], 2)
+        self.assertTrue(set(roles['HDFS', 'NAMENODE']) <= set(hostnames(5)[:3]))
+        # Only 2 dedicated workers, the masters run the worker roles too
+        for role in WORKER_ROLES:
+            self.assertEqual(sorted(roles[role]), hostnames(5))
+
+    def test_forty_hosts(self):
+        roles, planner = self.plan(40)
+        masters = [hostname for hostname in hostnames(40) if hostname.startswith('master')]
+        workers = [hostname for hostname in hostnames(40) if hostname.startswith('worker')]
+        self.assertEqual(self.masters(planner), masters)
+        for role in WORKER_ROLES:
+            self.assertEqual(sorted(roles[role]), workers)
+        for (service, group), hosts in roles.items():
+            if (service, group) not in WORKER_ROLES:
+                self.assertTrue(set(hosts) <= set(masters), (service, group, hosts))
+
+    def test_anti_affinity(self):
+        for size in [3, 5, 40]:
+            roles, _ = self.plan(size)
+            # NameNode and its standby on different hosts, each with its failover controller
+            self.assertDistinct(roles['HDFS', 'NAMENODE'], 2)
+            self.assertEqual(sorted(roles['HDFS', 'FAILOVERCONTROLLER']),
+                             sorted(roles['HDFS', 'NAMENODE']))
+            self.assertDistinct(roles['ZOOKEEPER', 'SERVER'], 3)
+            self.assertDistinct(roles['HDFS', 'JOURNALNODE'], 3)
+            self.assertDistinct(roles['YARN', 'RESOURCEMANAGER'], 2)
+            self.assertDistinct(roles['HBASE', 'MASTER'], 2)
+
+    def test_merge_keeps_the_configs(self):
+        roles, _ = self.plan(3)
+        planner = cdh.PlacementPlanner(cdh.load_host_facts(os.path.join(FIXTURES, 'hosts_3.json')))
+        merged = cdh.merge_placement(
+            dict(HDFS=dict(config=dict(dfs_replication=3),
+                           roles=[dict(group='DATANODE', hosts=['old.test'], config=dict(x=1))])),
+            planner.plan(['HDFS']))
+        datanode = [role for role in merged['HDFS']['roles'] if role['group'] == 'DATANODE'][0]
+        self.assertEqual(merged['HDFS']['config'], dict(dfs_replication=3))
+        self.assertEqual(datanode, dict(group='DATANODE', hosts=roles['HDFS', 'DATANODE'],
+                                        config=dict(x=1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# Tests of the per host readiness of cdh.py against a simulated Cloudera Manager.
+#
+# Usage: python -m unittest discover -s tests
+
+import unittest
+
+from cm_harness import SimulatedCMServer, started_cluster
+import benchmark
+import cdh
+
+
+HOSTS = ['worker-{:02d}.test'.format(i) for i in range(1, 4)]
+
+VERSION = '5.16.2-1.cdh5.16.2.p0.8'
+
+
+class HostReadinessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cm = benchmark.SimulatedCM(HOSTS + ['cm.test'], latency=0, host_duration=0)
+        started_cluster(self.cm, 'test', {})
+        self.cm.cluster('test')['hosts'].remove('cm.test')
+        self.parcel = self.cm.parcel('test', 'CDH', VERSION)
+        self.parcel['stage'] = 'ACTIVATED'
+
+    def findings(self, server):
+        readiness = cdh.HostReadiness(None, server.api, [dict(product='CDH', version=VERSION)])
+        return readiness.findings(HOSTS + ['cm.test']), readiness
+
+    def test_ready(self):
+        with SimulatedCMServer(self.cm) as server:
+            self.assertEqual(self.findings(server)[0], {})
+
+    def test_unrelated_checks_only_warn(self):
+        self.cm.health_checks[HOSTS[0]] = [dict(name='HOST_CLOCK_OFFSET', summary='BAD'),
+                                           dict(name='HOST_MEMORY_SWAPPING', summary='BAD'),
+                                           dict(name='HOST_DNS_RESOLUTION', summary='GOOD')]
+        with SimulatedCMServer(self.cm) as server:
+            not_ready, readiness = self.findings(server)
+            self.assertEqual(not_ready, {})
+            self.assertEqual(readiness.warnings(HOSTS), {
+                HOSTS[0]: ['HOST_CLOCK_OFFSET: BAD', 'HOST_MEMORY_SWAPPING: BAD']})
+
+    def test_agent_check_gates(self):
+        self.cm.health_checks[HOSTS[1]] = [dict(name='HOST_SCM_HEALTH', summary='BAD')]
+        with SimulatedCMServer(self.cm) as server:
+            self.assertEqual(self.findings(server)[0], {HOSTS[1]: ['HOST_SCM_HEALTH: BAD']})
+
+    def test_parcel_not_distributed(self):
+        self.parcel['stage'] = 'DOWNLOADED'
+        with SimulatedCMServer(self.cm) as server:
+            not_ready = self.findings(server)[0]
+        # The host outside of the cluster doesn't get the parcel
+        self.assertEqual(not_ready, dict((host, ['parcel CDH-{} DOWNLOADED'.format(VERSION)])
+                                         for host in HOSTS))
+
+
+if __name__ == '__main__':
+    unittest.main()
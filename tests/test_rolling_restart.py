@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# Tests of the rolling restart of cdh.py against a simulated Cloudera Manager.
+#
+# Usage: python -m unittest discover -s tests
+
+import time
+import unittest
+
+from cm_harness import SimulatedCMServer, started_cluster
+import benchmark
+import cdh
+
+
+HOSTS = ['worker-{:02d}.test'.format(i) for i in range(1, 9)]
+
+
+def workers(service, role_type, hosts=HOSTS):
+    return [('{}-{}-{}'.format(service, role_type, host.split('.')[0]), role_type, host)
+            for host in hosts]
+
+
+class RecordingCM(benchmark.SimulatedCM):
+    """
+    `SimulatedCM` recording the roles restarted and the role listings returned, in order
+    """
+    def __init__(self, *args, **kwargs):
+        benchmark.SimulatedCM.__init__(self, *args, **kwargs)
+        self.log = []
+
+    def role_command(self, body, command, cluster=None, service=None):
+        self.log.append(('restart', service, list(body['items'])))
+        return benchmark.SimulatedCM.role_command(self, body, command, cluster, service)
+
+    def get_roles(self, body, cluster=None, service=None):
+        result = benchmark.SimulatedCM.get_roles(self, body, cluster, service)
+        self.log.append(('roles', service, dict((role['name'], role['healthSummary'])
+                                                for role in result['items'])))
+        return result
+
+
+class RollingRestartTest(unittest.TestCase):
+
+    def cluster(self, replication=3, health_delay=0.0):
+        cm = RecordingCM(HOSTS, latency=0, command_duration=0.01, host_duration=0,
+                         health_delay=health_delay)
+        started_cluster(cm, 'test', {
+            'HDFS': ('HDFS', dict(dfs_replication=str(replication)),
+                     [('HDFS-NAMENODE', 'NAMENODE', HOSTS[0])] + workers('HDFS', 'DATANODE')),
+            'HBASE': ('HBASE', {},
+                      [('HBASE-MASTER', 'MASTER', HOSTS[0])] + workers('HBASE', 'REGIONSERVER')),
+        })
+        return cm
+
+    def restart(self, server, services, batch_size=5, health_timeout=5):
+        restart = cdh.RollingRestart(None, server.api.get_cluster('test'), services, batch_size,
+                                     health_timeout=health_timeout, health_interval=0.02)
+        return restart.run()
+
+    def restarted(self, cm):
+        return [(service, roles) for event, service, roles in cm.log if event == 'restart']
+
+    def test_replicated_batches_below_replication(self):
+        for replication in [2, 3]:
+            cm = self.cluster(replication)
+            with SimulatedCMServer(cm) as server:
+                restarted = self.restart(server, ['HBASE', 'HDFS'])
+
+            self.assertEqual(sorted(restarted), ['HBASE', 'HDFS'])
+            for service, role_type in [('HDFS', 'DATANODE'), ('HBASE', 'REGIONSERVER')]:
+                batches = [batch for batch in restarted[service] if role_type in batch[0]]
+                self.assertEqual(sorted(sum(batches, [])),
+                                 sorted(name for name, _, _ in workers(service, role_type)))
+                for batch in batches:
+                    self.assertTrue(len(batch) < replication, (replication, batch))
+
+    def test_dependency_order(self):
+        cm = self.cluster()
+        with SimulatedCMServer(cm) as server:
+            self.restart(server, ['HBASE', 'HDFS'])
+
+        services = [service for service, _ in self.restarted(cm)]
+        self.assertEqual(services, sorted(services, key=['HDFS', 'HBASE'].index))
+        # Masters go first, one at a time
+        self.assertEqual(self.restarted(cm)[0], ('HDFS', ['HDFS-NAMENODE']))
+
+    def test_dependency_cycle(self):
+        registry = cdh.ServiceRegistry(dict(Zookeeper=dict(depends_on=['Hbase'])))
+        restart = cdh.RollingRestart(None, None, ['HBASE', 'HDFS', 'ZOOKEEPER'], registry=registry)
+        with self.assertRaises(Exception) as raised:
+            restart.order()
+        self.assertIn('HBASE -> ZOOKEEPER -> HBASE', str(raised.exception))
+
+    def test_health_wait_between_batches(self):
+        cm = self.cluster(health_delay=0.1)
+        with SimulatedCMServer(cm) as server:
+            self.restart(server, ['HDFS'])
+
+        # Before every batch but the first, the previous batch was seen healthy
+        batches = []
+        healthy = waited = False
+        for event, service, roles in cm.log:
+            if event == 'restart':
+                if batches:
+                    self.assertTrue(healthy, batches[-1])
+                batches.append(roles)
+                healthy = False
+            elif batches:
+                healthy = all(roles.get(name) == 'GOOD' for name in batches[-1])
+                if not healthy:
+                    waited = True
+        self.assertTrue(len(batches) > 2)
+        # With the health delay, the restarted roles were seen not healthy yet at least once
+        self.assertTrue(waited)
+
+    def test_unhealthy_batch_aborts(self):
+        cm = self.cluster()
+        cm.unhealthy.add('HDFS-DATANODE-worker-01')
+        with SimulatedCMServer(cm) as server:
+            started = time.time()
+            self.assertRaises(SystemExit, self.restart, server, ['HDFS', 'HBASE'], 5, 0.5)
+            self.assertTrue(time.time() - started < 5)
+
+        restarted = self.restarted(cm)
+        # The run stopped at the batch of the unhealthy role
+        self.assertTrue(restarted[-1][1][0] == 'HDFS-DATANODE-worker-01', restarted)
+        self.assertFalse([service for service, _ in restarted if service == 'HBASE'])
+
+
+if __name__ == '__main__':
+    unittest.main()
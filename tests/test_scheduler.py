@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# Tests of the dependency ordered service scheduler of cdh.py.
+#
+# Usage: python -m unittest discover -s tests
+
+import threading
+import time
+import unittest
+
+from cm_harness import cdh
+
+
+# Seconds every simulated service step takes
+STEP_DURATION = 0.2
+
+# Simulated services and the services they depend on
+DEPENDS_ON = {
+    'ZOOKEEPER': [],
+    'HDFS': ['ZOOKEEPER'],
+    'YARN': ['HDFS'],
+    'HBASE': ['ZOOKEEPER', 'HDFS'],
+    'KAFKA': ['ZOOKEEPER'],
+    'SOLR': ['ZOOKEEPER', 'HDFS'],
+    'HUE': ['HBASE', 'YARN'],
+}
+
+
+class Steps(object):
+    """
+    Step recording the start and end time of every service, sleeping `STEP_DURATION`
+    """
+    def __init__(self, failing=None):
+        self.failing = failing
+        self.times = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name):
+        started = time.time()
+        time.sleep(STEP_DURATION)
+        with self._lock:
+            self.times[name] = (started, time.time())
+        if name == self.failing:
+            raise Exception('{} failed'.format(name))
+
+    def overlap(self, first, second):
+        return self.times[first][0] < self.times[second][1] and \
+            self.times[second][0] < self.times[first][1]
+
+
+class ServiceSchedulerTest(unittest.TestCase):
+
+    def run_steps(self, workers, names=sorted(DEPENDS_ON), failing=None):
+        steps = self.steps = Steps(failing)
+        scheduler = cdh.ServiceScheduler(workers)
+        started = time.time()
+        try:
+            scheduler.run(names, steps, key=lambda name: name,
+                          depends_on=lambda name: DEPENDS_ON[name])
+        finally:
+            steps.wall_time = time.time() - started
+        return steps
+
+    def test_dependency_order(self):
+        steps = self.run_steps(4)
+        self.assertEqual(sorted(steps.times), sorted(DEPENDS_ON))
+        for name, deps in DEPENDS_ON.items():
+            for dep in deps:
+                self.assertTrue(steps.times[dep][1] <= steps.times[name][0], (dep, name))
+
+    def test_independent_services_overlap(self):
+        steps = self.run_steps(4)
+        self.assertTrue(steps.overlap('HDFS', 'KAFKA'))
+        self.assertTrue(steps.overlap('YARN', 'HBASE'))
+        self.assertTrue(steps.overlap('HBASE', 'SOLR'))
+        # ZOOKEEPER, then HDFS and KAFKA, then YARN, HBASE and SOLR, then HUE
+        self.assertTrue(steps.wall_time < 5 * STEP_DURATION, steps.wall_time)
+
+    def test_single_worker_is_serial(self):
+        steps = self.run_steps(1)
+        intervals = sorted(steps.times.values())
+        for (_, end), (start, _) in zip(intervals, intervals[1:]):
+            self.assertTrue(end <= start)
+        self.assertTrue(steps.wall_time >= len(DEPENDS_ON) * STEP_DURATION)
+
+    def test_dependencies_not_scheduled_are_satisfied(self):
+        steps = self.run_steps(4, ['HUE', 'YARN'])
+        self.assertEqual(sorted(steps.times), ['HUE', 'YARN'])
+        self.assertTrue(steps.times['YARN'][1] <= steps.times['HUE'][0])
+
+    def test_error_stops_the_dependents(self):
+        with self.assertRaises(Exception) as context:
+            self.run_steps(4, failing='HDFS')
+        self.assertEqual(str(context.exception), 'HDFS failed')
+        # The services independent of HDFS still ran, none of the ones depending on it did
+        self.assertEqual(sorted(self.steps.times), ['HDFS', 'KAFKA', 'ZOOKEEPER'])
+
+    def test_dependency_cycle(self):
+        scheduler = cdh.ServiceScheduler(2)
+        cycle = dict(A=['B'], B=['A'])
+        self.assertRaises(Exception, scheduler.run, sorted(cycle), lambda name: None,
+                          lambda name: name, lambda name: cycle[name])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# Tests of the service deployment of cdh.py against a simulated Cloudera Manager.
+#
+# Usage: python -m unittest discover -s tests
+
+import unittest
+
+from cm_harness import SimulatedCMServer, started_cluster
+import benchmark
+import cdh
+
+
+HOSTS = ['master-{:02d}.test'.format(i) for i in range(1, 4)]
+
+
+class RecordingCM(benchmark.SimulatedCM):
+    """
+    `SimulatedCM` recording the role config updates
+    """
+    def __init__(self, *args, **kwargs):
+        benchmark.SimulatedCM.__init__(self, *args, **kwargs)
+        self.role_updates = []
+
+    def update_role_config(self, body, role, cluster=None, service=None):
+        self.role_updates.append((role, dict((item['name'], item.get('value'))
+                                             for item in body['items'])))
+        return benchmark.SimulatedCM.update_role_config(self, body, role, cluster, service)
+
+
+class ListingCM(benchmark.SimulatedCM):
+    """
+    `SimulatedCM` counting the role listings per service
+    """
+    def __init__(self, *args, **kwargs):
+        benchmark.SimulatedCM.__init__(self, *args, **kwargs)
+        self.listings = []
+
+    def get_roles(self, body, cluster=None, service=None):
+        self.listings.append(service)
+        return benchmark.SimulatedCM.get_roles(self, body, cluster, service)
+
+
+class ClusterStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cm = ListingCM(HOSTS, latency=0, command_duration=0.01, host_duration=0)
+        started_cluster(self.cm, 'test', dict(
+            (name, (name, {}, [('{}-1'.format(name), 'SERVER', HOSTS[0])]))
+            for name in ['ZOOKEEPER', 'HDFS', 'YARN', 'HBASE']))
+        self.cm.role('test', 'HBASE', 'HBASE-1')['state'] = 'STOPPED'
+
+    def test_roles_listed_on_read(self):
+        with SimulatedCMServer(self.cm) as server:
+            state = cdh.ClusterState(server.api.get_cluster('test'))
+            self.assertTrue(state.started('ZOOKEEPER'))
+            self.assertEqual(self.cm.listings, ['ZOOKEEPER'])
+            self.assertFalse(state.started('HBASE'))
+            self.assertTrue(state.started('ZOOKEEPER'))
+            self.assertEqual(self.cm.listings, ['ZOOKEEPER', 'HBASE'])
+            self.assertEqual(state.get('MISSING'), None)
+
+            # Invalidating lists the roles again on the next read
+            state.invalidate()
+            self.assertTrue(state.started('ZOOKEEPER'))
+            self.assertEqual(self.cm.listings, ['ZOOKEEPER', 'HBASE', 'ZOOKEEPER'])
+
+
+class ZookeeperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cm = RecordingCM(HOSTS, latency=0, command_duration=0.01, host_duration=0)
+        started_cluster(self.cm, 'test', {'ZOOKEEPER': ('ZOOKEEPER', {}, [])})
+        self.config = dict(roles=[dict(group='SERVER', hosts=HOSTS)])
+
+    def create_roles(self, server):
+        zookeeper = cdh.Zookeeper(server.api, server.api.get_cluster('test'), self.config)
+        zookeeper.create_roles(self.config['roles'][0], 'SERVER')
+        return zookeeper
+
+    def test_server_ids_set_once(self):
+        with SimulatedCMServer(self.cm) as server:
+            zookeeper = self.create_roles(server)
+            self.assertEqual(sorted(self.cm.role_updates),
+                             [('ZOOKEEPER-SERVER-{}'.format(i), dict(serverId=i))
+                              for i in range(1, 4)])
+            self.assertEqual(sorted(zookeeper.changes), ['ZOOKEEPER-SERVER-{}'.format(i)
+                                                         for i in range(1, 4)])
+
+            # A re-run finds the serverIds already right
+            del self.cm.role_updates[:]
+            zookeeper = self.create_roles(server)
+            self.assertEqual(self.cm.role_updates, [])
+            self.assertEqual(zookeeper.changes, {})
+
+    def test_wrong_server_id_fixed(self):
+        with SimulatedCMServer(self.cm) as server:
+            self.create_roles(server)
+            self.cm.role('test', 'ZOOKEEPER', 'ZOOKEEPER-SERVER-2')['config']['serverId'] = '5'
+            del self.cm.role_updates[:]
+            zookeeper = self.create_roles(server)
+        self.assertEqual(self.cm.role_updates, [('ZOOKEEPER-SERVER-2', dict(serverId=2))])
+        self.assertEqual(zookeeper.changes['ZOOKEEPER-SERVER-2'], dict(serverId=dict(old='5', new='2')))
+
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cm = benchmark.SimulatedCM(HOSTS, latency=0, command_duration=0.01, host_duration=0)
+        started_cluster(self.cm, 'test', {'ZOOKEEPER': (
+            'ZOOKEEPER', {}, [('ZOOKEEPER-SERVER-1', 'SERVER', HOSTS[0])])})
+
+    def orchestrated(self, server):
+        """
+        :return: Names of the services orchestrated while the journal records Zookeeper completed
+        """
+        manager = cdh.ClouderaManager(None, dict(
+            cm=dict(host='127.0.0.1', port=server.port, username='admin', password='admin'),
+            services=dict(ZOOKEEPER=dict(roles=[]))), trial=True)
+        manager.cluster = manager.api.get_cluster('test')
+        manager.state = cdh.ClusterState(manager.cluster)
+        manager.digests['MGMT'] = None
+        manager.journal.record('service:Zookeeper', manager.service_digest('Zookeeper'))
+        scheduled = set()
+        manager.scheduler.run = lambda services, step: scheduled.update(svc.name for svc in services)
+        manager.service_orchestrate(['Zookeeper'])
+        return scheduled
+
+    def test_started_service_skipped(self):
+        with SimulatedCMServer(self.cm) as server:
+            self.assertEqual(self.orchestrated(server), set())
+
+    def test_stopped_service_not_skipped(self):
+        self.cm.role('test', 'ZOOKEEPER', 'ZOOKEEPER-SERVER-1')['state'] = 'STOPPED'
+        with SimulatedCMServer(self.cm) as server:
+            self.assertEqual(self.orchestrated(server), set(['ZOOKEEPER']))
+
+
+if __name__ == '__main__':
+    unittest.main()
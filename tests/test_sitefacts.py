@@ -0,0 +1,164 @@
+#!/usr/bin/python
+# Regression tests of the worker memory reservations of sitefacts.py.
+#
+# The expected reservations are pinned here rather than read from the tables of sitefacts.py, so
+# that a change of a table or of the interpolation shows up as a failure to review.
+#
+# Usage: python -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'playbooks', 'library', 'site_facts'))
+
+import sitefacts
+
+
+# Reservations in GB of the standard node sizes.
+# Map: node memory in GB => (stack, hbase, impala, kafka)
+RESERVATIONS = {
+    4: (1, 1, 1, 1),
+    8: (2, 1, 2, 1),
+    16: (2, 2, 4, 2),
+    24: (4, 4, 6, 2),
+    48: (6, 8, 12, 4),
+    64: (8, 8, 16, 6),
+    72: (8, 8, 16, 6),
+    96: (12, 16, 24, 8),
+    128: (24, 24, 32, 8),
+    256: (32, 32, 64, 12),
+    512: (64, 64, 128, 16),
+    1024: (128, 128, 256, 32),
+}
+
+
+class ReservationTest(unittest.TestCase):
+
+    def test_stack(self):
+        for memory, (stack, _, _, _) in sorted(RESERVATIONS.items()):
+            self.assertEqual(sitefacts.getReservedStackdnmemory(memory), stack, memory)
+
+    def test_hbase(self):
+        for memory, (_, hbase, _, _) in sorted(RESERVATIONS.items()):
+            self.assertEqual(sitefacts.getReservedHBaseMem(memory), hbase, memory)
+            self.assertEqual(sitefacts.getReservedServiceMem('hbase', memory), hbase, memory)
+
+    def test_impala(self):
+        for memory, (_, _, impala, _) in sorted(RESERVATIONS.items()):
+            self.assertEqual(sitefacts.getReservedServiceMem('impala', memory), impala, memory)
+
+    def test_kafka(self):
+        for memory, (_, _, _, kafka) in sorted(RESERVATIONS.items()):
+            self.assertEqual(sitefacts.getReservedServiceMem('kafka', memory), kafka, memory)
+
+    def test_interpolated_between_table_sizes(self):
+        # 32GB is halfway between 24GB and 48GB
+        self.assertEqual(sitefacts.getReservedStackdnmemory(32), 5)
+        self.assertEqual(sitefacts.getReservedHBaseMem(32), 5)
+        self.assertEqual(sitefacts.getReservedServiceMem('impala', 32), 8)
+        self.assertEqual(sitefacts.getReservedServiceMem('kafka', 32), 3)
+        # 192GB is halfway between 128GB and 256GB
+        self.assertEqual(sitefacts.getReservedStackdnmemory(192), 28)
+
+    def test_clamped_below_the_table(self):
+        for memory in [1, 2, 3]:
+            self.assertEqual(sitefacts.getReservedStackdnmemory(memory), 1)
+            self.assertEqual(sitefacts.getReservedHBaseMem(memory), 1)
+            self.assertEqual(sitefacts.getReservedServiceMem('impala', memory), 1)
+            self.assertEqual(sitefacts.getReservedServiceMem('kafka', memory), 1)
+
+    def test_share_kept_above_the_table(self):
+        # Above 512GB the reservation keeps the share of memory of the largest table size
+        self.assertEqual(sitefacts.getReservedStackdnmemory(2048), 256)
+        self.assertEqual(sitefacts.getReservedHBaseMem(2048), 256)
+        self.assertEqual(sitefacts.getReservedServiceMem('impala', 2048), 512)
+        self.assertEqual(sitefacts.getReservedServiceMem('kafka', 2048), 64)
+
+
+class ColocatedServicesTest(unittest.TestCase):
+
+    def test_services(self):
+        self.assertEqual(sitefacts.colocated_services(), [])
+        self.assertEqual(sitefacts.colocated_services(hbaseEnabled=True), ['hbase'])
+        self.assertEqual(sitefacts.colocated_services(True, True, True), ['hbase', 'impala', 'kafka'])
+        self.assertEqual(sitefacts.colocated_services(False, True, True), ['impala', 'kafka'])
+
+    def test_combinations(self):
+        for memory, (stack, hbase, impala, kafka) in sorted(RESERVATIONS.items()):
+            for hbaseEnabled in [False, True]:
+                for impalaEnabled in [False, True]:
+                    for kafkaEnabled in [False, True]:
+                        services = sitefacts.colocated_services(hbaseEnabled, impalaEnabled, kafkaEnabled)
+                        expected = stack + hbaseEnabled * hbase + impalaEnabled * impala + \
+                            kafkaEnabled * kafka
+                        self.assertEqual(sitefacts.getReservedMem(memory, services), expected,
+                                         (memory, services))
+
+    def test_usable_memory(self):
+        # 96GB worker with HBase: 12GB for the stack and 16GB for HBase
+        sizing = sitefacts.node_sizing(16, 96, 12, ['hbase'])
+        self.assertEqual(sizing['reserved_mb'], 28 * 1024)
+        self.assertEqual(sizing['usable_mb'], 68 * 1024)
+
+    def test_usable_memory_floor(self):
+        # Reservations larger than the node still leave 2GB to YARN
+        sizing = sitefacts.node_sizing(4, 4, 4, ['hbase', 'impala', 'kafka'])
+        self.assertEqual(sizing['usable_mb'], 2 * 1024)
+
+
+class WorkloadTest(unittest.TestCase):
+
+    # Worker shapes as (cores, memory in GB)
+    SHAPES = [(4, 16), (8, 32), (16, 64), (32, 128), (48, 256)]
+
+    def facts(self, workload, cores, memory, services=()):
+        weights = sitefacts.WORKLOADS[workload]
+        sizing = sitefacts.node_sizing(cores, memory, 12, list(services), weights['regionserver_share'])
+        yarn_site = sitefacts.yarn_site_facts(sizing['container_ram'], sizing['containers'], 'scaled',
+                                              cores)
+        return yarn_site, sitefacts.workload_facts(weights, list(services), sizing, yarn_site, cores)
+
+    def test_spark_executors_fit(self):
+        for workload in ['batch-etl', 'interactive', 'hbase-serving', 'spark']:
+            for cores, memory in self.SHAPES:
+                yarn_site, facts = self.facts(workload, cores, memory)
+                spark = facts['spark-defaults']
+                heap = sitefacts.megabytes(spark['spark_yarn_executor_memory'])
+                request = heap + int(spark['spark_yarn_executor_memoryOverhead'])
+                self.assertTrue(request <= yarn_site['yarn_scheduler_maximum_allocation_mb'],
+                                (workload, memory, request))
+                # At least 1GB of heap per executor core
+                self.assertTrue(heap >= 1024 * int(spark['spark_executor_cores']),
+                                (workload, memory, spark))
+
+    def test_llap_daemon_fits(self):
+        for cores, memory in self.SHAPES:
+            yarn_site, facts = self.facts('interactive', cores, memory)
+            site, env = facts['hive-interactive-site'], facts['hive-interactive-env']
+            daemon = int(site['hive_llap_daemon_yarn_container_mb'])
+            self.assertTrue(daemon <= yarn_site['yarn_nodemanager_resource_memory_mb'])
+            self.assertEqual(int(env['llap_heap_size']) + int(env['llap_headroom_space']) +
+                             int(site['hive_llap_io_memory_size']), daemon)
+            self.assertEqual(site['hive_llap_io_enabled'], 'true', memory)
+
+    def test_default_sizing_unchanged(self):
+        # Without a workload the sizing keeps the facts of the default tuning
+        sizing = sitefacts.node_sizing(16, 64, 12, ['hbase'])
+        self.assertFalse('yarn_mb' in sizing or 'regionserver_mb' in sizing)
+        self.assertEqual(sitefacts.spark_defaults_facts(48)['spark_yarn_executor_memory'], '7808m')
+
+    def test_regionserver_heap(self):
+        _, facts = self.facts('hbase-serving', 16, 48, ['hbase'])
+        # 8GB reserved for HBase, grown by 40% of the 34GB usable memory rounded down to a GB
+        self.assertEqual(facts['hbase-env']['hbase_regionserver_heapsize'], '{}m'.format(21 * 1024))
+        _, facts = self.facts('hbase-serving', 16, 96, ['hbase'])
+        self.assertEqual(facts['hbase-env']['hbase_regionserver_heapsize'],
+                         '{}m'.format(sitefacts.MAX_REGIONSERVER_HEAP_MB))
+        _, facts = self.facts('batch-etl', 16, 96)
+        self.assertFalse('hbase-env' in facts)
+
+
+if __name__ == '__main__':
+    unittest.main()
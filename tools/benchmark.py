@@ -0,0 +1,677 @@
+#!/usr/bin/python
+# This file is part of Ansible
+
+# Offline benchmark of the cdh.py orchestration against a simulated Cloudera Manager.
+#
+# A local HTTP server implements the part of the CM REST API used by cdh.py, with a configurable
+# latency per API call, duration per command and injected failures. `ClouderaManager.setup()`
+# is driven against it for synthetic clusters, and the total wall time, the API calls made and
+# the time spent in sleeps are reported per cluster size, so orchestration changes can be
+# checked for their effect on large builds without a real cluster.
+#
+# Usage: python tools/benchmark.py [--sizes 10,100,1000] [--latency 0.005] [--parallelism 8]
+#                                  [--poll-interval 0.05] [--output results.json]
+
+from collections import Counter, defaultdict
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urlparse
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'playbooks', 'library', 'cloudera'))
+
+import cdh
+
+
+# Unpatched sleep, used by the simulated server so that its latency isn't counted as a sleep of
+# the orchestration
+_sleep = time.sleep
+
+# CM API prefix used by cm_api
+API_PREFIX = re.compile(r'^/api/v\d+')
+
+# Parcel stages and the transitional stage shown while the command starting them is running
+PARCEL_STAGES = {
+    'startDownload': ('DOWNLOADING', 'DOWNLOADED'),
+    'startDistribution': ('DISTRIBUTING', 'DISTRIBUTED'),
+    'activate': ('ACTIVATING', 'ACTIVATED'),
+}
+
+# Role state after a role or service command finished
+COMMAND_STATES = {'start': 'STARTED', 'restart': 'STARTED', 'stop': 'STOPPED'}
+
+# Management roles of the synthetic clusters
+MGMT_ROLES = ['ACTIVITYMONITOR', 'ALERTPUBLISHER', 'EVENTSERVER', 'HOSTMONITOR', 'SERVICEMONITOR']
+
+# Services of the synthetic clusters, placed by the `PlacementPlanner`
+BENCHMARK_SERVICES = ['ZOOKEEPER', 'HDFS', 'YARN', 'SPARK_ON_YARN', 'HBASE', 'HIVE', 'IMPALA',
+                      'OOZIE', 'SQOOP', 'SOLR', 'KAFKA', 'HUE']
+
+# Message of commands failed by the failure injection, which cdh.py retries
+UNAVAILABLE_MESSAGE = 'Command is not currently available for execution'
+
+SERVICE = r'(?:/cm/service|/clusters/(?P<cluster>[^/]+)/services/(?P<service>[^/]+))'
+PARCEL = r'/clusters/(?P<cluster>[^/]+)/parcels/products/(?P<product>[^/]+)/versions/(?P<version>[^/]+)'
+
+# (HTTP method, path pattern, `SimulatedCM` method handling it)
+ROUTES = [
+    ('GET', r'/cm/license', 'get_license'),
+    ('POST', r'/cm/license', 'begin_trial'),
+    ('POST', r'/cm/trial/begin', 'begin_trial'),
+    ('GET', r'/cm/config', 'get_cm_config'),
+    ('PUT', r'/cm/config', 'update_cm_config'),
+    ('POST', r'/cm/commands/(?P<command>[^/]+)', 'cm_command'),
+    ('PUT', r'/cm/service', 'create_mgmt'),
+    ('GET', r'/hosts', 'get_hosts'),
+    ('GET', r'/commands/(?P<command_id>\d+)', 'get_command'),
+    ('POST', r'/clusters', 'create_clusters'),
+    ('GET', r'/clusters/(?P<cluster>[^/]+)', 'get_cluster'),
+    ('GET', r'/clusters/(?P<cluster>[^/]+)/hosts', 'get_cluster_hosts'),
+    ('POST', r'/clusters/(?P<cluster>[^/]+)/hosts', 'add_cluster_hosts'),
+    ('POST', r'/clusters/(?P<cluster>[^/]+)/commands/(?P<command>[^/]+)', 'cluster_command'),
+    ('GET', PARCEL, 'get_parcel'),
+    ('POST', PARCEL + r'/commands/(?P<command>[^/]+)', 'parcel_command'),
+    ('GET', r'/clusters/(?P<cluster>[^/]+)/services', 'get_services'),
+    ('POST', r'/clusters/(?P<cluster>[^/]+)/services', 'create_services'),
+    ('GET', SERVICE, 'get_service'),
+    ('GET', SERVICE + r'/config', 'get_service_config'),
+    ('PUT', SERVICE + r'/config', 'update_service_config'),
+    ('GET', SERVICE + r'/roleConfigGroups/(?P<group>[^/]+)', 'get_group'),
+    ('GET', SERVICE + r'/roleConfigGroups/(?P<group>[^/]+)/config', 'get_group_config'),
+    ('PUT', SERVICE + r'/roleConfigGroups/(?P<group>[^/]+)/config', 'update_group_config'),
+    ('GET', SERVICE + r'/roles', 'get_roles'),
+    ('POST', SERVICE + r'/roles', 'create_roles'),
+    ('GET', SERVICE + r'/roles/(?P<role>[^/]+)', 'get_role'),
+    ('GET', SERVICE + r'/roles/(?P<role>[^/]+)/config', 'get_role_config'),
+    ('PUT', SERVICE + r'/roles/(?P<role>[^/]+)/config', 'update_role_config'),
+    ('POST', SERVICE + r'/commands/(?P<command>[^/]+)', 'service_command'),
+    ('POST', SERVICE + r'/roleCommands/(?P<command>[^/]+)', 'role_command'),
+]
+
+
+class NotFound(Exception):
+    pass
+
+
+class SimulatedCM(object):
+    """
+    In memory state of a simulated Cloudera Manager
+
+    Commands finish `command_duration` seconds after they are issued, plus `host_duration` for
+    every host they touch, and their effects (started services and roles, parcel stages) are
+    applied when they finish. `error_rate` of the API calls are answered with a 503, and
+    `command_failure_rate` of the commands fail with a message cdh.py treats as retryable.
+
+    Started roles report a good health `health_delay` seconds after they started, except for the
+    roles in `unhealthy`, which report a bad health.
+    """
+    def __init__(self, hosts, latency=0.005, command_duration=0.5, host_duration=0.002,
+                 parcel_duration=2.0, error_rate=0.0, command_failure_rate=0.0, seed=None,
+                 health_delay=0.0):
+        self.hosts = list(hosts)
+        self.health_delay = health_delay
+        self.unhealthy = set()
+        # Health checks of the hosts. Map: host => list of dicts with the name and summary
+        self.health_checks = {}
+        self.latency = latency
+        self.command_duration = command_duration
+        self.host_duration = host_duration
+        self.parcel_duration = parcel_duration
+        self.error_rate = error_rate
+        self.command_failure_rate = command_failure_rate
+        self.random = random.Random(seed)
+        self.routes = [(method, re.compile('^{}$'.format(pattern)), handler,
+                        '{} {}'.format(method, self.label(pattern)))
+                       for method, pattern, handler in ROUTES]
+        self.calls = Counter()
+        self.errors = 0
+        self._lock = threading.RLock()
+        self._license = None
+        self._cm_config = {}
+        self._clusters = {}
+        self._mgmt = None
+        self._commands = {}
+
+    @staticmethod
+    def label(pattern):
+        """
+        :return: Readable form of a route pattern, used to count the calls
+        """
+        pattern = pattern.replace(SERVICE, '/{service}')
+        return re.sub(r'\(\?P<(\w+)>[^)]*\)', r'{\1}', pattern)
+
+    def handle(self, method, path, body):
+        """
+        :param method: HTTP method
+        :param path: Request path including the query
+        :param body: Decoded JSON request body, None if there is none
+        :return: Tuple of HTTP status and the object to return as JSON
+        """
+        _sleep(self.latency)
+        path = API_PREFIX.sub('', urlparse.urlparse(path).path).rstrip('/')
+        for route_method, pattern, handler, label in self.routes:
+            match = pattern.match(path)
+            if route_method != method or match is None:
+                continue
+            with self._lock:
+                self.calls[label] += 1
+                if self.error_rate and self.random.random() < self.error_rate:
+                    self.errors += 1
+                    return 503, dict(message='Injected failure')
+                try:
+                    return 200, getattr(self, handler)(body, **match.groupdict())
+                except NotFound as e:
+                    return 404, dict(message='{} not found'.format(e))
+        with self._lock:
+            self.calls['{} {}'.format(method, path)] += 1
+        return 404, dict(message='No route for {} {}'.format(method, path))
+
+    # Commands
+
+    def command(self, name, hosts=1, effect=None, duration=None):
+        """
+        Issue a command
+
+        :param name: Command name
+        :param hosts: Number of hosts touched by the command
+        :param effect: Function applied once the command succeeded
+        :param duration: Duration in seconds, defaults to the one computed for the hosts
+        """
+        if duration is None:
+            duration = self.command_duration + self.host_duration * hosts
+        cmd = dict(id=len(self._commands) + 1, name=name, started=time.time(), duration=duration,
+                   failed=bool(self.command_failure_rate and
+                               self.random.random() < self.command_failure_rate),
+                   effect=effect, active=True)
+        self._commands[cmd['id']] = cmd
+        return self.command_json(cmd)
+
+    def command_json(self, cmd):
+        if cmd['active'] and time.time() - cmd['started'] >= cmd['duration']:
+            cmd['active'] = False
+            if not cmd['failed'] and cmd['effect'] is not None:
+                cmd['effect']()
+        result = dict(id=cmd['id'], name=cmd['name'], active=cmd['active'])
+        if not cmd['active']:
+            result['success'] = not cmd['failed']
+            result['resultMessage'] = UNAVAILABLE_MESSAGE if cmd['failed'] else 'Finished'
+        return result
+
+    def get_command(self, body, command_id):
+        if int(command_id) not in self._commands:
+            raise NotFound('Command {}'.format(command_id))
+        return self.command_json(self._commands[int(command_id)])
+
+    # Cloudera Manager
+
+    def get_license(self, body):
+        if self._license is None:
+            raise NotFound('License')
+        return self._license
+
+    def begin_trial(self, body):
+        self._license = dict(owner='Trial', uuid='00000000-0000-0000-0000-000000000000')
+        return {}
+
+    def get_cm_config(self, body):
+        return dict(items=[dict(name=cdh.REMOTE_PARCEL_REPO_URLS,
+                                value=self._cm_config.get(cdh.REMOTE_PARCEL_REPO_URLS),
+                                default='https://archive.cloudera.com/cdh5/parcels/latest/')])
+
+    def update_cm_config(self, body):
+        for item in body['items']:
+            self._cm_config[item['name']] = item.get('value')
+        return self.get_cm_config(None)
+
+    def cm_command(self, body, command):
+        return self.command(command, len(self.hosts))
+
+    def create_mgmt(self, body):
+        self._mgmt = self.new_service(None, 'mgmt', 'MGMT')
+        return self.service_json(self._mgmt)
+
+    def host_json(self, host, heartbeat):
+        result = dict(hostId=host, hostname=host, lastHeartbeat=heartbeat,
+                      healthChecks=self.health_checks.get(host, []))
+        for cluster in self._clusters.values():
+            if host in cluster['hosts']:
+                result['clusterRef'] = dict(clusterName=cluster['name'])
+        return result
+
+    def get_hosts(self, body):
+        heartbeat = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+        return dict(items=[self.host_json(host, heartbeat) for host in self.hosts])
+
+    # Clusters
+
+    def cluster(self, name):
+        if name not in self._clusters:
+            raise NotFound('Cluster {}'.format(name))
+        return self._clusters[name]
+
+    def create_clusters(self, body):
+        for item in body['items']:
+            self._clusters[item['name']] = dict(name=item['name'], version=item.get('version'),
+                                                fullVersion=item.get('fullVersion'), hosts=[],
+                                                services={}, parcels={})
+        return dict(items=[self.get_cluster(None, item['name']) for item in body['items']])
+
+    def get_cluster(self, body, cluster):
+        cluster = self.cluster(cluster)
+        return dict(name=cluster['name'], version=cluster['version'],
+                    fullVersion=cluster['fullVersion'])
+
+    def get_cluster_hosts(self, body, cluster):
+        return dict(items=[dict(hostId=host) for host in self.cluster(cluster)['hosts']])
+
+    def add_cluster_hosts(self, body, cluster):
+        hosts = self.cluster(cluster)['hosts']
+        added = [item['hostId'] for item in body['items'] if item['hostId'] not in hosts]
+        hosts.extend(added)
+        return dict(items=[dict(hostId=host) for host in added])
+
+    def cluster_command(self, body, cluster, command):
+        return self.command(command, len(self.cluster(cluster)['hosts']))
+
+    # Parcels
+
+    def parcel(self, cluster, product, version):
+        parcels = self.cluster(cluster)['parcels']
+        key = (product, version)
+        if key not in parcels:
+            parcels[key] = dict(product=product, version=version, stage='AVAILABLE_REMOTELY',
+                                command=None)
+        return parcels[key]
+
+    def get_parcel(self, body, cluster, product, version):
+        parcel = self.parcel(cluster, product, version)
+        progress = total = 0
+        if parcel['command'] is not None:
+            cmd = parcel['command']
+            self.command_json(cmd)
+            if cmd['active']:
+                total = 100
+                progress = int(100 * (time.time() - cmd['started']) / cmd['duration'])
+        return dict(product=product, version=version, stage=parcel['stage'],
+                    state=dict(progress=progress, totalProgress=total, count=0, totalCount=0,
+                               warnings=[], errors=[]),
+                    clusterRef=dict(clusterName=cluster))
+
+    def parcel_command(self, body, cluster, product, version, command):
+        parcel = self.parcel(cluster, product, version)
+        running, finished = PARCEL_STAGES[command]
+
+        def effect():
+            parcel['stage'] = finished
+
+        hosts = len(self.cluster(cluster)['hosts']) if command == 'startDistribution' else 1
+        parcel['stage'] = running
+        result = self.command(command, effect=effect,
+                              duration=self.parcel_duration + self.host_duration * hosts)
+        parcel['command'] = self._commands[result['id']]
+        return result
+
+    # Services
+
+    def new_service(self, cluster, name, service_type):
+        return dict(cluster=cluster, name=name, type=service_type, state='STOPPED', config={},
+                    groups={}, roles={})
+
+    def service(self, cluster, service):
+        if cluster is None:
+            if self._mgmt is None:
+                raise NotFound('Management service')
+            return self._mgmt
+        services = self.cluster(cluster)['services']
+        if service not in services:
+            raise NotFound('Service {}'.format(service))
+        return services[service]
+
+    def service_json(self, svc):
+        result = dict(name=svc['name'], type=svc['type'], serviceState=svc['state'])
+        if svc['cluster'] is not None:
+            result['clusterRef'] = dict(clusterName=svc['cluster'])
+        return result
+
+    def get_services(self, body, cluster):
+        return dict(items=[self.service_json(svc)
+                           for svc in self.cluster(cluster)['services'].values()])
+
+    def create_services(self, body, cluster):
+        services = self.cluster(cluster)['services']
+        for item in body['items']:
+            services[item['name']] = self.new_service(cluster, item['name'], item['type'])
+        return dict(items=[self.service_json(services[item['name']]) for item in body['items']])
+
+    def get_service(self, body, cluster=None, service=None):
+        return self.service_json(self.service(cluster, service))
+
+    @staticmethod
+    def config_json(config):
+        # CM returns all the config values as strings
+        return dict(items=[dict(name=name, value=cdh.config_value(value))
+                           for name, value in sorted(config.items())])
+
+    def get_service_config(self, body, cluster=None, service=None):
+        return dict(self.config_json(self.service(cluster, service)['config']), roleTypeConfigs=[])
+
+    def update_service_config(self, body, cluster=None, service=None):
+        config = self.service(cluster, service)['config']
+        config.update((item['name'], item.get('value')) for item in body['items'])
+        return self.get_service_config(None, cluster, service)
+
+    def group(self, cluster, service, group):
+        svc = self.service(cluster, service)
+        if group not in svc['groups']:
+            # Base groups exist for every role type of a service
+            prefix = '{}-'.format(svc['name'])
+            if not (group.startswith(prefix) and group.endswith('-BASE')):
+                raise NotFound('Role config group {}'.format(group))
+            svc['groups'][group] = dict(roleType=group[len(prefix):-len('-BASE')], config={})
+        return svc['groups'][group]
+
+    def get_group(self, body, group, cluster=None, service=None):
+        svc = self.service(cluster, service)
+        result = dict(name=group, roleType=self.group(cluster, service, group)['roleType'], base=True,
+                      serviceRef=dict(serviceName=svc['name']))
+        if cluster is not None:
+            result['serviceRef']['clusterName'] = cluster
+        return result
+
+    def get_group_config(self, body, group, cluster=None, service=None):
+        return self.config_json(self.group(cluster, service, group)['config'])
+
+    def update_group_config(self, body, group, cluster=None, service=None):
+        config = self.group(cluster, service, group)['config']
+        config.update((item['name'], item.get('value')) for item in body['items'])
+        return self.config_json(config)
+
+    def role_json(self, svc, name):
+        role = svc['roles'][name]
+        ref = dict(serviceName=svc['name'])
+        if svc['cluster'] is not None:
+            ref['clusterName'] = svc['cluster']
+        return dict(name=name, type=role['type'], hostRef=dict(hostId=role['host']),
+                    roleState=role['state'], healthSummary=self.health(name, role), serviceRef=ref)
+
+    def health(self, name, role):
+        if role['state'] != 'STARTED':
+            return 'DISABLED' if role['type'] == 'GATEWAY' else 'UNKNOWN'
+        if name in self.unhealthy:
+            return 'BAD'
+        if time.time() - role.get('started', 0) < self.health_delay:
+            return 'UNKNOWN'
+        return 'GOOD'
+
+    @staticmethod
+    def set_state(role, state):
+        role['state'] = state
+        if state == 'STARTED':
+            role['started'] = time.time()
+
+    def get_roles(self, body, cluster=None, service=None):
+        svc = self.service(cluster, service)
+        return dict(items=[self.role_json(svc, name) for name in sorted(svc['roles'])])
+
+    def create_roles(self, body, cluster=None, service=None):
+        svc = self.service(cluster, service)
+        for item in body['items']:
+            svc['roles'][item['name']] = dict(type=item['type'], host=item['hostRef']['hostId'],
+                                              state='STOPPED', config={})
+        return dict(items=[self.role_json(svc, item['name']) for item in body['items']])
+
+    def role(self, cluster, service, role):
+        svc = self.service(cluster, service)
+        if role not in svc['roles']:
+            raise NotFound('Role {}'.format(role))
+        return svc['roles'][role]
+
+    def get_role(self, body, role, cluster=None, service=None):
+        self.role(cluster, service, role)
+        return self.role_json(self.service(cluster, service), role)
+
+    def get_role_config(self, body, role, cluster=None, service=None):
+        return self.config_json(self.role(cluster, service, role)['config'])
+
+    def update_role_config(self, body, role, cluster=None, service=None):
+        config = self.role(cluster, service, role)['config']
+        config.update((item['name'], item.get('value')) for item in body['items'])
+        return self.config_json(config)
+
+    def service_command(self, body, command, cluster=None, service=None):
+        svc = self.service(cluster, service)
+
+        def effect():
+            if command in COMMAND_STATES:
+                svc['state'] = COMMAND_STATES[command]
+                for role in svc['roles'].values():
+                    if role['type'] != 'GATEWAY':
+                        self.set_state(role, COMMAND_STATES[command])
+
+        hosts = len(set(role['host'] for role in svc['roles'].values())) or 1
+        return self.command(command, hosts, effect)
+
+    def role_command(self, body, command, cluster=None, service=None):
+        svc = self.service(cluster, service)
+        commands = []
+        for name in body['items']:
+            role = svc['roles'].get(name)
+
+            def effect(role=role):
+                if role is not None and command in COMMAND_STATES:
+                    self.set_state(role, COMMAND_STATES[command])
+
+            commands.append(self.command(command, 1, effect))
+        return dict(items=commands, errors=[])
+
+
+class SimulatedCMHandler(BaseHTTPRequestHandler):
+    """
+    Serve the `SimulatedCM` of the server over HTTP with keep-alive
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        try:
+            body = json.loads(body) if body else None
+        except ValueError:
+            # The license upload is sent as a multipart form
+            body = None
+        status, result = self.server.cm.handle(self.command, self.path, body)
+        data = json.dumps(result)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SleepMeter(object):
+    """
+    Replace `time.sleep` to account the time cdh.py spends sleeping per call site, which is the
+    class and function calling it, or the retried function for sleeps between retries
+    """
+    def __init__(self):
+        self.sleeps = defaultdict(lambda: dict(count=0, seconds=0.0))
+        self._lock = threading.Lock()
+        self._filename = cdh.__file__.rstrip('c')
+
+    def sleep(self, seconds):
+        frame = sys._getframe(1)
+        if frame.f_code.co_filename.rstrip('c') != self._filename:
+            # Sleeps of the thread pools and the simulated CM
+            _sleep(seconds)
+            return
+        if frame.f_code.co_name == 'retry_loop' and 'func' in frame.f_locals:
+            site = 'retry {}'.format(frame.f_locals['func'].__name__)
+        elif 'self' in frame.f_locals:
+            site = '{}.{}'.format(frame.f_locals['self'].__class__.__name__, frame.f_code.co_name)
+        else:
+            site = frame.f_code.co_name
+        with self._lock:
+            self.sleeps[site]['count'] += 1
+            self.sleeps[site]['seconds'] += seconds
+        _sleep(seconds)
+
+    def __enter__(self):
+        time.sleep = self.sleep
+        return self
+
+    def __exit__(self, *exc_info):
+        time.sleep = _sleep
+
+
+def synthetic_config(port, size, services=BENCHMARK_SERVICES):
+    """
+    Build a cluster.yaml config for a synthetic cluster, with the roles placed by the planner
+
+    :param port: Port of the simulated CM
+    :param size: Number of hosts
+    :param services: Services to place on the hosts
+    :return: Config dict as loaded from a cluster.yaml
+    """
+    hosts = ['host-{:04d}.bench'.format(i) for i in range(1, size + 1)]
+    facts = [dict(hostname=host, cores=16, memory_mb=65536, disks=1 if i < 3 else 12)
+             for i, host in enumerate(hosts)]
+    placement = cdh.PlacementPlanner(facts).plan(services)
+    mgmt = dict(roles=[dict(group=group, hosts=hosts[:1]) for group in MGMT_ROLES])
+    return dict(cm=dict(host='127.0.0.1', port=port, username='admin', password='admin'),
+                cluster=dict(name='bench', version='CDH5', fullVersion='5.16.2', hosts=hosts),
+                parcels=[dict(product='CDH', version='5.16.2-1.cdh5.16.2.p0.8')],
+                services=cdh.merge_placement(dict(MGMT=mgmt), placement))
+
+
+def reset():
+    """
+    Reset the module level state of cdh.py between runs
+    """
+    cdh.RETRY_STATS.clear()
+    cdh.TRACER = cdh.Tracer()
+
+
+def run(size, options):
+    """
+    Run a full setup of a synthetic cluster against a simulated CM
+
+    :param size: Number of hosts
+    :param options: Parsed command line options
+    :return: Dict of results
+    """
+    config = synthetic_config(0, size)
+    cm = SimulatedCM(config['cluster']['hosts'], options.latency, options.command_duration,
+                     options.host_duration, options.parcel_duration, options.error_rate,
+                     options.command_failure_rate, options.seed)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SimulatedCMHandler)
+    server.cm = cm
+    thread = threading.Thread(target=server.serve_forever, name='simulated-cm')
+    thread.daemon = True
+    thread.start()
+    config['cm']['port'] = server.server_address[1]
+
+    reset()
+    cdh.COMMAND_WATCHER.interval = options.poll_interval
+    manager = cdh.ClouderaManager(None, config, trial=True, parallelism=options.parallelism)
+    error = None
+    started = time.time()
+    with SleepMeter() as meter:
+        try:
+            manager.setup()
+        except (Exception, SystemExit) as e:  # pylint: disable=broad-except
+            error = '{}: {}'.format(e.__class__.__name__, e)
+    wall_time = time.time() - started
+    server.shutdown()
+    server.server_close()
+
+    sleeps = dict((site, dict(count=stats['count'], seconds=round(stats['seconds'], 3)))
+                  for site, stats in meter.sleeps.items())
+    return dict(hosts=size, parallelism=options.parallelism, poll_interval=options.poll_interval,
+                roles=sum(len(role['hosts']) for service in config['services'].values()
+                                      for role in service['roles']),
+                wall_time=round(wall_time, 3), error=error,
+                api_calls=sum(cm.calls.values()), injected_errors=cm.errors,
+                calls=dict(cm.calls.most_common(options.top)),
+                sleep_time=round(sum(stats['seconds'] for stats in sleeps.values()), 3),
+                sleeps=sleeps, retries=dict(cdh.RETRY_STATS),
+                http=manager.http.stats() if manager.http is not None else None)
+
+
+def report(result):
+    print '{hosts} hosts, {roles} roles, parallelism {parallelism}, {poll_interval}s poll: ' \
+          '{wall_time}s wall time, {api_calls} API calls, {sleep_time}s sleeping'.format(**result)
+    if result['error']:
+        print '  FAILED: {}'.format(result['error'])
+    print '  Sleeps:'
+    for site, stats in sorted(result['sleeps'].items(), key=lambda item: -item[1]['seconds']):
+        print '    {:<40} {:>6} x {:>9.3f}s'.format(site, stats['count'], stats['seconds'])
+    print '  Most frequent API calls:'
+    for label, count in sorted(result['calls'].items(), key=lambda item: -item[1]):
+        print '    {:<80} {:>6}'.format(label, count)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark ClouderaManager.setup() against a simulated Cloudera Manager')
+    parser.add_argument('--sizes', default='10,100,1000',
+                        help='Comma separated cluster sizes in hosts')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Latency in seconds of every API call')
+    parser.add_argument('--command-duration', type=float, default=0.5,
+                        help='Base duration in seconds of every command')
+    parser.add_argument('--host-duration', type=float, default=0.002,
+                        help='Additional command duration in seconds per host touched')
+    parser.add_argument('--parcel-duration', type=float, default=2.0,
+                        help='Duration in seconds of every parcel stage')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Share of the API calls failing with a 503')
+    parser.add_argument('--command-failure-rate', type=float, default=0.0,
+                        help='Share of the commands failing as not available for execution')
+    parser.add_argument('--parallelism', type=int, default=cdh.DEFAULT_PARALLELISM)
+    parser.add_argument('--poll-interval', type=float, default=0.05,
+                        help='Tick in seconds of the command poller of cdh.py, kept well below the '
+                             'command durations so that it does not hide the effect of the '
+                             'parallelism, {}s in cdh.py'.format(cdh.COMMAND_POLL_INTERVAL))
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--top', type=int, default=10,
+                        help='Number of most frequent API calls to report')
+    parser.add_argument('--output', default='', help='Write the results as JSON to this file')
+    parser.add_argument('--events', default='', help='Write the progress events to this file')
+    options = parser.parse_args()
+
+    if options.events:
+        cdh.EVENTS.open(options.events)
+    else:
+        cdh.EVENTS.echo = False
+
+    results = []
+    for size in [int(size) for size in options.sizes.split(',')]:
+        result = run(size, options)
+        report(result)
+        results.append(result)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    return 1 if any(result['error'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
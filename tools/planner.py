@@ -0,0 +1,266 @@
+#!/usr/bin/python
+# This file is part of Ansible
+
+# What-if capacity planner for the worker sizing of sitefacts.py.
+#
+# sitefacts.py sizes the YARN containers of one node shape per Ansible run. This planner evaluates
+# the same formulas (reserved memory, minimum container size, number of containers, yarn-site and
+# mapred-site allocations) over a whole grid of node shapes (cores, memory, disks and the
+# colocated HBase, Impala and Kafka) at once with NumPy, and reports the containers, the usable
+# and wasted RAM and the task heaps of every shape, so node shapes can be compared before buying
+# them. All sizes are in MB.
+#
+# A workload profile moves memory from YARN to the RegionServer heap as sitefacts.py does. One
+# workload is planned per run, compare the workloads with a run each.
+#
+# Usage: python tools/planner.py [--cores 8,16,32] [--memory 64:512:64] [--disks 4,12]
+#                                [--hbase both] [--impala no] [--kafka no] [--sizing conservative]
+#                                [--workload default] [--sort wasted_mb] [--top 20]
+#                                [--output plan.csv] [--verify]
+
+from functools import partial
+import argparse
+import csv
+import os
+import re
+import sys
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'playbooks', 'library', 'site_facts'))
+
+import sitefacts
+from sitefacts import GB
+
+
+# Axes of the grid of node shapes, the colocated services as 0 or 1
+AXES = ['cores', 'memory_gb', 'disks', 'hbase', 'impala', 'kafka']
+
+# Colocated services of the grid, as in sitefacts.reservedServices
+SERVICES = ['hbase', 'impala', 'kafka']
+
+# Columns of the plan, in the order they are reported
+COLUMNS = AXES + ['reserved_mb', 'usable_mb', 'regionserver_mb', 'containers', 'container_mb',
+                  'nodemanager_mb', 'wasted_mb', 'wasted_pct', 'map_tasks', 'map_heap_mb',
+                  'reduce_heap_mb', 'am_heap_mb']
+
+# Values of a service axis per command line choice
+FLAGS = dict(both=[0, 1], yes=[1], no=[0])
+
+# Columns compared with the scalar sitefacts.py sizing by --verify.
+# Map: column => (sitefacts.py config, fact key)
+VERIFIED = {
+    'nodemanager_mb': ('yarn_site', 'yarn_nodemanager_resource_memory_mb'),
+    'map_heap_mb': ('mapred_site', 'mapreduce_map_java_opts'),
+    'reduce_heap_mb': ('mapred_site', 'mapreduce_reduce_java_opts'),
+    'am_heap_mb': ('mapred_site', 'yarn_app_mapreduce_am_command_opts'),
+}
+
+
+def parse_axis(value, cast=int):
+    """
+    Values of one axis of the grid
+
+    :param value: Comma separated values and start:stop:step ranges, stop included
+    :return: Sorted array of the distinct values
+    """
+    values = []
+    for part in value.split(','):
+        if ':' in part:
+            start, stop, step = [cast(bound) for bound in part.split(':')]
+            values.extend(value for value in np.arange(start, stop + step, step) if value <= stop)
+        else:
+            values.append(cast(part))
+    return np.unique(values)
+
+
+def lookup(function, values):
+    """
+    Vectorize a scalar sitefacts.py table lookup, calling it once per distinct value
+
+    :return: Array of the results, shaped like `values`
+    """
+    distinct, inverse = np.unique(values, return_inverse=True)
+    return np.array([function(int(value)) for value in distinct])[inverse].reshape(values.shape)
+
+
+def grid(*axes):
+    """
+    Every combination of the axes, flattened
+
+    :param axes: Values of every axis of `AXES`, in order
+    :return: Dict of axis name to array
+    """
+    return dict(zip(AXES, [axis.ravel() for axis in np.meshgrid(*axes, indexing='ij')]))
+
+
+def plan(shapes, mode='conservative', weights=None):
+    """
+    Size every node shape, following sitefacts.node_sizing, yarn_site_facts and mapred_site_facts
+
+    :param shapes: Dict of axis name to array, as returned by `grid`
+    :param mode: Sizing mode, one of `sitefacts.SIZING_MODES`
+    :param weights: Weights of the workload profile, as in `sitefacts.WORKLOADS`
+    :return: Dict of column name to array
+    """
+    cores, memory, disks = shapes['cores'], shapes['memory_gb'], shapes['disks']
+
+    min_container = lookup(sitefacts.getMinContainerSize, memory)
+    reserved = lookup(sitefacts.getReservedStackdnmemory, memory)
+    for service in SERVICES:
+        service_mem = lookup(partial(sitefacts.getReservedServiceMem, service), memory)
+        reserved = reserved + np.where(shapes[service], service_mem, 0)
+    usable_mb = np.maximum(2, memory - reserved) * GB
+
+    # The RegionServer heap is its reservation, grown with memory taken from YARN
+    share = weights['regionserver_share'] if weights else 0.0
+    regionserver_mb = lookup(sitefacts.getReservedHBaseMem, memory) * GB
+    moved_mb = np.minimum((share * usable_mb).astype(int) // GB * GB,
+                          np.maximum(0, sitefacts.MAX_REGIONSERVER_HEAP_MB - regionserver_mb))
+    moved_mb = np.where(shapes['hbase'], moved_mb, 0)
+    regionserver_mb = np.where(shapes['hbase'], regionserver_mb + moved_mb, 0)
+    yarn_mb = usable_mb - moved_mb
+
+    containers = np.minimum(2 * cores, np.minimum(np.ceil(1.8 * disks), yarn_mb // min_container))
+    containers = np.where(containers <= 2, 3, containers).astype(int)
+
+    container_mb = yarn_mb // containers
+    container_mb = np.where(container_mb > GB, container_mb // 512 * 512, container_mb)
+    reduce_mb = np.where(container_mb <= 2048, 2 * container_mb, container_mb)
+    am_mb = np.maximum(container_mb, reduce_mb)
+
+    if mode == 'scaled':
+        nodemanager_mb = np.maximum(containers * container_mb, 1024)
+        map_mb = np.maximum(container_mb, 1028)
+        task_heap = lambda memory: np.maximum((0.8 * memory).astype(int), 1028)
+    else:
+        nodemanager_mb = np.clip(containers * container_mb, 1024, 8192)
+        map_mb = np.clip(container_mb, 1028, 4096)
+        task_heap = lambda memory: np.clip((0.8 * memory).astype(int), 1028, 8192)
+    wasted_mb = memory * GB - reserved * GB - moved_mb - nodemanager_mb
+
+    return dict(shapes,
+                reserved_mb=reserved * GB,
+                usable_mb=usable_mb,
+                regionserver_mb=regionserver_mb,
+                containers=containers,
+                container_mb=container_mb,
+                nodemanager_mb=nodemanager_mb,
+                wasted_mb=np.maximum(0, wasted_mb),
+                wasted_pct=np.round(100.0 * np.maximum(0, wasted_mb) / (memory * GB), 1),
+                map_tasks=nodemanager_mb // map_mb,
+                map_heap_mb=task_heap(container_mb),
+                reduce_heap_mb=task_heap(reduce_mb),
+                am_heap_mb=np.clip((0.8 * am_mb).astype(int), 1028, 8192))
+
+
+def verify(result, mode='conservative', weights=None):
+    """
+    Compare the plan with the scalar sitefacts.py sizing of every shape
+
+    :return: List of the mismatches, as (shape, column, planned, sitefacts.py) tuples
+    """
+    mismatches = []
+    for row in range(len(result['cores'])):
+        shape = tuple(int(result[axis][row]) for axis in AXES)
+        sizing = sitefacts.node_sizing(shape[0], shape[1], shape[2],
+                                       [service for service in SERVICES if result[service][row]],
+                                       weights['regionserver_share'] if weights else 0.0)
+        facts = dict(
+            yarn_site=sitefacts.yarn_site_facts(sizing['container_ram'], sizing['containers'], mode,
+                                                shape[0]),
+            mapred_site=sitefacts.mapred_site_facts(sizing['map_memory'], sizing['reduce_memory'],
+                                                    sizing['am_memory'], mode))
+        for column, (config, key) in VERIFIED.items():
+            expected = int(re.sub(r'\D', '', str(facts[config][key])))
+            if expected != int(result[column][row]):
+                mismatches.append((shape, column, int(result[column][row]), expected))
+        if sizing['containers'] != int(result['containers'][row]):
+            mismatches.append((shape, 'containers', int(result['containers'][row]),
+                               sizing['containers']))
+        if sizing['regionserver_mb'] != int(result['regionserver_mb'][row]):
+            mismatches.append((shape, 'regionserver_mb', int(result['regionserver_mb'][row]),
+                               sizing['regionserver_mb']))
+    return mismatches
+
+
+def rows(result, sort, top=None):
+    """
+    Rows of the plan sorted by a column, ties broken by the node shape
+
+    :return: List of lists of the values of `COLUMNS`
+    """
+    order = np.lexsort([result[axis] for axis in reversed(AXES)] + [result[sort]])
+    return [[result[column][row].item() for column in COLUMNS] for row in order[:top]]
+
+
+def report(result, sort, top):
+    print '{} node shapes, sorted by {}'.format(len(result['cores']), sort)
+    print ' '.join('{:>14}'.format(column) for column in COLUMNS)
+    for row in rows(result, sort, top):
+        print ' '.join('{:>14}'.format(value) for value in row)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the sitefacts.py worker sizing over a grid of node shapes')
+    parser.add_argument('--cores', default='8,12,16,24,32,48,64',
+                        help='Cores per node, comma separated values or start:stop:step ranges')
+    parser.add_argument('--memory', default='32,48,64,96,128,192,256,384,512',
+                        help='Memory per node in GB, comma separated values or start:stop:step '
+                             'ranges')
+    parser.add_argument('--disks', default='2,4,6,8,12,24',
+                        help='Disks per node, comma separated values or start:stop:step ranges')
+    parser.add_argument('--hbase', default='both', choices=sorted(FLAGS),
+                        help='Whether HBase runs on the nodes')
+    parser.add_argument('--impala', default='no', choices=sorted(FLAGS),
+                        help='Whether Impala runs on the nodes')
+    parser.add_argument('--kafka', default='no', choices=sorted(FLAGS),
+                        help='Whether a Kafka broker runs on the nodes')
+    parser.add_argument('--sizing', default='conservative', choices=sitefacts.SIZING_MODES,
+                        help='Sizing mode of sitefacts.py')
+    parser.add_argument('--workload', default='default', choices=sorted(sitefacts.WORKLOADS),
+                        help='Workload profile of sitefacts.py, other than default it requires '
+                             '--sizing scaled')
+    parser.add_argument('--sort', default='wasted_mb', choices=COLUMNS)
+    parser.add_argument('--top', type=int, default=20, help='Number of node shapes to report')
+    parser.add_argument('--output', default='', help='Write every node shape as CSV to this file')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check the plan against the scalar sitefacts.py sizing of every shape')
+    options = parser.parse_args()
+
+    if not HAS_NUMPY:
+        sys.stderr.write('planner.py requires numpy\n')
+        return 2
+    weights = sitefacts.WORKLOADS[options.workload]
+    if weights and options.sizing != 'scaled':
+        parser.error('the {} workload profile requires --sizing scaled'.format(options.workload))
+
+    result = plan(grid(parse_axis(options.cores), parse_axis(options.memory),
+                       parse_axis(options.disks), FLAGS[options.hbase], FLAGS[options.impala],
+                       FLAGS[options.kafka]), options.sizing, weights)
+    report(result, options.sort, options.top)
+
+    if options.output:
+        with open(options.output, 'wb') as output:
+            writer = csv.writer(output)
+            writer.writerow(COLUMNS)
+            writer.writerows(rows(result, options.sort))
+
+    if options.verify:
+        mismatches = verify(result, options.sizing, weights)
+        for shape, column, planned, expected in mismatches:
+            print ('MISMATCH cores={} memory={} disks={} hbase={} impala={} kafka={}: '
+                   '{} {} != {}').format(*(shape + (column, planned, expected)))
+        print '{} mismatches against sitefacts.py'.format(len(mismatches))
+        return 1 if mismatches else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())